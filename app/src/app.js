@@ -38,6 +38,8 @@ export default class App {
         this.eventSource = null
         this.connectTime = null
         this.keepAliveTimer = null
+        // ID of the last received event to resume after reconnecting
+        this.lastEventId = null
         this.clusters = new Map()
         this.clusterStatuses = new Map()
         this.viewContainerTargetPosition = new PIXI.Point()
@@ -601,6 +603,8 @@ export default class App {
             this.selectedClusters.add(clusterId)
         }
         this.changeLocationHash('clusters', Array.from(this.selectedClusters).join(','))
+        // newly selected clusters need a full snapshot
+        this.lastEventId = null
         // make sure we are updating our EventSource filter
         this.connect()
         this.update()
@@ -625,7 +629,7 @@ export default class App {
         const nowSeconds = Date.now() / 1000
         for (const [clusterId, statusObj] of this.clusterStatuses.entries()) {
             const lastQueryTime = statusObj.last_query_time || 0
-            if (lastQueryTime < nowSeconds - this.config.maxDataAgeSeconds) {
+            if (this.isOutdated(statusObj, nowSeconds)) {
                 this.clusters.delete(clusterId)
                 updateNeeded = true
             } else if (lastQueryTime < nowSeconds - 20) {
@@ -637,6 +641,12 @@ export default class App {
         }
     }
 
+    isOutdated(statusObj, nowSeconds) {
+        // stale clusters (loaded from the server's snapshot) get more time to be queried
+        const maxDataAgeSeconds = statusObj.stale ? this.config.maxStaleDataAgeSeconds : this.config.maxDataAgeSeconds
+        return (statusObj.last_query_time || 0) < nowSeconds - maxDataAgeSeconds
+    }
+
     disconnect() {
         if (this.eventSource != null) {
             this.eventSource.close()
@@ -651,6 +661,7 @@ export default class App {
             statusObj = {}
         }
         statusObj.last_query_time = Date.now() / 1000
+        delete statusObj.stale
         this.clusterStatuses.set(clusterId, statusObj)
     }
 
@@ -660,9 +671,23 @@ export default class App {
         const that = this
         // NOTE: path must be relative to work with kubectl proxy out of the box
         let url = this.config.route_prefix + (this.config.route_prefix === '/' ? 'events' : '/events')
+        const query = []
         const clusterIds = Array.from(this.selectedClusters).join(',')
         if (clusterIds) {
-            url += '?cluster_ids=' + clusterIds
+            query.push('cluster_ids=' + clusterIds)
+        }
+        if (this.config.maxUpdateRate) {
+            query.push('max_update_rate=' + this.config.maxUpdateRate)
+        }
+        if (this.config.compress) {
+            query.push('compress=true')
+        }
+        if (this.lastEventId) {
+            // only replay missed events instead of sending all clusters again
+            query.push('last_event_id=' + encodeURIComponent(this.lastEventId))
+        }
+        if (query.length) {
+            url += '?' + query.join('&')
         }
         const eventSource = this.eventSource = new EventSource(url, {credentials: 'include'})
         this.keepAlive()
@@ -679,10 +704,11 @@ export default class App {
         eventSource.addEventListener('clusterupdate', function (event) {
             that._errors = 0
             that.keepAlive()
+            that.lastEventId = event.lastEventId
             const cluster = JSON.parse(event.data)
             const status = that.clusterStatuses.get(cluster.id)
             const nowSeconds = Date.now() / 1000
-            if (status && status.last_query_time < nowSeconds - that.config.maxDataAgeSeconds) {
+            if (status && that.isOutdated(status, nowSeconds)) {
                 // outdated data => ignore
             } else {
                 that.clusters.set(cluster.id, cluster)
@@ -692,6 +718,7 @@ export default class App {
         eventSource.addEventListener('clusterdelta', function (event) {
             that._errors = 0
             that.keepAlive()
+            that.lastEventId = event.lastEventId
             const data = JSON.parse(event.data)
             // we received some delta => we know that the cluster query succeeded!
             that.refreshLastQueryTime(data.cluster_id)
@@ -707,6 +734,7 @@ export default class App {
         eventSource.addEventListener('clusterstatus', function (event) {
             that._errors = 0
             that.keepAlive()
+            that.lastEventId = event.lastEventId
             const data = JSON.parse(event.data)
             that.clusterStatuses.set(data.cluster_id, data.status)
         })
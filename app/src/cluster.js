@@ -168,7 +168,7 @@ export default class Cluster extends PIXI.Graphics {
 
         let newTick = null
         const nowSeconds = Date.now() / 1000
-        if (this.status && this.status.last_query_time < nowSeconds - 20) {
+        if (this.status && (this.status.stale || this.status.last_query_time < nowSeconds - 20)) {
             newTick = this.pulsate
         }
 
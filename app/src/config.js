@@ -13,6 +13,13 @@ export default class Config {
         this.maxConnectionLifetimeSeconds = 300
         // consider cluster data older than 1 minute outdated
         this.maxDataAgeSeconds = 60
+        // clusters loaded from the server's snapshot are shown until they are queried,
+        // unless their data is older than 5 minutes (e.g. the cluster is unreachable)
+        this.maxStaleDataAgeSeconds = 300
+        // maximum number of updates per cluster and second (0: unlimited)
+        this.maxUpdateRate = 0
+        // request a compressed event stream (less bandwidth, more server CPU)
+        this.compress = false
 
         this.nodeLinkUrlTemplate = null
         this.podLinkUrlTemplate = null
@@ -24,6 +31,8 @@ export default class Config {
         config.reloadIntervalSeconds = parseInt(params.get('reload')) || 0
         config.initialScale = parseFloat(params.get('scale')) || 1.0
         config.renderer = params.get('renderer') || 'auto'
+        config.maxUpdateRate = parseFloat(params.get('max_update_rate')) || 0
+        config.compress = TRUTHY_VALUES.has(params.get('compress'))
         return config
     }
 
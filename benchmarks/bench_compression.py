@@ -0,0 +1,75 @@
+"""Measure size and CPU time of the /events stream with and without compression.
+
+Usage: python -m benchmarks.bench_compression [--pods 100000] [--deltas 100]
+
+Streams the bootstrap of a large mock cluster followed by deltas with 1% churn,
+encoded exactly like the broadcaster does.
+"""
+import time
+
+import click
+
+from benchmarks.bench_delta import churn
+from benchmarks.bench_delta import generate_cluster
+from kube_ops_view import delta
+from kube_ops_view.broadcast import encode_event
+from kube_ops_view.compress import compress_events
+from kube_ops_view.compress import COMPRESSION_LEVEL
+
+
+def generate_frames(pods: int, deltas: int):
+    cluster = generate_cluster(pods)
+    frames = [encode_event("clusterupdate", cluster)]
+    for _ in range(deltas):
+        new = churn(cluster, 0.01)
+        frames.append(
+            encode_event(
+                "clusterdelta",
+                {"cluster_id": cluster["id"], "delta": delta.diff(cluster, new)},
+            )
+        )
+        cluster = new
+    return frames
+
+
+def measure(frames: list, encoding: str = None, level: int = COMPRESSION_LEVEL):
+    start = time.process_time()
+    if encoding:
+        chunks = list(compress_events(iter(frames), encoding, level))
+    else:
+        chunks = frames
+    seconds = time.process_time() - start
+    bootstrap = len(chunks[0])
+    deltas = sum(len(chunk) for chunk in chunks[1:])
+    return bootstrap, deltas, seconds
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option("--pods", type=int, default=100000, help="Number of pods")
+@click.option(
+    "--deltas", "delta_count", type=int, default=100, help="Number of streamed deltas"
+)
+def main(pods: int, delta_count: int):
+    frames = generate_frames(pods, delta_count)
+    total = sum(len(frame) for frame in frames)
+    print(
+        "{:>12} {:>16} {:>16} {:>10} {:>12}".format(
+            "encoding", "bootstrap (KiB)", "deltas (KiB)", "CPU (s)", "MiB/s"
+        )
+    )
+    # the level is not used without encoding
+    for encoding, level in ((None, 0), ("gzip", 1), ("gzip", 6), ("gzip", 9)):
+        bootstrap, deltas, seconds = measure(frames, encoding, level)
+        print(
+            "{:>12} {:>16.0f} {:>16.0f} {:>10.3f} {:>12}".format(
+                "{}-{}".format(encoding, level) if encoding else "none",
+                bootstrap / 1024,
+                deltas / 1024,
+                seconds,
+                "{:.0f}".format(total / seconds / 2 ** 20) if encoding else "-",
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Compare json_delta.diff with kube_ops_view.delta.diff on large mock clusters.
+
+Usage: python -m benchmarks.bench_delta [--pods 200,1000,10000,100000]
+
+json_delta.diff grows quadratically with the number of paths (about 6 seconds for
+200 pods, 2 minutes for 1000 pods), it is therefore only measured up to
+--json-delta-max-pods.
+"""
+
+import copy
+import json
+import random
+import time
+
+import click
+import json_delta
+
+from kube_ops_view import delta
+from kube_ops_view.mock import generate_mock_pod
+from kube_ops_view.model import Node
+from kube_ops_view.model import to_json
+
+PODS_PER_NODE = 100
+
+
+def generate_cluster(pods: int):
+    nodes = {}
+    for i in range(max(pods // PODS_PER_NODE, 1)):
+        node_pods = {}
+        for j in range(min(PODS_PER_NODE, pods)):
+            pod = generate_mock_pod(0, i, j)
+            node_pods["{}/{}".format(pod.namespace, pod.name)] = pod
+        nodes[f"node-{i}"] = Node(
+            name=f"node-{i}",
+            labels={},
+            status={"capacity": {"cpu": "8", "memory": "64Gi", "pods": "110"}},
+            pods=node_pods,
+        )
+    return {
+        "id": "bench",
+        "api_server_url": "https://bench.example.org",
+        "nodes": nodes,
+        "unassigned_pods": {},
+    }
+
+
+def churn(cluster: dict, ratio: float):
+    """Change the usage of a ratio of pods and replace some pods."""
+    new = copy.deepcopy(cluster)
+    rng = random.Random(42)
+    for node in new["nodes"].values():
+        pods = node.pods
+        for key in list(pods):
+            if rng.random() < ratio:
+                for container in pods[key].containers:
+                    container.usage["cpu"] = "{}m".format(rng.randint(1, 100))
+            elif rng.random() < ratio / 10:
+                pod = pods.pop(key)
+                pod = pod.replace(name=pod.name + "-new")
+                pods["{}/{}".format(pod.namespace, pod.name)] = pod
+    return new
+
+
+def wire(obj):
+    """Convert model objects to plain dicts (as sent to the frontend)."""
+    return json.loads(json.dumps(obj, default=to_json))
+
+
+def measure(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option(
+    "--pods",
+    "pod_counts",
+    default="200,1000,10000,100000",
+    help="Comma separated numbers of pods per cluster",
+)
+@click.option(
+    "--churn", "churn_ratio", type=float, default=0.01, help="Ratio of changed pods"
+)
+@click.option(
+    "--json-delta-max-pods",
+    type=int,
+    default=200,
+    help="Largest number of pods to diff with json_delta",
+)
+def main(pod_counts: str, churn_ratio: float, json_delta_max_pods: int):
+    print(
+        "{:>8} {:>16} {:>16} {:>8} {:>10}".format(
+            "pods", "json_delta (s)", "delta (s)", "speedup", "stanzas"
+        )
+    )
+    for pods in map(int, pod_counts.split(",")):
+        old = generate_cluster(pods)
+        new = churn(old, churn_ratio)
+        delta_seconds, stanzas = measure(lambda old=old, new=new: delta.diff(old, new))
+        old_wire, new_wire = wire(old), wire(new)
+        assert json_delta.patch(copy.deepcopy(old_wire), wire(stanzas)) == new_wire
+        if pods <= json_delta_max_pods:
+            # same arguments as previously used in update_clusters
+            json_delta_seconds, _ = measure(
+                lambda old_wire=old_wire, new_wire=new_wire: json_delta.diff(
+                    old_wire, new_wire, verbose=False, array_align=False
+                )
+            )
+            print(
+                "{:>8} {:>16.4f} {:>16.4f} {:>7.0f}x {:>10}".format(
+                    pods,
+                    json_delta_seconds,
+                    delta_seconds,
+                    json_delta_seconds / delta_seconds,
+                    len(stanzas),
+                )
+            )
+        else:
+            print(
+                "{:>8} {:>16} {:>16.4f} {:>8} {:>10}".format(
+                    pods, "-", delta_seconds, "-", len(stanzas)
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Measure the cost of each update cycle from the cluster query to an /events client.
+
+Usage: python -m benchmarks.bench_end_to_end [--clusters 3] [--nodes 100] [--pods-per-node 30] [--cycles 5]
+
+update_clusters queries the (parameterised) mock clusters, stores and publishes the
+results via the store (memory or --redis-url) and the broadcaster sends them to one
+/events client of the Flask app. A cycle is one query of every cluster, the first
+cycle (all clusters are new, full data) is reported separately from the average of
+the others. Runs offline; with the --max-* options the benchmark exits with status 1
+if a budget is exceeded, e.g. as regression gate in CI (see "make benchmark").
+"""
+import gevent.monkey
+
+gevent.monkey.patch_all()
+
+import collections
+import functools
+import resource
+import sys
+import time
+
+import click
+import gevent
+
+from kube_ops_view import broadcast
+from kube_ops_view import delta
+from kube_ops_view import main as server
+from kube_ops_view.cluster_discovery import MockDiscoverer
+from kube_ops_view.mock import query_mock_cluster
+from kube_ops_view.stores import MemoryStore
+from kube_ops_view.stores import RedisStore
+from kube_ops_view.update import update_clusters
+
+STEPS = ["query", "diff", "store", "encode"]
+
+
+class Timings:
+
+    """Seconds spent in and number of calls of wrapped functions, by step."""
+
+    def __init__(self):
+        self.seconds: collections.Counter = collections.Counter()
+        self.calls: collections.Counter = collections.Counter()
+
+    def wrap(self, step: str, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[step] += time.perf_counter() - start
+                self.calls[step] += 1
+
+        return wrapper
+
+
+def receive_events(response, received: collections.Counter):
+    for chunk in response.response:
+        received["bytes"] += len(chunk)
+
+
+def peak_rss_mib() -> float:
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option("--clusters", type=int, default=3, help="Number of mock clusters")
+@click.option("--nodes", type=int, default=100, help="Number of nodes per cluster")
+@click.option("--pods-per-node", type=int, default=30, help="Number of pods per node")
+@click.option(
+    "--containers-per-pod", type=int, default=2, help="Number of containers per pod"
+)
+@click.option(
+    "--churn", type=float, default=0.01, help="Ratio of pods replaced per second"
+)
+@click.option(
+    "--cycles", type=click.IntRange(min=2), default=5, help="Number of update cycles"
+)
+@click.option(
+    "--query-interval",
+    type=float,
+    default=1,
+    help="Interval in seconds for querying clusters",
+)
+@click.option("--redis-url", help="Redis URL to use instead of the memory store")
+@click.option(
+    "--max-cycle-seconds",
+    type=float,
+    help="Budget of seconds spent in the steps per cycle",
+)
+@click.option("--max-cycle-kib", type=float, help="Budget of event KiB per cycle")
+@click.option("--max-rss-mib", type=float, help="Budget of the max RSS in MiB")
+def main(
+    clusters: int,
+    nodes: int,
+    pods_per_node: int,
+    containers_per_pod: int,
+    churn: float,
+    cycles: int,
+    query_interval: float,
+    redis_url: str,
+    max_cycle_seconds: float,
+    max_cycle_kib: float,
+    max_rss_mib: float,
+):
+    timings = Timings()
+    store = RedisStore(redis_url) if redis_url else MemoryStore()
+    for method in "set_cluster_data", "publish":
+        setattr(store, method, timings.wrap("store", getattr(store, method)))
+    # called once per applied query result
+    store.set_cluster_status = timings.wrap("status", store.set_cluster_status)
+    # looked up as module attributes on every call
+    delta.diff = timings.wrap("diff", delta.diff)
+    broadcast.encode_event = timings.wrap("encode", broadcast.encode_event)
+
+    server.app.store = store
+    server.app.broadcaster = broadcast.Broadcaster(store)
+    gevent.spawn(server.app.broadcaster.run)
+    received: collections.Counter = collections.Counter()
+    response = server.app.test_client().get("/events", buffered=False)
+    gevent.spawn(receive_events, response, received)
+
+    query_cluster = functools.partial(
+        query_mock_cluster,
+        nodes=nodes,
+        pods_per_node=pods_per_node,
+        containers_per_pod=containers_per_pod,
+        churn=churn,
+    )
+    gevent.spawn(
+        update_clusters,
+        MockDiscoverer(clusters),
+        timings.wrap("query", query_cluster),
+        store,
+        query_interval=query_interval,
+    )
+
+    # totals at the end of each cycle (plus at the start)
+    totals = [(time.time(), collections.Counter(timings.seconds), 0)]
+    while len(totals) <= cycles:
+        gevent.sleep(0.01)
+        if timings.calls["status"] >= len(totals) * clusters:
+            # let the broadcaster and the client receive the last events
+            gevent.sleep(0.1)
+            totals.append(
+                (time.time(), collections.Counter(timings.seconds), received["bytes"])
+            )
+
+    def report(name: str, start: int, end: int):
+        """Print the average per cycle and return the seconds and KiB."""
+        cycles = end - start
+        seconds = collections.Counter(totals[end][1])
+        seconds.subtract(totals[start][1])
+        kib = (totals[end][2] - totals[start][2]) / 1024 / cycles
+        print(
+            "{:>8} {}{:>13.1f} {:>10.2f}".format(
+                name,
+                "".join("{:>11.3f}".format(seconds[step] / cycles) for step in STEPS),
+                kib,
+                (totals[end][0] - totals[start][0]) / cycles,
+            )
+        )
+        return sum(seconds[step] for step in STEPS) / cycles, kib
+
+    pods = clusters * nodes * pods_per_node
+    print(
+        "{} clusters, {} pods x {} containers, churn {}/s".format(
+            clusters, pods, containers_per_pod, churn
+        )
+    )
+    print(
+        "{:>8} {}{:>13} {:>10}".format(
+            "cycle",
+            "".join("{:>11}".format(step + " (s)") for step in STEPS),
+            "events (KiB)",
+            "wall (s)",
+        )
+    )
+    report("first", 0, 1)
+    cycle_seconds, cycle_kib = report("average", 1, cycles)
+    rss = peak_rss_mib()
+    print("max RSS: {:.0f} MiB".format(rss))
+
+    exceeded = [
+        "{} {:.2f} > {}".format(name, value, budget)
+        for name, value, budget in [
+            ("cycle seconds", cycle_seconds, max_cycle_seconds),
+            ("cycle KiB", cycle_kib, max_cycle_kib),
+            ("RSS MiB", rss, max_rss_mib),
+        ]
+        if budget is not None and value > budget
+    ]
+    if exceeded:
+        print("Budget exceeded: {}".format(", ".join(exceeded)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Measure the real Kubernetes query path against the fake API server at various scales.
+
+Usage: python -m benchmarks.bench_kubernetes [--pods 1000,10000,80000] [--latency 0.01]
+
+For each scale a fake API server (benchmarks.fake_apiserver) is started in its own
+process and queried through pykube like a real cluster: query_kubernetes_cluster
+(LIST of nodes, pods and metrics, page by page) and WatchingClusterQuery (initial
+LIST, then WATCH while pods are replaced at --churn per second).
+"""
+import gevent.monkey
+
+gevent.monkey.patch_all()
+
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+import gevent
+import requests
+
+from kube_ops_view.cluster_discovery import StaticClusterDiscoverer
+from kube_ops_view.kubernetes import query_kubernetes_cluster
+from kube_ops_view.watch import WatchingClusterQuery
+
+
+def start_server(
+    port: int,
+    pods: int,
+    pods_per_node: int,
+    containers_per_pod: int,
+    churn: float,
+    latency: float,
+    error_rate: float,
+) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.fake_apiserver",
+            "--port",
+            str(port),
+            "--nodes",
+            str(max(pods // pods_per_node, 1)),
+            "--pods-per-node",
+            str(min(pods_per_node, pods)),
+            "--containers-per-pod",
+            str(containers_per_pod),
+            "--churn",
+            str(churn),
+            "--latency",
+            str(latency),
+            "--error-rate",
+            str(error_rate),
+        ],
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        try:
+            requests.get("http://localhost:{}/version".format(port), timeout=1)
+            return process
+        except requests.exceptions.RequestException:
+            gevent.sleep(0.2)
+    process.terminate()
+    raise TimeoutError("Fake API server did not start")
+
+
+def measure(query, cluster, repeat: int):
+    """Return the durations of successful queries and the number of failures."""
+    durations = []
+    failures = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            data = query(cluster)
+        except Exception:
+            failures += 1
+        else:
+            durations.append(time.perf_counter() - start)
+            del data
+    return durations, failures
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option(
+    "--pods",
+    "pod_counts",
+    default="1000,10000,80000",
+    help="Comma separated numbers of pods per cluster",
+)
+@click.option("--pods-per-node", type=int, default=80, help="Number of pods per node")
+@click.option(
+    "--containers-per-pod", type=int, default=2, help="Number of containers per pod"
+)
+@click.option(
+    "--churn", type=float, default=0.001, help="Ratio of pods replaced per second"
+)
+@click.option(
+    "--latency", type=float, default=0.01, help="Delay in seconds of every response"
+)
+@click.option(
+    "--error-rate", type=float, default=0, help="Ratio of requests failing with 500"
+)
+@click.option("--repeat", type=int, default=3, help="Number of queries per scale")
+@click.option("--port", type=int, default=18001, help="Port of the fake API server")
+def main(
+    pod_counts: str,
+    pods_per_node: int,
+    containers_per_pod: int,
+    churn: float,
+    latency: float,
+    error_rate: float,
+    repeat: int,
+    port: int,
+):
+    print(
+        "{:>8} {:>12} {:>12} {:>12} {:>12} {:>9} {:>10}".format(
+            "pods",
+            "list p50 (s)",
+            "list max (s)",
+            "sync (s)",
+            "watch (s)",
+            "failures",
+            "RSS (MiB)",
+        )
+    )
+    for pods in map(int, pod_counts.split(",")):
+        process = start_server(
+            port, pods, pods_per_node, containers_per_pod, churn, latency, error_rate
+        )
+        try:
+            (cluster,) = StaticClusterDiscoverer(
+                ["http://localhost:{}".format(port)]
+            ).get_clusters()
+            durations, failures = measure(query_kubernetes_cluster, cluster, repeat)
+            watching_query = WatchingClusterQuery()
+            # the first query waits for the initial LIST
+            sync, sync_failures = measure(watching_query, cluster, 1)
+            gevent.sleep(1)
+            watch, watch_failures = measure(watching_query, cluster, repeat)
+            watching_query.stop()
+            print(
+                "{:>8} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f} {:>9} {:>10.0f}".format(
+                    pods,
+                    statistics.median(durations or [float("nan")]),
+                    max(durations or [float("nan")]),
+                    sync[0] if sync else float("nan"),
+                    statistics.median(watch or [float("nan")]),
+                    failures + sync_failures + watch_failures,
+                    # KiB on Linux
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                )
+            )
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
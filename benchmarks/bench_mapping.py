@@ -0,0 +1,123 @@
+"""Measure mapping pods (containers, statuses, metrics) in query_kubernetes_cluster.
+
+Usage: python -m benchmarks.bench_mapping [--pods 5000] [--containers 12]
+
+Uses synthetic sidecar-heavy pods served by an in-memory client (no HTTP, no JSON).
+"""
+import time
+
+import click
+
+from kube_ops_view.cluster_discovery import Cluster
+from kube_ops_view.kubernetes import query_kubernetes_cluster
+
+
+class Response:
+    def __init__(self, data: dict):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class InMemoryClient:
+
+    """Serves every LIST in a single page from the given objects."""
+
+    def __init__(self, objects: dict):
+        self.objects = objects
+
+    def get(self, url: str, version="v1", namespace=None, params=None):
+        return Response(
+            {
+                "metadata": {"resourceVersion": "1"},
+                # copy as the items are consumed while iterating
+                "items": list(self.objects[(version, url)]),
+            }
+        )
+
+
+def generate_pod(i: int, containers: int):
+    phase = "Succeeded" if i % 10 == 0 else "Running"
+    names = [f"container-{j}" for j in range(containers)]
+    statuses = []
+    for name in names:
+        if phase == "Succeeded":
+            state = {
+                "terminated": {"finishedAt": "2020-01-0{}T12:00:00Z".format(i % 9 + 1)}
+            }
+        else:
+            state = {"running": {"startedAt": "2020-01-01T00:00:00Z"}}
+        statuses.append(
+            {"name": name, "ready": True, "restartCount": 0, "state": state}
+        )
+    # statuses are sorted by name in the API, i.e. not in spec order
+    statuses.sort(key=lambda status: status["name"], reverse=True)
+    return {
+        "metadata": {"name": f"pod-{i}", "namespace": "default", "labels": {}},
+        "spec": {
+            "nodeName": "node-{}".format(i % 100),
+            "containers": [
+                {
+                    "name": name,
+                    "image": "example.org/image:1",
+                    "resources": {"requests": {"cpu": "10m"}},
+                }
+                for name in names
+            ],
+        },
+        "status": {
+            "phase": phase,
+            "startTime": "2020-01-01T00:00:00Z",
+            "containerStatuses": statuses,
+        },
+    }
+
+
+def generate_objects(pods: int, containers: int):
+    pod_list = [generate_pod(i, containers) for i in range(pods)]
+    return {
+        ("v1", "nodes"): [
+            {"metadata": {"name": f"node-{i}", "labels": {}}, "status": {}}
+            for i in range(100)
+        ],
+        ("v1", "pods"): pod_list,
+        ("metrics.k8s.io/v1beta1", "nodes"): [],
+        ("metrics.k8s.io/v1beta1", "pods"): [
+            {
+                "metadata": pod["metadata"],
+                "containers": [
+                    {"name": container["name"], "usage": {"cpu": "1m"}}
+                    for container in pod["spec"]["containers"]
+                ],
+            }
+            for pod in pod_list
+        ],
+    }
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option("--pods", type=int, default=5000, help="Number of pods")
+@click.option("--containers", type=int, default=12, help="Number of containers per pod")
+@click.option("--rounds", type=int, default=5, help="Number of measured queries")
+def main(pods: int, containers: int, rounds: int):
+    client = InMemoryClient(generate_objects(pods, containers))
+    cluster = Cluster("bench", "bench", "https://bench.example.org", client)
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        query_kubernetes_cluster(cluster)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(
+        "{} pods x {} containers: best of {} rounds {:.3f}s ({:.1f} us/pod)".format(
+            pods, containers, rounds, best, best / pods * 1e6
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Measure the memory held by a cluster snapshot from query_kubernetes_cluster.
+
+Usage: python -m benchmarks.bench_memory [--pods 100000] [--containers 2]
+
+Pages are served as JSON text and decoded per request (like the real API client),
+i.e. strings are not shared with the generated objects. Memory is measured with
+tracemalloc while holding the returned snapshot.
+"""
+import gc
+import json
+import tracemalloc
+
+import click
+
+from kube_ops_view.cluster_discovery import Cluster
+from kube_ops_view.kubernetes import query_kubernetes_cluster
+
+NODES = 1000
+
+
+class Response:
+    def __init__(self, text: str):
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class JsonClient:
+
+    """Serves LISTs page by page as JSON text, pods are generated on the fly."""
+
+    def __init__(self, pods: int, containers: int):
+        self.pods = pods
+        self.containers = containers
+
+    def get(self, url: str, version="v1", namespace=None, params=None):
+        params = params or {}
+        metadata = {"resourceVersion": "1"}
+        items: list = []
+        if version == "v1" and url == "nodes":
+            items = [generate_node(i) for i in range(NODES)]
+        elif version == "v1" and url == "pods":
+            offset = int(params.get("continue", 0))
+            end = min(offset + params["limit"], self.pods)
+            items = [generate_pod(i, self.containers) for i in range(offset, end)]
+            if end < self.pods:
+                metadata["continue"] = str(end)
+        return Response(json.dumps({"metadata": metadata, "items": items}))
+
+
+def generate_node(i: int):
+    return {
+        "metadata": {
+            "name": f"node-{i}",
+            "labels": {
+                "kubernetes.io/os": "linux",
+                "node.kubernetes.io/instance-type": "m5.xlarge",
+                "topology.kubernetes.io/zone": "eu-central-1{}".format("abc"[i % 3]),
+            },
+        },
+        "status": {
+            "capacity": {"cpu": "4", "memory": "16Gi", "pods": "110"},
+            "allocatable": {"cpu": "3800m", "memory": "14Gi", "pods": "110"},
+        },
+    }
+
+
+def generate_pod(i: int, containers: int):
+    app = f"app-{i % 200}"
+    return {
+        "metadata": {
+            "name": f"{app}-{i:08x}",
+            "namespace": f"namespace-{i % 50}",
+            "labels": {
+                "application": app,
+                "component": "web",
+                "pod-template-hash": f"{i % 200:010x}",
+            },
+        },
+        "spec": {
+            "nodeName": f"node-{i % NODES}",
+            "containers": [
+                {
+                    "name": f"container-{j}",
+                    "image": f"registry.example.org/{app}/container-{j}:1.0",
+                    "resources": {
+                        "requests": {"cpu": "100m", "memory": "256Mi"},
+                        "limits": {"memory": "256Mi"},
+                    },
+                }
+                for j in range(containers)
+            ],
+        },
+        "status": {
+            "phase": "Running",
+            "startTime": "2020-01-01T00:00:00Z",
+            "containerStatuses": [
+                {
+                    "name": f"container-{j}",
+                    "ready": True,
+                    "restartCount": 0,
+                    "state": {"running": {"startedAt": "2020-01-01T00:00:00Z"}},
+                }
+                for j in range(containers)
+            ],
+        },
+    }
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option("--pods", type=int, default=100000, help="Number of pods")
+@click.option("--containers", type=int, default=2, help="Number of containers per pod")
+def main(pods: int, containers: int):
+    cluster = Cluster(
+        "bench",
+        "bench",
+        "https://bench.example.org",
+        JsonClient(pods, containers),
+    )
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    data = query_kubernetes_cluster(cluster)
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del data
+    print(
+        "{} pods x {} containers: {:.1f} MiB held ({:.0f} bytes/pod)".format(
+            pods, containers, held / 2 ** 20, held / pods
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Load test of the gevent and the asyncio runtime with many concurrent SSE clients.
+
+Usage: python -m benchmarks.bench_runtimes [--clients 500] [--seconds 30]
+
+Starts the server in mock mode for each runtime, connects all clients at once and
+reports how long the bootstrap took, how many events were delivered per second and
+the CPU time used by the server. The asyncio runtime needs aiohttp.
+"""
+
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+RUNTIMES = {
+    "gevent": [sys.executable, "-m", "kube_ops_view"],
+    "asyncio": [sys.executable, "-m", "kube_ops_view.aio"],
+}
+
+
+async def client(port: int, seconds: float, started: float, stats: dict):
+    # clusterupdate events are one (long) line
+    reader, writer = await asyncio.open_connection("localhost", port, limit=2**26)
+    writer.write(
+        "GET /events HTTP/1.1\r\nHost: localhost:{}\r\n\r\n".format(port).encode()
+    )
+    deadline = started + seconds
+    try:
+        while time.time() < deadline:
+            try:
+                line = await asyncio.wait_for(
+                    reader.readline(), timeout=deadline - time.time()
+                )
+            except asyncio.TimeoutError:
+                break
+            if not line:
+                break
+            if line == b"event: bootstrapend\n":
+                stats["bootstrap"].append(time.time() - started)
+            elif line == b"event: clusterdelta\n":
+                stats["deltas"] += 1
+    finally:
+        writer.close()
+
+
+def cpu_seconds(pid: int) -> float:
+    # utime and stime in clock ticks (Linux only)
+    with open("/proc/{}/stat".format(pid)) as fd:
+        fields = fd.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def run(
+    runtime: str,
+    port: int,
+    clients: int,
+    seconds: float,
+    query_interval: float,
+    warmup: float,
+) -> dict:
+    process = subprocess.Popen(
+        RUNTIMES[runtime]
+        + ["--mock", "--port", str(port), "--query-interval", str(query_interval)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        # wait for the server and the first cluster data
+        await asyncio.sleep(warmup)
+        cpu_before = cpu_seconds(process.pid)
+        stats: dict = {"bootstrap": [], "deltas": 0}
+        started = time.time()
+        await asyncio.gather(
+            *[client(port, seconds, started, stats) for _ in range(clients)]
+        )
+        stats["cpu"] = cpu_seconds(process.pid) - cpu_before
+        return stats
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option("--clients", type=int, default=500, help="Number of SSE clients")
+@click.option("--seconds", type=float, default=30, help="Duration of the measurement")
+@click.option(
+    "--query-interval",
+    type=float,
+    default=1,
+    help="Interval in seconds for querying the mock clusters",
+)
+@click.option(
+    "--warmup",
+    type=float,
+    default=5,
+    help="Seconds to wait for the server and the first cluster data",
+)
+@click.option("--port", type=int, default=18080, help="HTTP port of the server")
+@click.option(
+    "--runtimes",
+    default=",".join(RUNTIMES),
+    help="Comma separated runtimes to measure",
+)
+def main(
+    clients: int,
+    seconds: float,
+    query_interval: float,
+    warmup: float,
+    port: int,
+    runtimes: str,
+):
+    print(
+        "{:>8} {:>10} {:>14} {:>14} {:>12} {:>8}".format(
+            "runtime",
+            "clients",
+            "bootstrap p50",
+            "bootstrap max",
+            "deltas/s",
+            "CPU (s)",
+        )
+    )
+    for runtime in runtimes.split(","):
+        stats = asyncio.run(
+            run(runtime, port, clients, seconds, query_interval, warmup)
+        )
+        bootstrap = stats["bootstrap"] or [float("nan")]
+        print(
+            "{:>8} {:>10} {:>13.2f}s {:>13.2f}s {:>12.0f} {:>8.1f}".format(
+                runtime,
+                len(stats["bootstrap"]),
+                statistics.median(bootstrap),
+                max(bootstrap),
+                stats["deltas"] / seconds,
+                stats["cpu"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
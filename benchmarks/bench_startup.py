@@ -0,0 +1,97 @@
+"""Measure the time from startup until all clusters can be sent to a new viewer.
+
+Usage: python -m benchmarks.bench_startup [--clusters 60] [--pods 1000] [--query-seconds 2]
+
+Cold start: the memory store is empty and every cluster needs to be queried first
+(each query takes --query-seconds, at most --query-concurrency at a time). Warm
+start: the memory store loads the snapshot file written before the "restart".
+"""
+import os
+import tempfile
+import time
+
+import click
+import gevent
+
+from benchmarks.bench_delta import generate_cluster
+from kube_ops_view.cluster_discovery import Cluster
+from kube_ops_view.stores import MemoryStore
+from kube_ops_view.update import update_clusters
+
+
+class Discoverer:
+    def __init__(self, clusters: int):
+        self.clusters = [
+            Cluster(
+                "cluster-{}".format(i),
+                "cluster-{}".format(i),
+                "https://example.org",
+                None,
+            )
+            for i in range(clusters)
+        ]
+
+    def get_clusters(self):
+        return self.clusters
+
+
+def bootstrap(store: MemoryStore, clusters: int) -> bool:
+    """Return whether all clusters are available to viewers (as for /events)."""
+    cluster_ids = store.get_cluster_ids()
+    return len(cluster_ids) == clusters and all(
+        store.get_cluster_data_encoded(cluster_id) for cluster_id in cluster_ids
+    )
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option("--clusters", type=int, default=60, help="Number of clusters")
+@click.option("--pods", type=int, default=1000, help="Number of pods per cluster")
+@click.option(
+    "--query-seconds", type=float, default=2, help="Duration of each cluster query"
+)
+@click.option(
+    "--query-concurrency",
+    type=int,
+    default=10,
+    help="Maximum number of clusters to query concurrently",
+)
+def main(clusters: int, pods: int, query_seconds: float, query_concurrency: int):
+    data = generate_cluster(pods)
+
+    def query_cluster(cluster):
+        gevent.sleep(query_seconds)
+        return dict(data, id=cluster.id)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "snapshot")
+        start = time.perf_counter()
+        store = MemoryStore(path)
+        greenlet = gevent.spawn(
+            update_clusters,
+            Discoverer(clusters),
+            query_cluster,
+            store,
+            query_interval=60,
+            query_concurrency=query_concurrency,
+        )
+        while not bootstrap(store, clusters):
+            gevent.sleep(0.1)
+        print("cold start: {:.1f}s".format(time.perf_counter() - start))
+        greenlet.kill()
+
+        start = time.perf_counter()
+        store.save_snapshot()
+        print(
+            "saving snapshot: {:.2f}s ({} KiB)".format(
+                time.perf_counter() - start, os.path.getsize(path) // 1024
+            )
+        )
+
+        start = time.perf_counter()
+        store = MemoryStore(path)
+        assert bootstrap(store, clusters)
+        print("warm start: {:.2f}s".format(time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
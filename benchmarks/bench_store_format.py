@@ -0,0 +1,48 @@
+"""Compare encoding/decoding cluster data for Redis in the supported formats.
+
+Usage: python -m benchmarks.bench_store_format [--pods 100000]
+
+msgpack is only measured if the msgpack package is installed.
+"""
+import time
+
+import click
+
+from benchmarks.bench_delta import generate_cluster
+from kube_ops_view.stores import Codec
+from kube_ops_view.stores import msgpack
+
+
+def measure(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option("--pods", type=int, default=100000, help="Number of pods")
+def main(pods: int):
+    cluster = generate_cluster(pods)
+    print(
+        "{:>14} {:>12} {:>12} {:>12}".format(
+            "format", "size (KiB)", "encode (s)", "decode (s)"
+        )
+    )
+    for format in Codec.FORMATS:
+        if format == "msgpack" and msgpack is None:
+            continue
+        for compress in (False, True):
+            codec = Codec(format, compress)
+            encode_seconds, data = measure(lambda codec=codec: codec.dumps(cluster))
+            decode_seconds, _ = measure(
+                lambda codec=codec, data=data: codec.loads(data)
+            )
+            print(
+                "{:>14} {:>12.0f} {:>12.3f} {:>12.3f}".format(
+                    codec.name, len(data) / 1024, encode_seconds, decode_seconds
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
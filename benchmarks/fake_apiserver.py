@@ -0,0 +1,516 @@
+"""Fake Kubernetes API server to load test the real query path without a cluster.
+
+Usage: python -m benchmarks.fake_apiserver [--clusters 1] [--nodes 100] [--pods-per-node 30]
+
+Serves generated nodes and pods (LIST with limit/continue, WATCH) and their metrics
+(metrics.k8s.io) of one cluster per port, starting at --port. Pods are replaced at
+the --churn rate, responses can be delayed (--latency) and fail randomly
+(--error-rate). Point kube-ops-view at it, e.g. with
+"--clusters=http://localhost:8001,http://localhost:8002".
+"""
+import collections
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import click
+import flask
+from werkzeug.serving import make_server
+
+from kube_ops_view.utils import stable_hash
+
+# number of watch events kept per cluster, older resource versions get "410 Gone"
+EVENT_LOG_SIZE = 10000
+# metrics-server resolution, i.e. how often the usage of pods changes
+METRICS_RESOLUTION_SECONDS = 15
+BOOKMARK_INTERVAL_SECONDS = 60
+# paginated LIST requests in progress per cluster, older ones expire
+MAX_LISTS = 20
+CONTAINER_START_TIME = "2020-01-01T00:00:00Z"
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceVersionExpired(Exception):
+
+    """The requested resourceVersion is older than the event log."""
+
+
+def generate_node(i: int) -> dict:
+    return {
+        "metadata": {
+            "name": f"node-{i}",
+            "labels": {
+                "kubernetes.io/os": "linux",
+                "node.kubernetes.io/instance-type": "m5.xlarge",
+                "topology.kubernetes.io/zone": "eu-central-1{}".format("abc"[i % 3]),
+            },
+        },
+        "status": {
+            "capacity": {"cpu": "4", "memory": "16Gi", "pods": "110"},
+            "allocatable": {"cpu": "3800m", "memory": "14Gi", "pods": "110"},
+            "addresses": [{"type": "InternalIP", "address": f"10.0.{i // 250}.{i}"}],
+        },
+    }
+
+
+def generate_pod(i: int, node_name: str, containers: int, namespaces: int) -> dict:
+    app = f"app-{i % 200}"
+    return {
+        "metadata": {
+            "name": f"{app}-{i:08x}",
+            "namespace": f"namespace-{i % namespaces}",
+            "labels": {
+                "application": app,
+                "component": "web",
+                "pod-template-hash": f"{i % 200:010x}",
+            },
+        },
+        "spec": {
+            "nodeName": node_name,
+            "containers": [
+                {
+                    "name": f"container-{j}",
+                    "image": f"registry.example.org/{app}/container-{j}:1.0",
+                    "resources": {
+                        "requests": {"cpu": "100m", "memory": "256Mi"},
+                        "limits": {"memory": "256Mi"},
+                    },
+                }
+                for j in range(containers)
+            ],
+        },
+        "status": {
+            "phase": "Running",
+            "startTime": CONTAINER_START_TIME,
+            "containerStatuses": [
+                {
+                    "name": f"container-{j}",
+                    "ready": True,
+                    "restartCount": 0,
+                    "state": {"running": {"startedAt": CONTAINER_START_TIME}},
+                }
+                for j in range(containers)
+            ],
+        },
+    }
+
+
+def get_field(obj: dict, path: str):
+    for key in path.split("."):
+        obj = obj.get(key) or {}
+    return obj or ""
+
+
+def parse_selector(selector: Optional[str]) -> List[Tuple[str, str, bool]]:
+    """Parse "key=value,key!=value" selectors into (key, value, equal) tuples."""
+    requirements = []
+    for requirement in (selector or "").split(","):
+        for operator, equal in ("!=", False), ("==", True), ("=", True):
+            if operator in requirement:
+                key, value = requirement.split(operator, 1)
+                requirements.append((key, value, equal))
+                break
+    return requirements
+
+
+def matcher(params: dict) -> Callable[[dict], bool]:
+    """Return a predicate for the labelSelector and fieldSelector query parameters.
+
+    Only equality based requirements are supported (as used by query profiles).
+    """
+    labels = parse_selector(params.get("labelSelector"))
+    fields = parse_selector(params.get("fieldSelector"))
+
+    def matches(obj: dict):
+        obj_labels = obj["metadata"].get("labels") or {}
+        return all(
+            (obj_labels.get(key) == value) == equal for key, value, equal in labels
+        ) and all(
+            (get_field(obj, key) == value) == equal for key, value, equal in fields
+        )
+
+    return matches
+
+
+class FakeCluster:
+
+    """Generated nodes and pods of one cluster and a bounded log of their changes."""
+
+    def __init__(
+        self,
+        nodes: int = 100,
+        pods_per_node: int = 30,
+        containers_per_pod: int = 2,
+        namespaces: int = 10,
+    ):
+        self.containers_per_pod = containers_per_pod
+        self.namespaces = namespaces
+        self.resource_version = 1
+        self.nodes: Dict[str, dict] = {}
+        # oldest pods first (replaced first)
+        self.pods: Dict[Tuple[str, str], dict] = {}
+        # (resource version, endpoint, event type, object)
+        self._events: collections.deque = collections.deque(maxlen=EVENT_LOG_SIZE)
+        self._changed = threading.Condition()
+        self._pod_index = 0
+        for i in range(nodes):
+            node = generate_node(i)
+            node["metadata"]["resourceVersion"] = str(self.resource_version)
+            self.nodes[node["metadata"]["name"]] = node
+        node_names = list(self.nodes)
+        for _ in range(nodes * pods_per_node):
+            self._add_pod(node_names[self._pod_index % len(node_names)])
+
+    def _add_pod(self, node_name: str) -> dict:
+        pod = generate_pod(
+            self._pod_index, node_name, self.containers_per_pod, self.namespaces
+        )
+        self._pod_index += 1
+        pod["metadata"]["resourceVersion"] = str(self.resource_version)
+        metadata = pod["metadata"]
+        self.pods[(metadata["namespace"], metadata["name"])] = pod
+        return pod
+
+    def _log(self, endpoint: str, event_type: str, obj: dict):
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        self._events.append((self.resource_version, endpoint, event_type, obj))
+
+    def replace_pods(self, count: int):
+        """Delete the oldest pods and create new ones on the same nodes."""
+        with self._changed:
+            for key in list(self.pods)[:count]:
+                pod = self.pods.pop(key)
+                self._log("pods", "DELETED", dict(pod, metadata=dict(pod["metadata"])))
+                self._log("pods", "ADDED", self._add_pod(pod["spec"]["nodeName"]))
+            self._changed.notify_all()
+
+    def list(self, endpoint: str, namespace: str = None) -> Tuple[int, List[dict]]:
+        """Return the current resource version and all objects of the endpoint."""
+        with self._changed:
+            if endpoint == "nodes":
+                return self.resource_version, list(self.nodes.values())
+            return self.resource_version, [
+                pod
+                for key, pod in self.pods.items()
+                if namespace is None or key[0] == namespace
+            ]
+
+    def wait_for_events(
+        self, endpoint: str, resource_version: int, timeout: float
+    ) -> Tuple[int, List[Tuple[str, dict]]]:
+        """Return the current resource version and the (type, object) events since the given one.
+
+        Waits until there are new events (of any endpoint) or the timeout expires.
+        """
+        with self._changed:
+            if resource_version >= self.resource_version:
+                self._changed.wait(timeout)
+            if self._events and self._events[0][0] > resource_version + 1:
+                raise ResourceVersionExpired()
+            return self.resource_version, [
+                (event_type, obj)
+                for version, event_endpoint, event_type, obj in self._events
+                if version > resource_version and event_endpoint == endpoint
+            ]
+
+    def get_pod_usage(self, pod: dict, container: dict, now: float) -> dict:
+        window = int(now / METRICS_RESOLUTION_SECONDS)
+        value = stable_hash(pod["metadata"]["name"], container["name"], window)
+        return {
+            "cpu": "{}m".format(10 + value % 190),
+            "memory": "{}Mi".format(64 + value % 448),
+        }
+
+    def list_pod_metrics(self, namespace: str = None) -> Tuple[int, List[dict]]:
+        now = time.time()
+        resource_version, pods = self.list("pods", namespace)
+        return resource_version, [
+            {
+                "metadata": {
+                    "name": pod["metadata"]["name"],
+                    "namespace": pod["metadata"]["namespace"],
+                },
+                "timestamp": CONTAINER_START_TIME,
+                "window": "30s",
+                "containers": [
+                    {
+                        "name": container["name"],
+                        "usage": self.get_pod_usage(pod, container, now),
+                    }
+                    for container in pod["spec"]["containers"]
+                ],
+            }
+            for pod in pods
+        ]
+
+    def list_node_metrics(self) -> Tuple[int, List[dict]]:
+        now = time.time()
+        resource_version, nodes = self.list("nodes")
+        window = int(now / METRICS_RESOLUTION_SECONDS)
+        return resource_version, [
+            {
+                "metadata": {"name": node["metadata"]["name"]},
+                "timestamp": CONTAINER_START_TIME,
+                "window": "30s",
+                "usage": {
+                    "cpu": "{}m".format(
+                        100 + stable_hash(node["metadata"]["name"], window) % 3000
+                    ),
+                    "memory": "{}Mi".format(
+                        1024 + stable_hash(window, node["metadata"]["name"]) % 12000
+                    ),
+                },
+            }
+            for node in nodes
+        ]
+
+
+def status_response(code: int, reason: str, message: str):
+    return (
+        flask.jsonify(
+            {
+                "kind": "Status",
+                "apiVersion": "v1",
+                "status": "Failure",
+                "message": message,
+                "reason": reason,
+                "code": code,
+            }
+        ),
+        code,
+    )
+
+
+def watch_events(cluster: FakeCluster, endpoint: str, namespace: Optional[str]):
+    """Stream watch events as JSON lines until timeoutSeconds (like the API server)."""
+    args = flask.request.args
+    resource_version = int(args.get("resourceVersion") or cluster.resource_version)
+    deadline = time.time() + args.get("timeoutSeconds", 1800, type=float)
+    bookmarks = args.get("allowWatchBookmarks") == "true"
+    matches = matcher(args)
+
+    def event(event_type: str, obj: dict):
+        return json.dumps({"type": event_type, "object": obj}) + "\n"
+
+    def generate():
+        nonlocal resource_version
+        last_bookmark = time.time()
+        while True:
+            try:
+                resource_version, events = cluster.wait_for_events(
+                    endpoint,
+                    resource_version,
+                    max(min(deadline - time.time(), BOOKMARK_INTERVAL_SECONDS), 0),
+                )
+            except ResourceVersionExpired:
+                yield event(
+                    "ERROR",
+                    {
+                        "kind": "Status",
+                        "status": "Failure",
+                        "reason": "Expired",
+                        "code": 410,
+                    },
+                )
+                return
+            for event_type, obj in events:
+                if (
+                    namespace is None or obj["metadata"]["namespace"] == namespace
+                ) and matches(obj):
+                    yield event(event_type, obj)
+            if bookmarks and time.time() - last_bookmark >= BOOKMARK_INTERVAL_SECONDS:
+                last_bookmark = time.time()
+                yield event(
+                    "BOOKMARK",
+                    {"metadata": {"resourceVersion": str(resource_version)}},
+                )
+            if time.time() >= deadline:
+                return
+
+    return flask.Response(generate(), mimetype="application/json")
+
+
+def create_app(
+    cluster: FakeCluster, latency: float = 0, error_rate: float = 0
+) -> flask.Flask:
+    """Create the WSGI app serving the given cluster."""
+    app = flask.Flask(__name__)
+    # items of recent LIST requests by continue token prefix (consistent pages),
+    # requests are served in threads
+    lists: collections.OrderedDict = collections.OrderedDict()
+    lists_lock = threading.Lock()
+    list_ids = itertools.count()
+
+    def paginate(kind: str, list_items: Callable[[], Tuple[int, List[dict]]]):
+        """Return one page of the listed items, the continue token refers to the list."""
+        args = flask.request.args
+        token = args.get("continue")
+        if token:
+            list_id, offset = map(int, token.split("-"))
+            with lists_lock:
+                listed = lists.get(list_id)
+            if listed is None:
+                return status_response(
+                    410, "Expired", "The provided continue parameter is too old"
+                )
+            resource_version, items = listed
+        else:
+            list_id, offset = next(list_ids), 0
+            resource_version, items = list_items()
+            matches = matcher(args)
+            items = [item for item in items if matches(item)]
+        limit = args.get("limit", type=int) or len(items)
+        metadata = {"resourceVersion": str(resource_version)}
+        with lists_lock:
+            if offset + limit < len(items):
+                metadata["continue"] = "{}-{}".format(list_id, offset + limit)
+                lists[list_id] = resource_version, items
+                while len(lists) > MAX_LISTS:
+                    lists.popitem(last=False)
+            else:
+                lists.pop(list_id, None)
+        return flask.Response(
+            json.dumps(
+                {
+                    "kind": kind,
+                    "apiVersion": "v1",
+                    "metadata": metadata,
+                    "items": items[offset : offset + limit],
+                }
+            ),
+            mimetype="application/json",
+        )
+
+    @app.before_request
+    def delay_or_fail():
+        if latency:
+            time.sleep(latency)
+        if error_rate and random.random() < error_rate:
+            return status_response(500, "InternalError", "Injected error")
+
+    @app.route("/version")
+    def version():
+        return flask.jsonify({"major": "1", "minor": "18", "gitVersion": "v1.18.0"})
+
+    @app.route("/api/v1/nodes")
+    def nodes():
+        if flask.request.args.get("watch") == "true":
+            return watch_events(cluster, "nodes", None)
+        return paginate("NodeList", lambda: cluster.list("nodes"))
+
+    @app.route("/api/v1/pods")
+    @app.route("/api/v1/namespaces/<namespace>/pods")
+    def pods(namespace: str = None):
+        if flask.request.args.get("watch") == "true":
+            return watch_events(cluster, "pods", namespace)
+        return paginate("PodList", lambda: cluster.list("pods", namespace))
+
+    @app.route("/apis/metrics.k8s.io/v1beta1/nodes")
+    def node_metrics():
+        return paginate("NodeMetricsList", cluster.list_node_metrics)
+
+    @app.route("/apis/metrics.k8s.io/v1beta1/pods")
+    @app.route("/apis/metrics.k8s.io/v1beta1/namespaces/<namespace>/pods")
+    def pod_metrics(namespace: str = None):
+        return paginate("PodMetricsList", lambda: cluster.list_pod_metrics(namespace))
+
+    return app
+
+
+def churn_periodically(cluster: FakeCluster, churn: float, interval: float = 1):
+    """Replace the given ratio of pods per second."""
+    pending = 0.0
+    while True:
+        time.sleep(interval)
+        pending += churn * len(cluster.pods) * interval
+        if pending >= 1:
+            cluster.replace_pods(int(pending))
+            pending -= int(pending)
+
+
+def serve(
+    clusters: Iterable[FakeCluster],
+    port: int,
+    latency: float = 0,
+    error_rate: float = 0,
+    churn: float = 0,
+) -> list:
+    """Serve each cluster on its own port in background threads, returns the servers."""
+    servers = []
+    for i, cluster in enumerate(clusters):
+        server = make_server(
+            "localhost",
+            port + i if port else 0,
+            create_app(cluster, latency, error_rate),
+            threaded=True,
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        if churn:
+            threading.Thread(
+                target=churn_periodically, args=(cluster, churn), daemon=True
+            ).start()
+        servers.append(server)
+    return servers
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option("-p", "--port", type=int, default=8001, help="Port of the first cluster")
+@click.option("--clusters", type=int, default=1, help="Number of clusters (ports)")
+@click.option("--nodes", type=int, default=100, help="Number of nodes per cluster")
+@click.option("--pods-per-node", type=int, default=30)
+@click.option("--containers-per-pod", type=int, default=2)
+@click.option("--namespaces", type=int, default=10)
+@click.option(
+    "--churn", type=float, default=0, help="Ratio of pods replaced per second"
+)
+@click.option(
+    "--latency", type=float, default=0, help="Delay in seconds of every response"
+)
+@click.option(
+    "--error-rate", type=float, default=0, help="Ratio of requests failing with 500"
+)
+def main(
+    port: int,
+    clusters: int,
+    nodes: int,
+    pods_per_node: int,
+    containers_per_pod: int,
+    namespaces: int,
+    churn: float,
+    latency: float,
+    error_rate: float,
+):
+    logging.basicConfig(level=logging.INFO)
+    # do not log every request
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    serve(
+        [
+            FakeCluster(nodes, pods_per_node, containers_per_pod, namespaces)
+            for _ in range(clusters)
+        ],
+        port,
+        latency,
+        error_rate,
+        churn,
+    )
+    logger.info(
+        "Serving {} clusters with {} pods each on ports {}-{}..".format(
+            clusters, nodes * pods_per_node, port, port + clusters - 1
+        )
+    )
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
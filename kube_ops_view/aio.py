@@ -0,0 +1,578 @@
+"""Alternative asyncio runtime without gevent monkey patching.
+
+Usage: python -m kube_ops_view.aio --mock
+
+Serves the same routes as the default (gevent) runtime with aiohttp and shares
+everything else: the stores, the update logic (leases, apply_query_result) and the
+broadcaster's channels. The synchronous clients (pykube/requests, redis-py) are kept
+instead of async ones to share that code, their blocking calls run in thread pools
+instead of greenlets:
+
+* cluster queries (pykube/requests) in a pool of query_concurrency threads, the
+  requests of a query in threads of their own (see utils.run_concurrently)
+* store calls of the updater in a single thread, i.e. in order as before
+* store reads of requests (and snapshot saving) in the default executor
+* the store's event listener in its own thread
+
+i.e. the store is called from several threads (the memory store is locked, the
+Redis client is thread-safe).
+
+OAuth login and the watch mode are only supported by the gevent runtime.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import signal
+import threading
+import time
+from pathlib import Path
+from typing import AsyncGenerator
+from typing import Callable
+from typing import Set
+
+import click
+import jinja2
+from aiohttp import web
+
+import kube_ops_view
+from . import metrics
+from .backoff import random_jitter
+from .broadcast import _RESYNC
+from .broadcast import Broadcaster
+from .broadcast import FLUSH_INTERVAL_SECONDS
+from .broadcast import RECONNECT_WAIT_SECONDS
+from .broadcast import snapshot_frames
+from .broadcast import Subscription
+from .broadcast import VIEWERS_INTERVAL_SECONDS
+from .cli import common_options
+from .cli import create_cluster_query
+from .cli import create_discoverer
+from .cli import create_store
+from .cluster_discovery import Cluster
+from .compress import EventCompressor
+from .compress import negotiate_encoding
+from .metrics import QUERY_DURATION
+from .stores import MemoryStore
+from .update import ClusterUpdater
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait after SIGTERM until Kubernetes updated the endpoints
+SHUTDOWN_WAIT_SECONDS = 10
+
+
+class AsyncSubscription(Subscription):
+
+    """Subscription with an asyncio queue, iterate with "async for"."""
+
+    queue_class = asyncio.Queue
+    Full = asyncio.QueueFull
+    Empty = asyncio.QueueEmpty
+
+    async def __aiter__(self):
+        while not self.closed:
+            item = await self.queue.get()
+            if item is None:
+                break
+            elif item is _RESYNC:
+                # events queued so far are part of the snapshot (read afterwards)
+                self._discard_queued()
+                async for chunk in self.resync():
+                    yield chunk
+            elif not self._replayed(item):
+                yield item[0]
+
+
+class AsyncBroadcaster(Broadcaster):
+
+    """Broadcaster running in the event loop, the blocking store listener runs in a thread."""
+
+    subscription_class = AsyncSubscription
+
+    def _listen(self, loop: asyncio.AbstractEventLoop, done: asyncio.Future):
+        try:
+            for event_id, event_type, event_data in self.store.listen(
+                self.last_event_id
+            ):
+                loop.call_soon_threadsafe(
+                    self.publish, event_type, event_data, event_id
+                )
+        except Exception as e:
+            loop.call_soon_threadsafe(done.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(done.set_result, None)
+
+    async def _flush_periodically(self):
+        loop = asyncio.get_running_loop()
+        touched = time.time()
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+            now = time.time()
+            self.flush(now)
+            if now - touched >= VIEWERS_INTERVAL_SECONDS:
+                touched = now
+                cluster_ids = self.viewed_cluster_ids()
+                if cluster_ids:
+                    await loop.run_in_executor(
+                        None, self.touch_viewed_clusters, cluster_ids
+                    )
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        flusher = asyncio.ensure_future(self._flush_periodically())
+        try:
+            while True:
+                done = loop.create_future()
+                # daemon thread as store.listen() blocks forever (and would block exit)
+                threading.Thread(
+                    target=self._listen, args=(loop, done), name="listen", daemon=True
+                ).start()
+                try:
+                    await done
+                except Exception as e:
+                    logger.exception(f"Failed to listen for events: {e}")
+                await asyncio.sleep(RECONNECT_WAIT_SECONDS)
+        finally:
+            flusher.cancel()
+
+
+async def query_cluster_with_timeout(
+    query_cluster: Callable[[Cluster], dict],
+    cluster: Cluster,
+    query_timeout: float,
+    executor: concurrent.futures.Executor,
+    results: asyncio.Queue,
+):
+    """Query a single cluster (in a pool thread) and put the result into the queue."""
+    loop = asyncio.get_running_loop()
+    started = time.time()
+    try:
+        # the thread is not interrupted on timeout, its result is ignored
+        data = await asyncio.wait_for(
+            loop.run_in_executor(executor, query_cluster, cluster), query_timeout
+        )
+    except asyncio.TimeoutError:
+        error = TimeoutError(
+            "Query did not finish within {} seconds".format(round(query_timeout))
+        )
+        results.put_nowait((cluster, started, None, error))
+    except Exception as e:
+        results.put_nowait((cluster, started, None, e))
+    else:
+        results.put_nowait((cluster, started, data, None))
+    finally:
+        QUERY_DURATION.labels(cluster.id).observe(time.time() - started)
+
+
+async def update_clusters(
+    cluster_discoverer,
+    query_cluster: Callable[[Cluster], dict],
+    store,
+    query_interval: float = 5,
+    debug: bool = False,
+    query_concurrency: int = 10,
+    query_timeout: float = 60,
+    publish_interval: float = 0,
+    replica_id: str = None,
+    max_query_interval: float = None,
+    idle_query_interval: float = None,
+):
+    """Same as update.update_clusters, scheduled in the event loop."""
+    loop = asyncio.get_running_loop()
+    updater = ClusterUpdater(
+        store,
+        query_interval,
+        debug,
+        query_concurrency,
+        publish_interval,
+        replica_id,
+        max_query_interval,
+        idle_query_interval,
+    )
+    query_executor = concurrent.futures.ThreadPoolExecutor(
+        query_concurrency, thread_name_prefix="query"
+    )
+    # the updater (and its store calls) only runs in this thread
+    store_executor = concurrent.futures.ThreadPoolExecutor(
+        1, thread_name_prefix="update"
+    )
+
+    def call(func, *args):
+        return loop.run_in_executor(store_executor, func, *args)
+
+    results: asyncio.Queue = asyncio.Queue()
+    while True:
+        # sleep 1-2 seconds (while waiting for query results)
+        wait_seconds = min(random_jitter(1), query_interval)
+        try:
+            clusters = await call(lambda: list(cluster_discoverer.get_clusters()))
+            for cluster in await call(updater.start_queries, clusters):
+                asyncio.ensure_future(
+                    query_cluster_with_timeout(
+                        query_cluster, cluster, query_timeout, query_executor, results
+                    )
+                )
+
+            deadline = time.time() + wait_seconds
+            while True:
+                try:
+                    result = await asyncio.wait_for(
+                        results.get(), timeout=max(deadline - time.time(), 0)
+                    )
+                except asyncio.TimeoutError:
+                    break
+                await call(updater.apply_result, *result)
+            await call(updater.flush)
+        except Exception as e:
+            logger.exception(f"Failed to update: {e}")
+            await asyncio.sleep(wait_seconds)
+
+
+async def save_snapshots(store, interval: float):
+    """Save the store's snapshot every interval seconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(None, store.save_snapshot)
+        except Exception as e:
+            logger.exception(f"Failed to save snapshot: {e}")
+
+
+async def snapshot(
+    store, broadcaster: Broadcaster, cluster_ids: Set[str]
+) -> AsyncGenerator[bytes, None]:
+    """Status and data events of all (given) clusters, read in the default executor."""
+    loop = asyncio.get_running_loop()
+    # events received so far are part of the snapshot
+    generated = snapshot_frames(store, cluster_ids, broadcaster.last_event_id)
+    # the encoded cluster data is cached by the store, i.e. this only collects references
+    frames = await loop.run_in_executor(None, list, generated)
+    for frame in frames:
+        yield frame
+
+
+async def events(
+    request: web.Request,
+    cluster_ids: Set[str],
+    update_interval: float,
+    last_event_id: str = None,
+) -> AsyncGenerator[bytes, None]:
+    app = request.app
+    store = app["store"]
+    broadcaster: AsyncBroadcaster = app["broadcaster"]
+    remote_addr = request.headers.get("X-Forwarded-For") or request.remote
+    subscribe = functools.partial(
+        broadcaster.subscribe,
+        cluster_ids,
+        functools.partial(snapshot, store, broadcaster, cluster_ids),
+        remote_addr,
+        update_interval,
+    )
+    subscription = None
+    replayed = None
+    if last_event_id and not update_interval:
+        # subscribe first to not miss events while reading the event log
+        subscription = subscribe()
+        replayed = await asyncio.get_running_loop().run_in_executor(
+            None, broadcaster.replay, subscription, last_event_id
+        )
+        if replayed is None:
+            broadcaster.unsubscribe(subscription)
+            subscription = None
+    try:
+        if replayed is not None:
+            for frame in replayed:
+                yield frame
+        else:
+            async for frame in snapshot(store, broadcaster, cluster_ids):
+                yield frame
+        yield b"event: bootstrapend\ndata: \n\n"
+
+        if subscription is None:
+            subscription = subscribe()
+        async for frame in subscription:
+            yield frame
+    finally:
+        if subscription is not None:
+            broadcaster.unsubscribe(subscription)
+
+
+async def health(request: web.Request):
+    if request.app["shutdown"]:
+        raise web.HTTPServiceUnavailable()
+    return web.Response(text="OK")
+
+
+async def index(request: web.Request):
+    app = request.app
+    static_build_path = Path(__file__).parent / "static" / "build"
+    candidates = sorted(static_build_path.glob("app*.js"))
+    if not candidates:
+        logger.error(
+            "Could not find JavaScript application bundle app*.js in {}".format(
+                static_build_path
+            )
+        )
+        raise web.HTTPServiceUnavailable(
+            text="JavaScript application bundle not found (missing build)"
+        )
+    app_js = candidates[0].name
+    if app["debug"]:
+        # cache busting for local development
+        app_js += "?_={}".format(time.time())
+    html = (
+        app["templates"]
+        .get_template("index.html")
+        .render(
+            app_js=app_js,
+            version=kube_ops_view.__version__,
+            route_prefix=app["app_config"]["route_prefix"],
+            app_config_json=json.dumps(app["app_config"]),
+        )
+    )
+    return web.Response(text=html, content_type="text/html")
+
+
+async def get_events(request: web.Request):
+    """SSE (Server Side Events), for an EventSource."""
+    cluster_ids = set(request.query.get("cluster_ids", "").split())
+    max_update_rate = float(request.query.get("max_update_rate") or 0)
+    update_interval = 1 / max_update_rate if max_update_rate > 0 else 0
+    last_event_id = request.headers.get("Last-Event-ID") or request.query.get(
+        "last_event_id"
+    )
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+    encoding, compression_headers = negotiate_encoding(
+        request.query.get("compress"), request.headers.get("Accept-Encoding")
+    )
+    compressor = EventCompressor(encoding) if encoding else None
+    response.headers.update(compression_headers)
+    await response.prepare(request)
+    chunks = events(request, cluster_ids, update_interval, last_event_id)
+    try:
+        async for chunk in chunks:
+            data = compressor.compress(chunk) if compressor else chunk
+            if data:
+                await response.write(data)
+    except ConnectionResetError:
+        logger.debug("Client {} disconnected".format(request.remote))
+    finally:
+        # unsubscribe right away when the client disconnected
+        await chunks.aclose()
+    return response
+
+
+async def get_metrics(request: web.Request):
+    """Metrics in the Prometheus text format."""
+    request.app["broadcaster"].update_metrics()
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+
+async def get_event_stats(request: web.Request):
+    """Counters of SSE clients which did not keep up with events."""
+    return web.json_response(request.app["broadcaster"].stats())
+
+
+async def get_store_stats(request: web.Request):
+    """Counters of the store backend, e.g. Redis round trips."""
+    return web.json_response(request.app["store"].stats())
+
+
+async def screen_tokens(request: web.Request):
+    new_token = None
+    if request.method == "POST":
+        new_token = await asyncio.get_running_loop().run_in_executor(
+            None, request.app["store"].create_screen_token
+        )
+    html = (
+        request.app["templates"]
+        .get_template("screen-tokens.html")
+        .render(new_token=new_token)
+    )
+    return web.Response(text=html, content_type="text/html")
+
+
+async def redeem_screen_token(request: web.Request):
+    token = request.match_info["token"]
+    remote_addr = request.headers.get("X-Forwarded-For") or request.remote
+    logger.info(
+        'Trying to redeem screen token "{}" for IP {}..'.format(token, remote_addr)
+    )
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None, request.app["store"].redeem_screen_token, token, remote_addr
+        )
+    except Exception:
+        raise web.HTTPUnauthorized()
+    # without OAuth there is no session to remember the token in
+    raise web.HTTPFound(request.app["app_config"]["route_prefix"])
+
+
+async def logout(request: web.Request):
+    raise web.HTTPFound(request.app["app_config"]["route_prefix"])
+
+
+def create_app(store, broadcaster: AsyncBroadcaster, app_config: dict, debug=False):
+    app = web.Application()
+    app["store"] = store
+    app["broadcaster"] = broadcaster
+    app["app_config"] = app_config
+    app["debug"] = debug
+    app["shutdown"] = False
+    app["templates"] = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(str(Path(__file__).parent / "templates")),
+        autoescape=True,
+    )
+    app.router.add_get("/health", health)
+    app.router.add_get("/", index)
+    app.router.add_get("/events", get_events)
+    app.router.add_get("/events/stats", get_event_stats)
+    app.router.add_get("/metrics", get_metrics)
+    app.router.add_get("/store/stats", get_store_stats)
+    app.router.add_route("*", "/screen-tokens", screen_tokens)
+    app.router.add_get("/screen/{token}", redeem_screen_token)
+    app.router.add_get("/logout", logout)
+    app.router.add_static("/static", Path(__file__).parent / "static")
+    return app
+
+
+async def serve(app: web.Application, port: int, background_tasks: list):
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+
+    async def shutdown():
+        logger.info("Received TERM signal, shutting down..")
+        app["shutdown"] = True
+        try:
+            await loop.run_in_executor(None, app["store"].save_snapshot)
+        except Exception as e:
+            logger.exception(f"Failed to save snapshot: {e}")
+        # give Kubernetes time to update endpoints (see readinessProbe)
+        await asyncio.sleep(SHUTDOWN_WAIT_SECONDS)
+        stopped.set()
+
+    loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(shutdown()))
+    tasks = [asyncio.ensure_future(task) for task in background_tasks]
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logger.info("Listening on :{}..".format(port))
+    try:
+        await stopped.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await runner.cleanup()
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@common_options
+def main(
+    port: int,
+    route_prefix: str,
+    debug: bool,
+    mock: bool,
+    mock_clusters: int,
+    mock_nodes: int,
+    mock_pods_per_node: int,
+    mock_containers_per_pod: int,
+    mock_churn: float,
+    redis_url: str,
+    redis_format: str,
+    redis_compression: bool,
+    redis_max_connections: int,
+    snapshot_path: str,
+    snapshot_interval: float,
+    clusters: list,
+    cluster_registry_url: str,
+    kubeconfig_path: str,
+    kubeconfig_contexts: list,
+    query_interval: float,
+    max_query_interval: float,
+    idle_query_interval: float,
+    query_concurrency: int,
+    query_timeout: float,
+    publish_interval: float,
+    watch: bool,
+    query_profiles: str,
+    max_queued_events: int,
+    slow_client_policy: str,
+    node_link_url_template: str,
+    pod_link_url_template: str,
+):
+    if watch:
+        # the watches are long running greenlets
+        raise click.BadParameter(
+            "only supported by the gevent runtime", param_hint="'--watch'"
+        )
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
+
+    store = create_store(
+        redis_url,
+        redis_format,
+        redis_compression,
+        redis_max_connections,
+        snapshot_path,
+    )
+    broadcaster = AsyncBroadcaster(
+        store,
+        max_queued_events=max_queued_events,
+        slow_client_policy=slow_client_policy,
+    )
+    app_config = {
+        "node_link_url_template": node_link_url_template,
+        "pod_link_url_template": pod_link_url_template,
+        "route_prefix": route_prefix,
+    }
+
+    cluster_query = create_cluster_query(
+        mock,
+        mock_nodes,
+        mock_pods_per_node,
+        mock_containers_per_pod,
+        mock_churn,
+        query_profiles,
+        watch,
+    )
+    discoverer = create_discoverer(
+        mock,
+        mock_clusters,
+        clusters,
+        cluster_registry_url,
+        kubeconfig_path,
+        kubeconfig_contexts,
+    )
+
+    background_tasks = [
+        update_clusters(
+            cluster_discoverer=discoverer,
+            query_cluster=cluster_query,
+            store=store,
+            query_interval=query_interval,
+            max_query_interval=max_query_interval,
+            idle_query_interval=idle_query_interval,
+            debug=debug,
+            query_concurrency=query_concurrency,
+            query_timeout=query_timeout,
+            publish_interval=publish_interval,
+        ),
+        broadcaster.run(),
+    ]
+    if isinstance(store, MemoryStore) and snapshot_path:
+        background_tasks.append(save_snapshots(store, snapshot_interval))
+    app = create_app(store, broadcaster, app_config, debug)
+    asyncio.run(serve(app, port, background_tasks))
+
+
+if __name__ == "__main__":
+    main()
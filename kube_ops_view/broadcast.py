@@ -0,0 +1,486 @@
+"""Fan-out of store events to all SSE clients of this process.
+
+A single greenlet listens to the store, encodes each event once and pushes the
+encoded frame to the bounded queue of every subscribed client. Subscriptions are
+indexed by cluster ID, i.e. an event is only offered to interested clients, and
+grouped by their requested update interval (see Channel).
+
+Events sent immediately carry their ID from the store's event log, a reconnecting
+client passes the last ID it received and gets the missed events replayed (see
+Broadcaster.replay) instead of a full snapshot.
+"""
+
+import itertools
+import logging
+import math
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+
+import gevent
+import gevent.queue
+
+from .delta import DeltaCoalescer
+from .metrics import BROADCAST_DURATION
+from .metrics import EVENT_SIZE
+from .metrics import SSE_CLIENTS
+from .metrics import SSE_DROPPED_EVENTS
+from .metrics import SSE_MAX_QUEUED_EVENTS
+from .metrics import SSE_QUEUED_EVENTS
+from .metrics import SSE_RESYNCS
+from .stores import dumps
+from .stores import event_id_key
+
+logger = logging.getLogger(__name__)
+
+# maximum number of encoded events queued per client
+MAX_QUEUED_EVENTS = 100
+# policies for clients which do not keep up with events
+RESYNC = "resync"
+DISCONNECT = "disconnect"
+SLOW_CLIENT_POLICIES = (RESYNC, DISCONNECT)
+# longest update interval a client can request (the frontend reconnects after 20s without events)
+MAX_UPDATE_INTERVAL = 15
+# how often merged deltas are checked for sending
+FLUSH_INTERVAL_SECONDS = 1
+# wait time before listening again after the store subscription failed
+RECONNECT_WAIT_SECONDS = 1
+# how often the clusters with SSE clients are recorded in the store (see update_clusters)
+VIEWERS_INTERVAL_SECONDS = 5
+# clusters not recorded for this long have no SSE clients
+VIEWERS_TTL_SECONDS = 20
+# viewed cluster ID of clients receiving events of all clusters
+ALL_CLUSTERS = "*"
+
+
+# queue marker to send a fresh snapshot instead of the dropped events
+_RESYNC = object()
+# IDs of subscriptions (per process), e.g. to tell clients with the same address apart
+_subscription_ids = itertools.count()
+
+
+def encode_event(event_type: str, event_data, event_id: str = None) -> bytes:
+    """Encode an event as SSE frame."""
+    frame = "event: {}\ndata: {}\n\n".format(event_type, dumps(event_data))
+    if event_id:
+        frame = "id: {}\n".format(event_id) + frame
+    return frame.encode("utf-8")
+
+
+def snapshot_frames(store, cluster_ids: Set[str], event_id: str = None) -> Iterator:
+    """Generate status and data events of all (given) clusters, e.g. for new clients.
+
+    event_id is the ID of the last event included in the snapshot (if known), i.e. a
+    reconnecting client resumes after it instead of after an older event.
+    """
+    id_line = "id: {}\n".format(event_id).encode("utf-8") if event_id else b""
+    for cluster_id in store.get_cluster_ids():
+        if not cluster_ids or cluster_id in cluster_ids:
+            status = store.get_cluster_status(cluster_id)
+            if status:
+                # send the cluster status including last_query_time BEFORE the cluster data
+                # so the UI knows how to render correctly from the start
+                yield encode_event(
+                    "clusterstatus",
+                    {"cluster_id": cluster_id, "status": status},
+                    event_id,
+                )
+            # the store keeps the cluster data encoded, i.e. it is not serialised per client
+            cluster = store.get_cluster_data_encoded(cluster_id)
+            if cluster:
+                yield id_line + b"event: clusterupdate\ndata: "
+                yield cluster
+                yield b"\n\n"
+
+
+def event_cluster_id(event_data: dict) -> Optional[str]:
+    # clusterupdate events contain the cluster object itself
+    return event_data.get("cluster_id", event_data.get("id"))
+
+
+class Subscription:
+
+    """Encoded events for a single client, iterate to receive them.
+
+    If the client falls behind (its queue is full), all queued events are dropped and
+    the client gets a fresh snapshot via resync() instead ("resync" policy) or is
+    disconnected ("disconnect" policy, EventSource reconnects and bootstraps again).
+    """
+
+    # queue implementation, e.g. replaced for asyncio (see aio)
+    queue_class = gevent.queue.Queue
+    Full = gevent.queue.Full
+    Empty = gevent.queue.Empty
+
+    def __init__(
+        self,
+        cluster_ids: Set[str],
+        max_queued_events: int,
+        slow_client_policy: str = RESYNC,
+        resync: Callable[[], Any] = None,
+        remote_addr: str = None,
+    ):
+        self.id = next(_subscription_ids)
+        self.cluster_ids = cluster_ids
+        self.queue = self.queue_class(max_queued_events)
+        self.slow_client_policy = slow_client_policy if resync else DISCONNECT
+        self.resync = resync
+        self.remote_addr = remote_addr
+        # seconds between merged deltas of a cluster, 0 to receive all events immediately
+        self.update_interval = 0
+        self.closed = False
+        # closed because the client did not keep up
+        self.disconnected = False
+        # number of events dropped because the client did not keep up
+        self.dropped_events = 0
+        # number of times the dropped events were replaced by a fresh snapshot
+        self.resyncs = 0
+        # sort key of the last replayed event ID, queued events up to it are skipped
+        self.replayed_until: Optional[tuple] = None
+
+    def wants(self, cluster_id: Optional[str]):
+        return not self.cluster_ids or cluster_id in self.cluster_ids
+
+    def offer(self, frame: bytes, event_id: str = None):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait((frame, event_id))
+        except self.Full:
+            self._handle_overflow()
+
+    def _discard_queued(self) -> int:
+        """Discard all queued items, returns the number of discarded events."""
+        discarded = 0
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except self.Empty:
+                return discarded
+            if item is not _RESYNC and item is not None:
+                discarded += 1
+
+    def _handle_overflow(self):
+        dropped = 1 + self._discard_queued()
+        self.dropped_events += dropped
+        SSE_DROPPED_EVENTS.inc(dropped)
+        if self.slow_client_policy == RESYNC:
+            logger.info(
+                "Client {} does not keep up with events, dropped {} events and resending snapshot..".format(
+                    self.remote_addr, dropped
+                )
+            )
+            self.resyncs += 1
+            SSE_RESYNCS.inc()
+            self.queue.put_nowait(_RESYNC)
+        else:
+            logger.warning(
+                "Client {} does not keep up with events, disconnecting..".format(
+                    self.remote_addr
+                )
+            )
+            self.disconnected = True
+            self.close()
+
+    def close(self):
+        self.closed = True
+        try:
+            # wake up the waiting client
+            self.queue.put_nowait(None)
+        except self.Full:
+            # not waiting, will see the closed flag
+            pass
+
+    def stats(self):
+        return {
+            "id": self.id,
+            "remote_addr": self.remote_addr,
+            "cluster_ids": sorted(self.cluster_ids),
+            "queued_events": self.queue.qsize(),
+            "dropped_events": self.dropped_events,
+            "resyncs": self.resyncs,
+        }
+
+    def __iter__(self):
+        while not self.closed:
+            item = self.queue.get()
+            if item is None:
+                break
+            elif item is _RESYNC:
+                # events queued so far are part of the snapshot (read afterwards)
+                self._discard_queued()
+                yield from self.resync()
+            elif not self._replayed(item):
+                yield item[0]
+
+    def _replayed(self, item: tuple):
+        """Return whether the queued (frame, event ID) was already sent when replaying."""
+        event_id = item[1]
+        return bool(
+            event_id
+            and self.replayed_until
+            and event_id_key(event_id) <= self.replayed_until
+        )
+
+
+class Channel:
+
+    """Subscriptions which receive deltas at the same update interval, indexed by cluster ID.
+
+    With an update interval, deltas per cluster are merged and sent at most once per
+    interval, i.e. each merged delta is still encoded only once for all subscriptions.
+    """
+
+    def __init__(self, update_interval: float = 0):
+        self.coalescer = DeltaCoalescer(update_interval) if update_interval else None
+        # subscriptions without cluster filter
+        self.all: Set[Subscription] = set()
+        self.by_cluster: Dict[str, Set[Subscription]] = {}
+
+    def __bool__(self):
+        return bool(self.all or self.by_cluster)
+
+    def add(self, subscription: Subscription):
+        if subscription.cluster_ids:
+            for cluster_id in subscription.cluster_ids:
+                self.by_cluster.setdefault(cluster_id, set()).add(subscription)
+        else:
+            self.all.add(subscription)
+
+    def remove(self, subscription: Subscription):
+        self.all.discard(subscription)
+        for cluster_id in subscription.cluster_ids:
+            subscriptions = self.by_cluster.get(cluster_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.by_cluster[cluster_id]
+
+    def subscriptions(self):
+        subscriptions = set(self.all)
+        for cluster_subscriptions in self.by_cluster.values():
+            subscriptions.update(cluster_subscriptions)
+        return subscriptions
+
+    def _offer(
+        self,
+        cluster_id: Optional[str],
+        event_type: str,
+        event_data: dict,
+        event_id: str = None,
+    ):
+        subscriptions = self.by_cluster.get(cluster_id) if cluster_id else None
+        if not self.all and not subscriptions:
+            return
+        frame = encode_event(event_type, event_data, event_id)
+        EVENT_SIZE.labels(event_type).observe(len(frame))
+        # copy as clients are removed while offering
+        for subscription in list(self.all):
+            subscription.offer(frame, event_id)
+        for subscription in list(subscriptions or ()):
+            subscription.offer(frame, event_id)
+
+    def publish(
+        self, event_type: str, event_data: dict, now: float, event_id: str = None
+    ):
+        cluster_id = event_cluster_id(event_data)
+        if self.coalescer and cluster_id is not None:
+            if event_type == "clusterdelta":
+                delta = self.coalescer.add(cluster_id, event_data["delta"], now)
+                if delta is None:
+                    return
+                event_data = dict(event_data, delta=delta)
+            elif event_type == "clusterupdate":
+                # pending deltas are obsolete
+                self.coalescer.discard(cluster_id, now)
+            # merged events have no single ID, i.e. these clients cannot resume
+            event_id = None
+        self._offer(cluster_id, event_type, event_data, event_id)
+
+    def flush(self, now: float):
+        if self.coalescer:
+            for cluster_id, delta in self.coalescer.flush(now):
+                self._offer(
+                    cluster_id,
+                    "clusterdelta",
+                    {"cluster_id": cluster_id, "delta": delta},
+                )
+
+
+class Broadcaster:
+
+    """Listens to the store once per process and forwards events to all subscriptions."""
+
+    subscription_class = Subscription
+
+    def __init__(
+        self,
+        store,
+        max_queued_events: int = MAX_QUEUED_EVENTS,
+        slow_client_policy: str = RESYNC,
+    ):
+        self.store = store
+        self.max_queued_events = max_queued_events
+        self.slow_client_policy = slow_client_policy
+        # update interval => channel, 0 for clients receiving every event immediately
+        self._channels: Dict[int, Channel] = {0: Channel()}
+        # counters of already unsubscribed clients
+        self._dropped_events = 0
+        self._resyncs = 0
+        self._disconnects = 0
+        # ID of the last event received from the store (to continue after reconnecting)
+        self.last_event_id: Optional[str] = None
+
+    def subscribe(
+        self,
+        cluster_ids: Iterable[str] = (),
+        resync: Callable[[], Any] = None,
+        remote_addr: str = None,
+        update_interval: float = 0,
+    ):
+        """Subscribe to events of the given clusters (all clusters if empty).
+
+        resync is called to get a fresh snapshot (encoded frames, asynchronously iterated
+        by AsyncSubscription) if the client fell behind.
+        Deltas are merged and sent at most every update_interval seconds per cluster
+        (rounded up to full seconds).
+        """
+        subscription = self.subscription_class(
+            set(cluster_ids),
+            self.max_queued_events,
+            self.slow_client_policy,
+            resync,
+            remote_addr,
+        )
+        if update_interval > 0:
+            subscription.update_interval = min(
+                math.ceil(update_interval), MAX_UPDATE_INTERVAL
+            )
+        channel = self._channels.get(subscription.update_interval)
+        if channel is None:
+            channel = self._channels[subscription.update_interval] = Channel(
+                subscription.update_interval
+            )
+        channel.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        if subscription.disconnected:
+            self._disconnects += 1
+        subscription.close()
+        self._dropped_events += subscription.dropped_events
+        self._resyncs += subscription.resyncs
+        channel = self._channels.get(subscription.update_interval)
+        if channel is not None:
+            channel.remove(subscription)
+            if not channel and subscription.update_interval:
+                del self._channels[subscription.update_interval]
+
+    def replay(
+        self, subscription: Subscription, after_id: str
+    ) -> Optional[List[bytes]]:
+        """Return the encoded events after the given ID for the subscription.
+
+        Returns None if the events cannot be replayed (unknown or too old ID), the
+        client needs a full snapshot then. Events also queued for the subscription are
+        only sent once.
+        """
+        try:
+            events = self.store.read_events(after_id)
+        except ValueError:
+            # invalid ID
+            return None
+        if events is None:
+            return None
+        frames = [
+            encode_event(event_type, event_data, event_id)
+            for event_id, event_type, event_data in events
+            if subscription.wants(event_cluster_id(event_data))
+        ]
+        subscription.replayed_until = event_id_key(
+            events[-1][0] if events else after_id
+        )
+        return frames
+
+    def publish(self, event_type: str, event_data: dict, event_id: str = None):
+        now = time.time()
+        self.last_event_id = event_id or self.last_event_id
+        with BROADCAST_DURATION.time():
+            for channel in list(self._channels.values()):
+                channel.publish(event_type, event_data, now, event_id)
+
+    def flush(self, now: float):
+        """Send merged deltas which are due."""
+        for channel in list(self._channels.values()):
+            channel.flush(now)
+
+    def stats(self):
+        """Return counters of slow clients, in total and per connected client."""
+        clients = [
+            subscription.stats()
+            for channel in self._channels.values()
+            for subscription in channel.subscriptions()
+        ]
+        return {
+            "dropped_events": self._dropped_events
+            + sum(client["dropped_events"] for client in clients),
+            "resyncs": self._resyncs + sum(client["resyncs"] for client in clients),
+            "disconnects": self._disconnects,
+            "clients": clients,
+        }
+
+    def update_metrics(self):
+        """Set the SSE client gauges from the current stats (e.g. when scraped)."""
+        queued = [client["queued_events"] for client in self.stats()["clients"]]
+        SSE_CLIENTS.set(len(queued))
+        SSE_QUEUED_EVENTS.set(sum(queued))
+        SSE_MAX_QUEUED_EVENTS.set(max(queued, default=0))
+
+    def viewed_cluster_ids(self) -> Set[str]:
+        """Return the IDs of clusters with subscriptions (ALL_CLUSTERS for unfiltered ones)."""
+        cluster_ids: Set[str] = set()
+        for channel in self._channels.values():
+            if channel.all:
+                cluster_ids.add(ALL_CLUSTERS)
+            cluster_ids.update(channel.by_cluster)
+        return cluster_ids
+
+    def touch_viewed_clusters(self, cluster_ids: Set[str]):
+        try:
+            self.store.touch_viewed_clusters(cluster_ids)
+        except Exception as e:
+            logger.warning(f"Failed to record viewed clusters: {e}")
+
+    def _flush_periodically(self):
+        touched = time.time()
+        while True:
+            gevent.sleep(FLUSH_INTERVAL_SECONDS)
+            now = time.time()
+            self.flush(now)
+            if now - touched >= VIEWERS_INTERVAL_SECONDS:
+                touched = now
+                cluster_ids = self.viewed_cluster_ids()
+                if cluster_ids:
+                    self.touch_viewed_clusters(cluster_ids)
+
+    def run(self):
+        flusher = gevent.spawn(self._flush_periodically)
+        try:
+            while True:
+                try:
+                    # continue after the last received event (if still logged)
+                    for event_id, event_type, event_data in self.store.listen(
+                        self.last_event_id
+                    ):
+                        self.publish(event_type, event_data, event_id)
+                except Exception as e:
+                    logger.exception(f"Failed to listen for events: {e}")
+                gevent.sleep(RECONNECT_WAIT_SECONDS)
+        finally:
+            flusher.kill()
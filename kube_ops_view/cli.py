@@ -0,0 +1,345 @@
+"""Command line options and setup shared by the gevent (main) and asyncio (aio) runtimes."""
+import functools
+from pathlib import Path
+from typing import Callable
+from typing import Union
+
+import click
+
+import kube_ops_view
+from .broadcast import MAX_QUEUED_EVENTS
+from .broadcast import RESYNC
+from .broadcast import SLOW_CLIENT_POLICIES
+from .cluster_discovery import Cluster
+from .cluster_discovery import ClusterRegistryDiscoverer
+from .cluster_discovery import DEFAULT_CLUSTERS
+from .cluster_discovery import KubeconfigDiscoverer
+from .cluster_discovery import MockDiscoverer
+from .cluster_discovery import StaticClusterDiscoverer
+from .kubernetes import query_kubernetes_cluster
+from .kubernetes import QueryProfiles
+from .mock import query_mock_cluster
+from .stores import Codec
+from .stores import MemoryStore
+from .stores import REDIS_MAX_CONNECTIONS
+from .stores import RedisStore
+from .update import MAX_DATA_AGE_SECONDS
+from .watch import WatchingClusterQuery
+
+
+def print_version(ctx, param, value):
+    if not value or ctx.resilient_parsing:
+        return
+    click.echo("Kubernetes Operational View {}".format(kube_ops_view.__version__))
+    ctx.exit()
+
+
+def validate_max_query_interval(ctx, param, value):
+    if value and value >= MAX_DATA_AGE_SECONDS:
+        # the stored last query time must not look outdated to the frontend
+        raise click.BadParameter(
+            "must be below {} seconds".format(MAX_DATA_AGE_SECONDS)
+        )
+    return value
+
+
+class CommaSeparatedValues(click.ParamType):
+    name = "comma_separated_values"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, str):
+            values = filter(None, value.split(","))
+        else:
+            values = value
+        return values
+
+
+# in the order of --help
+OPTIONS = [
+    click.option(
+        "-V",
+        "--version",
+        is_flag=True,
+        callback=print_version,
+        expose_value=False,
+        is_eager=True,
+        help="Print the current version number and exit.",
+    ),
+    click.option(
+        "-p",
+        "--port",
+        type=int,
+        help="HTTP port to listen on (default: 8080)",
+        envvar="SERVER_PORT",
+        default=8080,
+    ),
+    click.option(
+        "--route-prefix",
+        help="""The URL prefix under which kube-ops-view is externally reachable
+        (for example, if kube-ops-view is served via a reverse proxy). Used for
+        generating relative and absolute links back to kube-ops-view itself. If the
+        URL has a path portion, it will be used to prefix all HTTP endpoints served
+        by kube-ops-view. If omitted, relevant URL components will be derived
+        automatically.""",
+        envvar="ROUTE_PREFIX",
+        default="/",
+    ),
+    click.option(
+        "-d", "--debug", is_flag=True, help="Run in debugging mode", envvar="DEBUG"
+    ),
+    click.option(
+        "-m", "--mock", is_flag=True, help="Mock Kubernetes clusters", envvar="MOCK"
+    ),
+    click.option(
+        "--mock-clusters",
+        type=int,
+        help="Number of mock clusters (default: 3)",
+        envvar="MOCK_CLUSTERS",
+        default=3,
+    ),
+    click.option(
+        "--mock-nodes",
+        type=int,
+        help="Number of nodes per mock cluster (default: 10)",
+        envvar="MOCK_NODES",
+        default=10,
+    ),
+    click.option(
+        "--mock-pods-per-node",
+        type=int,
+        help="Number of pods per mock node (default: up to 31)",
+        envvar="MOCK_PODS_PER_NODE",
+    ),
+    click.option(
+        "--mock-containers-per-pod",
+        type=int,
+        help="Number of containers per mock pod (default: one or two)",
+        envvar="MOCK_CONTAINERS_PER_POD",
+    ),
+    click.option(
+        "--mock-churn",
+        type=float,
+        help="Ratio of mock pods replaced per second, other pods do not change (default: some pods come and go every few seconds)",
+        envvar="MOCK_CHURN",
+    ),
+    click.option(
+        "--redis-url",
+        help="Redis URL to use for pub/sub and job locking",
+        envvar="REDIS_URL",
+    ),
+    click.option(
+        "--redis-format",
+        type=click.Choice(Codec.FORMATS),
+        help="Format of cluster data stored in Redis, msgpack requires the msgpack package (default: json)",
+        envvar="REDIS_FORMAT",
+        default="json",
+    ),
+    click.option(
+        "--redis-compression",
+        is_flag=True,
+        help="Compress cluster data stored in Redis (zlib)",
+        envvar="REDIS_COMPRESSION",
+    ),
+    click.option(
+        "--redis-max-connections",
+        type=int,
+        help="Maximum number of Redis connections shared by all greenlets/threads (default: {})".format(
+            REDIS_MAX_CONNECTIONS
+        ),
+        envvar="REDIS_MAX_CONNECTIONS",
+        default=REDIS_MAX_CONNECTIONS,
+    ),
+    click.option(
+        "--snapshot-path",
+        type=click.Path(dir_okay=False),
+        help="File to keep cluster data across restarts, loaded on startup (only without Redis)",
+        envvar="SNAPSHOT_PATH",
+    ),
+    click.option(
+        "--snapshot-interval",
+        type=float,
+        help="Interval in seconds for saving the snapshot file (default: 60)",
+        envvar="SNAPSHOT_INTERVAL",
+        default=60,
+    ),
+    click.option(
+        "--clusters",
+        type=CommaSeparatedValues(),
+        help="Comma separated list of Kubernetes API server URLs (default: {})".format(
+            DEFAULT_CLUSTERS
+        ),
+        envvar="CLUSTERS",
+    ),
+    click.option(
+        "--cluster-registry-url",
+        help="URL to cluster registry",
+        envvar="CLUSTER_REGISTRY_URL",
+    ),
+    click.option(
+        "--kubeconfig-path",
+        type=click.Path(exists=True),
+        help="Path to kubeconfig file",
+        envvar="KUBECONFIG_PATH",
+    ),
+    click.option(
+        "--kubeconfig-contexts",
+        type=CommaSeparatedValues(),
+        help="List of kubeconfig contexts to use (default: use all defined contexts)",
+        envvar="KUBECONFIG_CONTEXTS",
+    ),
+    click.option(
+        "--query-interval",
+        type=float,
+        help="Interval in seconds for querying clusters (default: 5)",
+        envvar="QUERY_INTERVAL",
+        default=5,
+    ),
+    click.option(
+        "--max-query-interval",
+        type=float,
+        callback=validate_max_query_interval,
+        help="Longest interval in seconds for querying clusters which do not change or are expensive to query, below {} (default: query interval, i.e. fixed)".format(
+            MAX_DATA_AGE_SECONDS
+        ),
+        envvar="MAX_QUERY_INTERVAL",
+    ),
+    click.option(
+        "--idle-query-interval",
+        type=float,
+        help="Interval in seconds for querying clusters without SSE clients (default: query interval)",
+        envvar="IDLE_QUERY_INTERVAL",
+    ),
+    click.option(
+        "--query-concurrency",
+        type=int,
+        help="Maximum number of clusters to query concurrently (default: 10)",
+        envvar="QUERY_CONCURRENCY",
+        default=10,
+    ),
+    click.option(
+        "--query-timeout",
+        type=float,
+        help="Timeout in seconds for querying a single cluster (default: 60)",
+        envvar="QUERY_TIMEOUT",
+        default=60,
+    ),
+    click.option(
+        "--publish-interval",
+        type=float,
+        help="Minimum interval in seconds between published deltas of a cluster, deltas in between are merged (default: 0)",
+        envvar="PUBLISH_INTERVAL",
+        default=0,
+    ),
+    click.option(
+        "--watch",
+        is_flag=True,
+        help="Keep nodes and pods up-to-date via Kubernetes WATCH instead of listing all objects on every query (gevent runtime only)",
+        envvar="WATCH",
+    ),
+    click.option(
+        "--query-profiles",
+        type=click.Path(exists=True),
+        help="Path to YAML file with field/label selectors and namespaces to query (per cluster ID or default)",
+        envvar="QUERY_PROFILES",
+    ),
+    click.option(
+        "--max-queued-events",
+        type=int,
+        help="Maximum number of events queued per SSE client (default: {})".format(
+            MAX_QUEUED_EVENTS
+        ),
+        envvar="MAX_QUEUED_EVENTS",
+        default=MAX_QUEUED_EVENTS,
+    ),
+    click.option(
+        "--slow-client-policy",
+        type=click.Choice(SLOW_CLIENT_POLICIES),
+        help="What to do with SSE clients which do not keep up with events: drop queued events and resend a snapshot or disconnect (default: resync)",
+        envvar="SLOW_CLIENT_POLICY",
+        default=RESYNC,
+    ),
+    click.option(
+        "--node-link-url-template",
+        help="Template for target URL when clicking on a Node",
+        envvar="NODE_LINK_URL_TEMPLATE",
+    ),
+    click.option(
+        "--pod-link-url-template",
+        help="Template for target URL when clicking on a Pod",
+        envvar="POD_LINK_URL_TEMPLATE",
+    ),
+]
+
+
+def common_options(func):
+    """Add the options of both runtimes to the command."""
+    for option in reversed(OPTIONS):
+        func = option(func)
+    return func
+
+
+def create_store(
+    redis_url: str,
+    redis_format: str,
+    redis_compression: bool,
+    redis_max_connections: int,
+    snapshot_path: str,
+):
+    if redis_url:
+        return RedisStore(
+            redis_url,
+            Codec(redis_format, redis_compression),
+            max_connections=redis_max_connections,
+        )
+    return MemoryStore(snapshot_path)
+
+
+def create_cluster_query(
+    mock: bool,
+    mock_nodes: int,
+    mock_pods_per_node: int,
+    mock_containers_per_pod: int,
+    mock_churn: float,
+    query_profiles: str,
+    watch: bool,
+) -> Callable[[Cluster], dict]:
+    if mock:
+        return functools.partial(
+            query_mock_cluster,
+            nodes=mock_nodes,
+            pods_per_node=mock_pods_per_node,
+            containers_per_pod=mock_containers_per_pod,
+            churn=mock_churn,
+        )
+    profiles = (
+        QueryProfiles.from_file(Path(query_profiles))
+        if query_profiles
+        else QueryProfiles()
+    )
+    if watch:
+        return WatchingClusterQuery(query_profiles=profiles)
+    return functools.partial(query_kubernetes_cluster, query_profiles=profiles)
+
+
+def create_discoverer(
+    mock: bool,
+    mock_clusters: int,
+    clusters: list,
+    cluster_registry_url: str,
+    kubeconfig_path: str,
+    kubeconfig_contexts: list,
+) -> Union[
+    MockDiscoverer,
+    ClusterRegistryDiscoverer,
+    KubeconfigDiscoverer,
+    StaticClusterDiscoverer,
+]:
+    if mock:
+        return MockDiscoverer(mock_clusters)
+    if cluster_registry_url:
+        return ClusterRegistryDiscoverer(cluster_registry_url)
+    if kubeconfig_path:
+        return KubeconfigDiscoverer(
+            Path(kubeconfig_path), set(kubeconfig_contexts or [])
+        )
+    return StaticClusterDiscoverer(list(clusters or []))
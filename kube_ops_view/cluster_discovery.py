@@ -164,8 +164,11 @@ class KubeconfigDiscoverer:
 
 
 class MockDiscoverer:
+    def __init__(self, clusters: int = 3):
+        self._clusters = clusters
+
     def get_clusters(self):
-        for i in range(3):
+        for i in range(self._clusters):
             yield Cluster(
                 f"mock-cluster-{i}",
                 f"mock-cluster-{i}",
@@ -0,0 +1,88 @@
+"""Optional compression of the SSE stream.
+
+The whole stream is one gzip (or deflate) stream, it is flushed after every event
+so that events still reach the client immediately. Consecutive events share the
+compression window, i.e. repetitive deltas compress well.
+
+Compression is opt-in per client (?compress=true) as every client needs its own
+compressor, i.e. it costs CPU per client and event.
+"""
+import zlib
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
+# zlib compression level, higher levels cost a lot more CPU for little gain on JSON
+COMPRESSION_LEVEL = 6
+
+ENCODINGS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+TRUTHY_VALUES = {"1", "true"}
+
+
+def select_encoding(accept_encoding: str) -> Optional[str]:
+    """Return the supported encoding with the highest quality in the Accept-Encoding header."""
+    qualities = {}
+    for item in accept_encoding.split(","):
+        name, _, parameters = item.partition(";")
+        parameter, _, value = parameters.partition("=")
+        try:
+            quality = float(value) if parameter.strip() == "q" else 1.0
+        except ValueError:
+            quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    def get_quality(encoding: str) -> float:
+        return qualities.get(encoding, qualities.get("*", 0.0))
+
+    # the first one (gzip) if both are accepted equally
+    encoding = max(ENCODINGS, key=get_quality)
+    return encoding if get_quality(encoding) > 0 else None
+
+
+def negotiate_encoding(
+    compress: Optional[str], accept_encoding: Optional[str]
+) -> Tuple[Optional[str], dict]:
+    """Return the encoding of the SSE stream (None if not compressed) and the response headers.
+
+    compress is the value of the query parameter of the client.
+    """
+    if compress not in TRUTHY_VALUES:
+        return None, {}
+    headers = {"Vary": "Accept-Encoding"}
+    encoding = select_encoding(accept_encoding or "")
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return encoding, headers
+
+
+class EventCompressor:
+
+    """Compressor of one SSE stream, flushed at the end of each event."""
+
+    def __init__(self, encoding: str, level: int = COMPRESSION_LEVEL):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+
+    def compress(self, chunk) -> bytes:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = self._compressor.compress(chunk)
+        if chunk.endswith(b"\n\n"):
+            data += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data
+
+
+def compress_events(
+    chunks: Iterable, encoding: str, level: int = COMPRESSION_LEVEL
+) -> Iterable[bytes]:
+    """Compress the SSE stream, flushing the compressor at the end of each event."""
+    compressor = EventCompressor(encoding, level)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+    finally:
+        # e.g. to unsubscribe the client
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
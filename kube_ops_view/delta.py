@@ -0,0 +1,129 @@
+"""Fast cluster diffs in the JSON-delta format applied by the frontend.
+
+json_delta.diff walks the whole nested structure in pure Python, even for the
+(vast majority of) unchanged nodes and pods. Here unchanged objects are skipped
+with an identity check (snapshots from the watch mode share unchanged objects)
+or with the C-level dict equality, only changed objects are diffed recursively.
+Model objects (nodes, pods, containers) are diffed in their wire format.
+"""
+from .model import Model
+
+
+def _diff(old, new, path: list, stanzas: list):
+    if old is new:
+        return
+    if isinstance(old, Model) or isinstance(new, Model):
+        if old == new:
+            return
+        if isinstance(old, Model):
+            old = old.to_dict()
+        if isinstance(new, Model):
+            new = new.to_dict()
+    if isinstance(old, dict) and isinstance(new, dict):
+        if old == new:
+            return
+        for key, value in new.items():
+            if key in old:
+                _diff(old[key], value, path + [key], stanzas)
+            else:
+                stanzas.append([path + [key], value])
+        for key in old.keys() - new.keys():
+            stanzas.append([path + [key]])
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for i, (old_item, new_item) in enumerate(zip(old, new)):
+            _diff(old_item, new_item, path + [i], stanzas)
+    elif old != new or type(old) is not type(new):
+        stanzas.append([path, new])
+
+
+def diff(old: dict, new: dict):
+    """Return a list of JSON-delta stanzas ([path, value] or [path] for deletion)."""
+    stanzas: list = []
+    _diff(old, new, [], stanzas)
+    return stanzas
+
+
+def merge(first: list, second: list):
+    """Merge two consecutive deltas into one, equivalent to applying first and then second.
+
+    Stanzas of the first delta are dropped if the second delta replaces or deletes
+    the same path or one of its parents.
+    """
+    if not first:
+        return second
+    if not second:
+        return first
+    replaced = {tuple(stanza[0]) for stanza in second}
+    merged = []
+    for stanza in first:
+        path = stanza[0]
+        if not any(tuple(path[:i]) in replaced for i in range(len(path) + 1)):
+            merged.append(stanza)
+    merged.extend(second)
+    return merged
+
+
+class DeltaCoalescer:
+
+    """Publish at most one delta per cluster and interval, deltas in between are merged.
+
+    The first delta after a quiet period is released immediately, later ones are
+    held back until the interval since the last release passed (see flush).
+    Empty deltas are suppressed unless nothing was released for keepalive seconds
+    (the frontend takes any delta as sign of a successful cluster query), clusters
+    which are not queried that often get one from keepalives.
+    """
+
+    def __init__(self, interval: float, keepalive: float = None):
+        self.interval = interval
+        self.keepalive = keepalive
+        # cluster ID => time of last released delta
+        self._released: dict = {}
+        # cluster ID => merged delta not released yet
+        self._pending: dict = {}
+
+    def add(self, cluster_id: str, delta: list, now: float):
+        """Add a delta, returns the delta to publish now (or None)."""
+        released = self._released.get(cluster_id, 0)
+        if cluster_id in self._pending:
+            self._pending[cluster_id] = merge(self._pending[cluster_id], delta)
+            return None
+        if not delta and self.keepalive is not None and now < released + self.keepalive:
+            return None
+        if now < released + self.interval:
+            self._pending[cluster_id] = delta
+            return None
+        self._released[cluster_id] = now
+        return delta
+
+    def discard(self, cluster_id: str, now: float):
+        """Drop the pending delta, e.g. because the whole cluster is published."""
+        self._pending.pop(cluster_id, None)
+        self._released[cluster_id] = now
+
+    def pop(self, cluster_id: str):
+        """Return and drop the pending delta (if any), e.g. to publish it right away."""
+        return self._pending.pop(cluster_id, None)
+
+    def flush(self, now: float):
+        """Return (cluster ID, delta) pairs due for publishing."""
+        due = []
+        for cluster_id, delta in list(self._pending.items()):
+            if now >= self._released.get(cluster_id, 0) + self.interval:
+                del self._pending[cluster_id]
+                self._released[cluster_id] = now
+                due.append((cluster_id, delta))
+        return due
+
+    def keepalives(self, cluster_ids, now: float):
+        """Return the IDs of clusters due for an empty keepalive delta (nothing released or pending)."""
+        due: list = []
+        if self.keepalive is None:
+            return due
+        for cluster_id in cluster_ids:
+            if cluster_id in self._pending:
+                continue
+            if now >= self._released.get(cluster_id, 0) + self.keepalive:
+                self._released[cluster_id] = now
+                due.append(cluster_id)
+        return due
@@ -1,20 +1,34 @@
+import calendar
 import datetime
+import functools
 import logging
 import time
+from pathlib import Path
+from typing import Optional
 
-import pykube
 import requests
-from pykube import Node
-from pykube import Pod
+import yaml
 from pykube.objects import APIObject
 from pykube.objects import NamespacedAPIObject
 
+from .metrics import QUERY_STEP_DURATION
+from .model import Container
+from .model import intern_dict
+from .model import Node
+from .model import Pod
+from .model import share_resources
 from .utils import get_short_error_message
+from .utils import run_concurrently
 
 logger = logging.getLogger(__name__)
 
 session = requests.Session()
 
+# finished pods (jobs) are still shown for one hour
+FINISHED_POD_TTL = 3600
+# number of objects requested per page when listing (same default as kubectl)
+LIST_PAGE_SIZE = 500
+
 
 # https://github.com/kubernetes/community/blob/master/contributors/design-proposals/instrumentation/resource-metrics-api.md
 class NodeMetrics(APIObject):
@@ -35,46 +49,56 @@ class PodMetrics(NamespacedAPIObject):
 def map_node_status(status: dict):
     return {
         "addresses": status.get("addresses"),
-        "capacity": status.get("capacity"),
-        "allocatable": status.get("allocatable"),
+        "capacity": intern_dict(status.get("capacity")),
+        "allocatable": intern_dict(status.get("allocatable")),
     }
 
 
 def map_node(node: dict):
-    return {
-        "name": node["metadata"]["name"],
-        "labels": node["metadata"]["labels"],
-        "status": map_node_status(node["status"]),
-        "pods": {},
-    }
+    return Node(
+        name=node["metadata"]["name"],
+        labels=intern_dict(node["metadata"]["labels"]),
+        status=map_node_status(node["status"]),
+    )
 
 
 def map_pod(pod: dict):
-    return {
-        "name": pod["metadata"]["name"],
-        "namespace": pod["metadata"]["namespace"],
-        "labels": pod["metadata"].get("labels", {}),
-        "phase": pod["status"].get("phase"),
-        "startTime": pod["status"]["startTime"] if "startTime" in pod["status"] else "",
-        "containers": [],
-    }
+    return Pod(
+        name=pod["metadata"]["name"],
+        namespace=pod["metadata"]["namespace"],
+        labels=intern_dict(pod["metadata"].get("labels")),
+        phase=pod["status"].get("phase"),
+        reason=pod["status"].get("reason"),
+        startTime=pod["status"].get("startTime", ""),
+    )
 
 
-def map_container(cont: dict, pod: dict):
-    obj = {"name": cont["name"], "image": cont["image"], "resources": cont["resources"]}
-    status = list(
-        [
-            s
-            for s in pod.get("status", {}).get("containerStatuses", [])
-            if s["name"] == cont["name"]
-        ]
+def map_container(cont: dict, status: Optional[dict]):
+    return Container(
+        name=cont["name"],
+        image=cont["image"],
+        resources=share_resources(cont["resources"]),
+        status=status,
     )
-    if status:
-        obj.update(**status[0])
-    return obj
 
 
+@functools.lru_cache(maxsize=8192)
 def parse_time(s: str):
+    if len(s) == 20 and s[4] == "-" and s[10] == "T" and s[19] == "Z":
+        # fast path for the "%Y-%m-%dT%H:%M:%SZ" format used by Kubernetes,
+        # datetime.strptime is slow (many finished pods share the same timestamps anyway)
+        return float(
+            calendar.timegm(
+                (
+                    int(s[0:4]),
+                    int(s[5:7]),
+                    int(s[8:10]),
+                    int(s[11:13]),
+                    int(s[14:16]),
+                    int(s[17:19]),
+                )
+            )
+        )
     return (
         datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ")
         .replace(tzinfo=datetime.timezone.utc)
@@ -82,71 +106,345 @@ def parse_time(s: str):
     )
 
 
-def query_kubernetes_cluster(cluster):
-    cluster_id = cluster.id
-    api_server_url = cluster.api_server_url
-    nodes = {}
-    pods_by_namespace_name = {}
-    unassigned_pods = {}
-    for node in Node.objects(cluster.client):
-        obj = map_node(node.obj)
-        nodes[obj["name"]] = obj
-    now = time.time()
-    for pod in Pod.objects(cluster.client, namespace=pykube.all):
-        obj = map_pod(pod.obj)
-        if "deletionTimestamp" in pod.metadata:
-            obj["deleted"] = parse_time(pod.metadata["deletionTimestamp"])
-        for cont in pod.obj["spec"]["containers"]:
-            obj["containers"].append(map_container(cont, pod.obj))
-        if obj["phase"] in ("Succeeded", "Failed"):
-            last_termination_time = 0
-            for container in obj["containers"]:
-                termination_time = (
-                    container.get("state", {}).get("terminated", {}).get("finishedAt")
-                )
-                if termination_time:
-                    termination_time = parse_time(termination_time)
-                    if termination_time > last_termination_time:
-                        last_termination_time = termination_time
-            if (last_termination_time and last_termination_time < now - 3600) or (
-                obj.get("reason") == "Evicted"
-            ):
-                # the job/pod finished more than an hour ago or if it is evicted by cgroup limits
-                # => filter out
-                continue
-        pods_by_namespace_name[(pod.namespace, pod.name)] = obj
-        pod_key = f"{pod.namespace}/{pod.name}"
-        node_name = pod.obj["spec"].get("nodeName")
-        if node_name in nodes:
-            nodes[node_name]["pods"][pod_key] = obj
-        else:
-            unassigned_pods[pod_key] = obj
+def map_pod_and_containers(pod: dict):
+    obj = map_pod(pod)
+    if "deletionTimestamp" in pod["metadata"]:
+        obj.deleted = parse_time(pod["metadata"]["deletionTimestamp"])
+    # index container statuses by name once instead of scanning them per container
+    statuses = {
+        status["name"]: status
+        for status in pod.get("status", {}).get("containerStatuses") or []
+    }
+    for cont in pod["spec"]["containers"]:
+        obj.containers.append(map_container(cont, statuses.get(cont["name"])))
+    return obj
+
+
+def get_last_termination_time(obj: Pod):
+    last_termination_time = 0
+    for container in obj.containers:
+        termination_time = (
+            container.status.get("state", {}).get("terminated", {}).get("finishedAt")
+        )
+        if termination_time:
+            termination_time = parse_time(termination_time)
+            if termination_time > last_termination_time:
+                last_termination_time = termination_time
+    return last_termination_time
+
+
+def get_pod_expiry_time(obj: Pod):
+    """Return the time after which a finished pod is filtered out (None if the pod is not finished)."""
+    if obj.phase not in ("Succeeded", "Failed"):
+        return None
+    if obj.reason == "Evicted":
+        # evicted by cgroup limits => filter out immediately
+        return 0
+    last_termination_time = get_last_termination_time(obj)
+    if last_termination_time:
+        return last_termination_time + FINISHED_POD_TTL
+    return None
+
+
+def is_expired_pod(obj: Pod, now: float):
+    """Check whether the pod finished more than an hour ago or was evicted."""
+    expiry_time = get_pod_expiry_time(obj)
+    return expiry_time is not None and expiry_time < now
+
+
+class PaginatedList:
+
+    """All objects of a LIST request, fetched page by page using limit/continue.
+
+    Only one page is decoded at a time and objects are handed out (and dropped) one by one,
+    i.e. memory is bounded by the page size instead of the number of objects.
+    """
+
+    def __init__(
+        self,
+        client,
+        endpoint: str,
+        version: str = "v1",
+        params: dict = None,
+        page_size: int = LIST_PAGE_SIZE,
+        namespace: str = None,
+    ):
+        self.client = client
+        self.endpoint = endpoint
+        self.version = version
+        self.namespace = namespace
+        self.params = params or {}
+        self.page_size = page_size
+        # resourceVersion of the list, set after iterating all pages
+        self.resource_version = None
+
+    def __iter__(self):
+        params = dict(self.params, limit=self.page_size)
+        while True:
+            response = self.client.get(
+                url=self.endpoint,
+                version=self.version,
+                namespace=self.namespace,
+                params=params,
+            )
+            response.raise_for_status()
+            page = response.json()
+            # free the raw response body before mapping the objects
+            del response
+            items = page.get("items") or []
+            items.reverse()
+            while items:
+                yield items.pop()
+            metadata = page["metadata"]
+            if not metadata.get("continue"):
+                self.resource_version = metadata.get("resourceVersion")
+                return
+            params["continue"] = metadata["continue"]
+
+
+class QueryProfile:
+
+    """Server-side filters for listing and watching nodes and pods of a cluster.
+
+    Only selectors are used to shrink the transferred data: metadata-only representations
+    (Table, PartialObjectMetadata) lack the spec/status fields needed for mapping.
+    """
+
+    def __init__(
+        self,
+        pod_field_selector: str = None,
+        pod_label_selector: str = None,
+        node_label_selector: str = None,
+        namespaces: list = None,
+        exclude_namespaces: list = None,
+    ):
+        self.pod_field_selector = pod_field_selector
+        self.pod_label_selector = pod_label_selector
+        self.node_label_selector = node_label_selector
+        self.namespaces = namespaces or []
+        self.exclude_namespaces = exclude_namespaces or []
+
+    @property
+    def pod_namespaces(self):
+        """Namespaces to list pods in, None means all namespaces."""
+        return self.namespaces or [None]
 
+    def pod_params(self):
+        field_selectors = [self.pod_field_selector] if self.pod_field_selector else []
+        for namespace in self.exclude_namespaces:
+            field_selectors.append(f"metadata.namespace!={namespace}")
+        params = {}
+        if field_selectors:
+            params["fieldSelector"] = ",".join(field_selectors)
+        if self.pod_label_selector:
+            params["labelSelector"] = self.pod_label_selector
+        return params
+
+    @property
+    def nodes_filtered(self) -> bool:
+        """Whether only some nodes are listed, pods on other nodes are left out then."""
+        return bool(self.node_label_selector)
+
+    def node_params(self):
+        if self.node_label_selector:
+            return {"labelSelector": self.node_label_selector}
+        return {}
+
+
+# the arguments of QueryProfile
+QUERY_PROFILE_OPTIONS = frozenset(
+    [
+        "pod_field_selector",
+        "pod_label_selector",
+        "node_label_selector",
+        "namespaces",
+        "exclude_namespaces",
+    ]
+)
+
+
+class QueryProfiles:
+
+    """Query profiles by cluster ID, clusters without own profile use the "default" profile.
+
+    Example YAML::
+
+        default:
+          pod_field_selector: status.phase!=Succeeded
+          exclude_namespaces: [kube-system]
+        clusters:
+          my-cluster:
+            namespaces: [default, production]
+    """
+
+    def __init__(self, config: dict = None):
+        config = config or {}
+        self._default = config.get("default") or {}
+        self._clusters = config.get("clusters") or {}
+        # fail on load, not on the first query of the cluster
+        self._validate(config.keys() - {"default", "clusters"}, "query profiles")
+        self._validate(self._default.keys() - QUERY_PROFILE_OPTIONS, "default")
+        for cluster_id, profile in self._clusters.items():
+            self._validate(profile.keys() - QUERY_PROFILE_OPTIONS, cluster_id)
+
+    @staticmethod
+    def _validate(unknown_keys: set, name: str):
+        if unknown_keys:
+            raise ValueError(
+                "Unknown keys in {}: {}".format(name, ", ".join(sorted(unknown_keys)))
+            )
+
+    @classmethod
+    def from_file(cls, path: Path):
+        with path.open() as fd:
+            return cls(yaml.safe_load(fd))
+
+    def get(self, cluster_id: str):
+        # cluster specific settings override the default ones
+        return QueryProfile(**{**self._default, **self._clusters.get(cluster_id, {})})
+
+
+def observe_steps(cluster, resource: str, started: float, mapping_seconds: float = 0):
+    """Observe the wall time of fetching (and mapping) the resource since started."""
+    seconds = time.perf_counter() - started
+    QUERY_STEP_DURATION.labels(cluster.id, "fetch_" + resource).observe(
+        seconds - mapping_seconds
+    )
+    if mapping_seconds:
+        QUERY_STEP_DURATION.labels(cluster.id, "map_" + resource).observe(
+            mapping_seconds
+        )
+
+
+def query_node_usage(cluster):
+    """Query node metrics, returns usage by node name (empty if not available)."""
+    usage = {}
+    started = time.perf_counter()
     try:
-        for node_metrics in NodeMetrics.objects(cluster.client):
-            key = node_metrics.name
-            nodes[key]["usage"] = node_metrics.obj.get("usage", {})
+        for node_metrics in PaginatedList(
+            cluster.client, NodeMetrics.endpoint, NodeMetrics.version
+        ):
+            usage[node_metrics["metadata"]["name"]] = node_metrics.get("usage", {})
     except Exception as e:
         logger.warning(
             "Failed to query node metrics {}: {}".format(
                 cluster.id, get_short_error_message(e)
             )
         )
+    observe_steps(cluster, "node_metrics", started)
+    return usage
+
+
+def query_pod_metrics(cluster, profile: QueryProfile):
+    """Query pod metrics, returns usage by container name by (namespace, name) (empty if not available)."""
+    metrics = {}
+    started = time.perf_counter()
     try:
-        for pod_metrics in PodMetrics.objects(cluster.client, namespace=pykube.all):
-            key = (pod_metrics.namespace, pod_metrics.name)
-            pod = pods_by_namespace_name.get(key)
-            if pod:
-                for container in pod["containers"]:
-                    for container_metrics in pod_metrics.obj.get("containers", []):
-                        if container["name"] == container_metrics["name"]:
-                            container["resources"]["usage"] = container_metrics["usage"]
+        for namespace in profile.pod_namespaces:
+            for pod_metrics in PaginatedList(
+                cluster.client,
+                PodMetrics.endpoint,
+                PodMetrics.version,
+                namespace=namespace,
+            ):
+                key = (
+                    pod_metrics["metadata"]["namespace"],
+                    pod_metrics["metadata"]["name"],
+                )
+                metrics[key] = {
+                    container_metrics["name"]: container_metrics["usage"]
+                    for container_metrics in pod_metrics.get("containers") or []
+                }
     except Exception as e:
         logger.warning(
             "Failed to query pod metrics for cluster {}: {}".format(
                 cluster.id, get_short_error_message(e)
             )
         )
+    observe_steps(cluster, "pod_metrics", started)
+    return metrics
+
+
+def list_nodes(cluster, profile: QueryProfile):
+    """List and map all nodes, returns nodes by name."""
+    nodes = {}
+    started = time.perf_counter()
+    mapping_seconds = 0.0
+    for node in PaginatedList(cluster.client, "nodes", params=profile.node_params()):
+        mapping_started = time.perf_counter()
+        obj = map_node(node)
+        nodes[obj.name] = obj
+        mapping_seconds += time.perf_counter() - mapping_started
+    observe_steps(cluster, "nodes", started, mapping_seconds)
+    return nodes
+
+
+def list_pods(cluster, profile: QueryProfile):
+    """List and map all pods while they arrive, returns (namespace, name, node name, pod) tuples."""
+    pods = []
+    now = time.time()
+    started = time.perf_counter()
+    mapping_seconds = 0.0
+    for namespace in profile.pod_namespaces:
+        for pod in PaginatedList(
+            cluster.client, "pods", params=profile.pod_params(), namespace=namespace
+        ):
+            mapping_started = time.perf_counter()
+            obj = map_pod_and_containers(pod)
+            mapping_seconds += time.perf_counter() - mapping_started
+            if is_expired_pod(obj, now):
+                # the job/pod finished more than an hour ago or if it is evicted by cgroup limits
+                # => filter out
+                continue
+            metadata = pod["metadata"]
+            pods.append(
+                (
+                    metadata["namespace"],
+                    metadata["name"],
+                    pod["spec"].get("nodeName"),
+                    obj,
+                )
+            )
+    observe_steps(cluster, "pods", started, mapping_seconds)
+    return pods
+
+
+def query_kubernetes_cluster(cluster, query_profiles: QueryProfiles = None):
+    cluster_id = cluster.id
+    api_server_url = cluster.api_server_url
+    profile = (query_profiles or QueryProfiles()).get(cluster_id)
+    # all requests are independent of each other, run them concurrently
+    nodes, pods, node_usage, pod_metrics = run_concurrently(
+        (list_nodes, cluster, profile),
+        (list_pods, cluster, profile),
+        (query_node_usage, cluster),
+        (query_pod_metrics, cluster, profile),
+    )
+    started = time.perf_counter()
+    pods_by_namespace_name = {}
+    unassigned_pods = {}
+    for namespace, name, node_name, obj in pods:
+        pods_by_namespace_name[(namespace, name)] = obj
+        pod_key = f"{namespace}/{name}"
+        if node_name in nodes:
+            nodes[node_name].pods[pod_key] = obj
+        # pods scheduled on filtered out nodes are left out (not "unassigned")
+        elif not node_name or not profile.nodes_filtered:
+            unassigned_pods[pod_key] = obj
+
+    for key, usage in node_usage.items():
+        if key in nodes:
+            nodes[key].usage = usage
+    for key, usage_by_container in pod_metrics.items():
+        pod = pods_by_namespace_name.get(key)
+        if pod:
+            for container in pod.containers:
+                usage = usage_by_container.get(container.name)
+                if usage is not None:
+                    container.usage = usage
+    QUERY_STEP_DURATION.labels(cluster_id, "assemble").observe(
+        time.perf_counter() - started
+    )
     return {
         "id": cluster_id,
         "api_server_url": api_server_url,
@@ -7,6 +7,7 @@ import click
 import flask
 import functools
 import gevent
+import gevent.lock
 import gevent.pywsgi
 import json
 import logging
@@ -14,28 +15,31 @@ import os
 import signal
 import time
 import kube_ops_view
-from typing import Union
 from pathlib import Path
 
 from flask import Flask, redirect, url_for
 from .oauth import OAuth2ConsumerBlueprintWithClientRefresh
 
-from .mock import query_mock_cluster
-from .kubernetes import query_kubernetes_cluster
-from .stores import MemoryStore, RedisStore
-from .cluster_discovery import (
-    DEFAULT_CLUSTERS,
-    StaticClusterDiscoverer,
-    ClusterRegistryDiscoverer,
-    KubeconfigDiscoverer,
-    MockDiscoverer,
-)
+from . import metrics
+from .broadcast import Broadcaster
+from .broadcast import snapshot_frames
+from .cli import common_options
+from .cli import create_cluster_query
+from .cli import create_discoverer
+from .cli import create_store
+from .compress import compress_events
+from .compress import negotiate_encoding
+from .profiler import MAX_PROFILE_SECONDS
+from .profiler import Profiler
+from .profiler import SAMPLE_INTERVAL_SECONDS
+from .stores import MemoryStore
 from .update import update_clusters
 
 
 logger = logging.getLogger(__name__)
 
 SERVER_STATUS = {"shutdown": False}
+PROFILER_LOCK = gevent.lock.Semaphore()
 AUTHORIZE_URL = os.getenv("AUTHORIZE_URL")
 ACCESS_TOKEN_URL = os.getenv("ACCESS_TOKEN_URL")
 SCOPE = os.getenv("SCOPE")
@@ -74,6 +78,12 @@ def health():
         return "OK"
 
 
+@app.route("/metrics")
+def get_metrics():
+    app.broadcaster.update_metrics()
+    return flask.Response(metrics.render(), mimetype="text/plain")
+
+
 @app.route("/")
 @authorize
 def index():
@@ -100,34 +110,50 @@ def index():
     )
 
 
-def event(cluster_ids: set):
-    # first sent full data once
-    for cluster_id in app.store.get_cluster_ids():
-        if not cluster_ids or cluster_id in cluster_ids:
-            status = app.store.get_cluster_status(cluster_id)
-            if status:
-                # send the cluster status including last_query_time BEFORE the cluster data
-                # so the UI knows how to render correctly from the start
-                yield "event: clusterstatus\ndata: " + json.dumps(
-                    {"cluster_id": cluster_id, "status": status}, separators=(",", ":")
-                ) + "\n\n"
-            cluster = app.store.get_cluster_data(cluster_id)
-            if cluster:
-                yield "event: clusterupdate\ndata: " + json.dumps(
-                    cluster, separators=(",", ":")
-                ) + "\n\n"
-    yield "event: bootstrapend\ndata: \n\n"
-
-    while True:
-        for event_type, event_data in app.store.listen():
-            # hacky, event_data can be delta or full cluster object
-            if (
-                not cluster_ids
-                or event_data.get("cluster_id", event_data.get("id")) in cluster_ids
-            ):
-                yield "event: " + event_type + "\ndata: " + json.dumps(
-                    event_data, separators=(",", ":")
-                ) + "\n\n"
+def snapshot(cluster_ids: set):
+    """Generate status and data events of all (given) clusters."""
+    # events received so far are part of the snapshot
+    return snapshot_frames(app.store, cluster_ids, app.broadcaster.last_event_id)
+
+
+def event(
+    cluster_ids: set,
+    remote_addr: str,
+    update_interval: float,
+    last_event_id: str = None,
+):
+    # a slow client gets a fresh snapshot instead of the deltas it missed
+    subscribe = functools.partial(
+        app.broadcaster.subscribe,
+        cluster_ids,
+        functools.partial(snapshot, cluster_ids),
+        remote_addr,
+        update_interval,
+    )
+    subscription = None
+    replayed = None
+    if last_event_id and not update_interval:
+        # subscribe first to not miss events while reading the event log
+        subscription = subscribe()
+        replayed = app.broadcaster.replay(subscription, last_event_id)
+        if replayed is None:
+            app.broadcaster.unsubscribe(subscription)
+            subscription = None
+    try:
+        if replayed is not None:
+            # reconnecting client which only missed some events
+            yield from replayed
+        else:
+            # first sent full data once
+            yield from snapshot(cluster_ids)
+        yield "event: bootstrapend\ndata: \n\n"
+
+        if subscription is None:
+            subscription = subscribe()
+        yield from subscription
+    finally:
+        if subscription is not None:
+            app.broadcaster.unsubscribe(subscription)
 
 
 @app.route("/events")
@@ -138,11 +164,68 @@ def get_events():
     for _id in flask.request.args.get("cluster_ids", "").split():
         if _id:
             cluster_ids.add(_id)
-    return flask.Response(
-        event(cluster_ids),
-        mimetype="text/event-stream",
-        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    # optional maximum number of deltas per cluster and second, e.g. 0.2 for slow links
+    max_update_rate = flask.request.args.get("max_update_rate", type=float)
+    update_interval = 1 / max_update_rate if max_update_rate else 0
+    remote_addr = (
+        flask.request.headers.get("X-Forwarded-For") or flask.request.remote_addr
+    )
+    # sent by EventSource when reconnecting, the frontend passes it as parameter
+    last_event_id = flask.request.headers.get(
+        "Last-Event-ID"
+    ) or flask.request.args.get("last_event_id")
+    events = event(cluster_ids, remote_addr, update_interval, last_event_id)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    encoding, compression_headers = negotiate_encoding(
+        flask.request.args.get("compress"), flask.request.headers.get("Accept-Encoding")
+    )
+    if encoding:
+        events = compress_events(events, encoding)
+    headers.update(compression_headers)
+    return flask.Response(events, mimetype="text/event-stream", headers=headers)
+
+
+@app.route("/events/stats")
+@authorize
+def get_event_stats():
+    """Counters of SSE clients which did not keep up with events."""
+    return flask.jsonify(app.broadcaster.stats())
+
+
+@app.route("/store/stats")
+@authorize
+def get_store_stats():
+    """Counters of the store backend, e.g. Redis round trips."""
+    return flask.jsonify(app.store.stats())
+
+
+@app.route("/debug/profile")
+@authorize
+def get_profile():
+    """Sample stacks for ?seconds as collapsed stacks (or ?format=json incl. greenlet run times)."""
+    if not app.config.get("PROFILER"):
+        flask.abort(404)
+    seconds = min(
+        flask.request.args.get("seconds", 10, type=float), MAX_PROFILE_SECONDS
     )
+    interval = max(
+        flask.request.args.get("interval", SAMPLE_INTERVAL_SECONDS, type=float), 0.001
+    )
+    # one profile at a time, greenlet switches can only be traced once
+    if not PROFILER_LOCK.acquire(blocking=False):
+        flask.abort(409)
+    try:
+        profiler = Profiler(interval)
+        profiler.start()
+        try:
+            gevent.sleep(seconds)
+        finally:
+            profiler.stop()
+    finally:
+        PROFILER_LOCK.release()
+    if flask.request.args.get("format") == "json":
+        return flask.jsonify(dict(profiler.stats(), stacks=profiler.collapsed()))
+    return flask.Response(profiler.collapsed(), mimetype="text/plain")
 
 
 @app.route("/screen-tokens", methods=["GET", "POST"])
@@ -177,6 +260,10 @@ def logout():
 
 
 def shutdown():
+    try:
+        app.store.save_snapshot()
+    except Exception as e:
+        logger.exception(f"Failed to save snapshot: {e}")
     # just wait some time to give Kubernetes time to update endpoints
     # this requires changing the readinessProbe's
     # PeriodSeconds and FailureThreshold appropriately
@@ -191,59 +278,8 @@ def exit_gracefully(signum, frame):
     gevent.spawn(shutdown)
 
 
-def print_version(ctx, param, value):
-    if not value or ctx.resilient_parsing:
-        return
-    click.echo("Kubernetes Operational View {}".format(kube_ops_view.__version__))
-    ctx.exit()
-
-
-class CommaSeparatedValues(click.ParamType):
-    name = "comma_separated_values"
-
-    def convert(self, value, param, ctx):
-        if isinstance(value, str):
-            values = filter(None, value.split(","))
-        else:
-            values = value
-        return values
-
-
 @click.command(context_settings={"help_option_names": ["-h", "--help"]})
-@click.option(
-    "-V",
-    "--version",
-    is_flag=True,
-    callback=print_version,
-    expose_value=False,
-    is_eager=True,
-    help="Print the current version number and exit.",
-)
-@click.option(
-    "-p",
-    "--port",
-    type=int,
-    help="HTTP port to listen on (default: 8080)",
-    envvar="SERVER_PORT",
-    default=8080,
-)
-@click.option(
-    "--route-prefix",
-    help="""The URL prefix under which kube-ops-view is externally reachable
-    (for example, if kube-ops-view is served via a reverse proxy). Used for
-    generating relative and absolute links back to kube-ops-view itself. If the
-    URL has a path portion, it will be used to prefix all HTTP endpoints served
-    by kube-ops-view. If omitted, relevant URL components will be derived
-    automatically.""",
-    envvar="ROUTE_PREFIX",
-    default="/",
-)
-@click.option(
-    "-d", "--debug", is_flag=True, help="Run in debugging mode", envvar="DEBUG"
-)
-@click.option(
-    "-m", "--mock", is_flag=True, help="Mock Kubernetes clusters", envvar="MOCK"
-)
+@common_options
 @click.option(
     "--secret-key",
     help="Secret key for session cookies",
@@ -251,102 +287,89 @@ class CommaSeparatedValues(click.ParamType):
     default="development",
 )
 @click.option(
-    "--redis-url",
-    help="Redis URL to use for pub/sub and job locking",
-    envvar="REDIS_URL",
-)
-@click.option(
-    "--clusters",
-    type=CommaSeparatedValues(),
-    help="Comma separated list of Kubernetes API server URLs (default: {})".format(
-        DEFAULT_CLUSTERS
-    ),
-    envvar="CLUSTERS",
-)
-@click.option(
-    "--cluster-registry-url",
-    help="URL to cluster registry",
-    envvar="CLUSTER_REGISTRY_URL",
-)
-@click.option(
-    "--kubeconfig-path",
-    type=click.Path(exists=True),
-    help="Path to kubeconfig file",
-    envvar="KUBECONFIG_PATH",
-)
-@click.option(
-    "--kubeconfig-contexts",
-    type=CommaSeparatedValues(),
-    help="List of kubeconfig contexts to use (default: use all defined contexts)",
-    envvar="KUBECONFIG_CONTEXTS",
-)
-@click.option(
-    "--query-interval",
-    type=float,
-    help="Interval in seconds for querying clusters (default: 5)",
-    envvar="QUERY_INTERVAL",
-    default=5,
-)
-@click.option(
-    "--node-link-url-template",
-    help="Template for target URL when clicking on a Node",
-    envvar="NODE_LINK_URL_TEMPLATE",
-)
-@click.option(
-    "--pod-link-url-template",
-    help="Template for target URL when clicking on a Pod",
-    envvar="POD_LINK_URL_TEMPLATE",
+    "--enable-profiler",
+    is_flag=True,
+    help="Enable the sampling profiler on /debug/profile (collapsed stacks and greenlet run times)",
+    envvar="ENABLE_PROFILER",
 )
 def main(
     port,
+    route_prefix: str,
     debug,
     mock,
-    secret_key,
+    mock_clusters: int,
+    mock_nodes: int,
+    mock_pods_per_node: int,
+    mock_containers_per_pod: int,
+    mock_churn: float,
     redis_url,
+    redis_format: str,
+    redis_compression: bool,
+    redis_max_connections: int,
+    snapshot_path: str,
+    snapshot_interval: float,
     clusters: list,
     cluster_registry_url,
     kubeconfig_path,
     kubeconfig_contexts: list,
     query_interval,
+    max_query_interval: float,
+    idle_query_interval: float,
+    query_concurrency: int,
+    query_timeout: float,
+    publish_interval: float,
+    watch,
+    query_profiles,
+    max_queued_events: int,
+    slow_client_policy: str,
     node_link_url_template: str,
     pod_link_url_template: str,
-    route_prefix: str,
+    secret_key,
+    enable_profiler: bool,
 ):
     logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
 
-    store = RedisStore(redis_url) if redis_url else MemoryStore()
+    store = create_store(
+        redis_url,
+        redis_format,
+        redis_compression,
+        redis_max_connections,
+        snapshot_path,
+    )
 
     app.debug = debug
     app.secret_key = secret_key
     app.store = store
+    app.broadcaster = Broadcaster(
+        store,
+        max_queued_events=max_queued_events,
+        slow_client_policy=slow_client_policy,
+    )
     app.config["APPLICATION_ROOT"] = route_prefix
+    app.config["PROFILER"] = enable_profiler
     app.app_config = {
         "node_link_url_template": node_link_url_template,
         "pod_link_url_template": pod_link_url_template,
         "route_prefix": route_prefix,
     }
 
-    discoverer: Union[
-        MockDiscoverer,
-        ClusterRegistryDiscoverer,
-        KubeconfigDiscoverer,
-        StaticClusterDiscoverer,
-    ]
-
-    if mock:
-        cluster_query = query_mock_cluster
-        discoverer = MockDiscoverer()
-    else:
-        cluster_query = query_kubernetes_cluster
-        if cluster_registry_url:
-            discoverer = ClusterRegistryDiscoverer(cluster_registry_url)
-        elif kubeconfig_path:
-            discoverer = KubeconfigDiscoverer(
-                Path(kubeconfig_path), set(kubeconfig_contexts or [])
-            )
-        else:
-            api_server_urls = clusters or []
-            discoverer = StaticClusterDiscoverer(api_server_urls)
+    cluster_query = create_cluster_query(
+        mock,
+        mock_nodes,
+        mock_pods_per_node,
+        mock_containers_per_pod,
+        mock_churn,
+        query_profiles,
+        watch,
+    )
+    discoverer = create_discoverer(
+        mock,
+        mock_clusters,
+        clusters,
+        cluster_registry_url,
+        kubeconfig_path,
+        kubeconfig_contexts,
+    )
 
     gevent.spawn(
         update_clusters,
@@ -354,9 +377,19 @@ def main(
         query_cluster=cluster_query,
         store=store,
         query_interval=query_interval,
+        max_query_interval=max_query_interval,
+        idle_query_interval=idle_query_interval,
         debug=debug,
+        query_concurrency=query_concurrency,
+        query_timeout=query_timeout,
+        publish_interval=publish_interval,
     )
 
+    gevent.spawn(app.broadcaster.run)
+
+    if isinstance(store, MemoryStore) and snapshot_path:
+        gevent.spawn(store.save_snapshots, snapshot_interval)
+
     signal.signal(signal.SIGTERM, exit_gracefully)
     http_server = gevent.pywsgi.WSGIServer(("0.0.0.0", port), app)
     logger.info("Listening on :{}..".format(port))
@@ -0,0 +1,289 @@
+"""Process-local metrics in the Prometheus text format (served on /metrics).
+
+A minimal subset of the prometheus_client API (counters, gauges and histograms with
+labels) to avoid another dependency. Metrics are per process, i.e. every replica is
+scraped on its own.
+"""
+
+import contextlib
+import functools
+import math
+import threading
+import time
+from typing import Dict
+from typing import List
+from typing import Sequence
+from typing import Tuple
+
+# seconds, from a single Redis command up to querying a large cluster
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# all metrics in order of creation
+REGISTRY: list = []
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return (
+        "{"
+        + ",".join('{}="{}"'.format(name, escape(v)) for name, v in zip(names, values))
+        + "}"
+    )
+
+
+class Metric:
+
+    """Metric with one child (value) per combination of label values."""
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def remove(self, *values):
+        self._children.pop(tuple(str(value) for value in values), None)
+
+    def clear(self):
+        self._children.clear()
+
+    def samples(self, values: Tuple[str, ...], child) -> List[Tuple[str, str, float]]:
+        """Return the (suffix, labels, value) samples of a child."""
+        return [("", format_labels(self.labelnames, values), child.value)]
+
+    def render(self) -> List[str]:
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        for values, child in sorted(self._children.items()):
+            for suffix, labels, value in self.samples(values, child):
+                lines.append(
+                    "{}{}{} {}".format(self.name, suffix, labels, format_value(value))
+                )
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+
+    type = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DURATION_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def _new_child(self):
+        return _Histogram(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self, values, child):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, child.counts):
+            cumulative += count
+            samples.append(
+                (
+                    "_bucket",
+                    format_labels(
+                        self.labelnames + ("le",), values + (format_value(bound),)
+                    ),
+                    cumulative,
+                )
+            )
+        labels = format_labels(self.labelnames, values)
+        samples.append(("_count", labels, child.count))
+        samples.append(("_sum", labels, child.sum))
+        return samples
+
+
+def timed(histogram: Histogram, *labels):
+    """Decorate a function to observe its duration in the histogram."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.labels(*labels).time():
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def render() -> str:
+    """Return all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+QUERY_DURATION = Histogram(
+    "kube_ops_view_query_duration_seconds",
+    "Duration of cluster queries (including failed ones)",
+    ["cluster"],
+)
+QUERY_STEP_DURATION = Histogram(
+    "kube_ops_view_query_step_duration_seconds",
+    "Wall time of fetching (LIST requests incl. decoding, run concurrently) and mapping nodes, pods and metrics and assembling the cluster snapshot per query",
+    ["cluster", "step"],
+)
+QUERY_FAILURES = Counter(
+    "kube_ops_view_query_failures_total",
+    "Number of failed cluster queries",
+    ["cluster"],
+)
+BACKOFF_TRIES = Gauge(
+    "kube_ops_view_query_backoff_tries",
+    "Consecutive failed queries of clusters in backoff",
+    ["cluster"],
+)
+BACKOFF_NEXT_TRY = Gauge(
+    "kube_ops_view_query_backoff_next_try_timestamp_seconds",
+    "Time of the next query of clusters in backoff",
+    ["cluster"],
+)
+QUERY_INTERVAL = Gauge(
+    "kube_ops_view_query_interval_seconds",
+    "Adapted query interval of clusters (with --max-query-interval)",
+    ["cluster"],
+)
+DIFF_DURATION = Histogram(
+    "kube_ops_view_diff_duration_seconds",
+    "Duration of computing the delta between cluster snapshots",
+    ["cluster"],
+)
+STORE_DURATION = Histogram(
+    "kube_ops_view_store_duration_seconds",
+    "Duration of store reads and writes",
+    ["operation"],
+)
+EVENT_SIZE = Histogram(
+    "kube_ops_view_event_size_bytes",
+    "Size of encoded SSE events (e.g. deltas) published to clients",
+    ["type"],
+    buckets=SIZE_BUCKETS,
+)
+BROADCAST_DURATION = Histogram(
+    "kube_ops_view_broadcast_duration_seconds",
+    "Duration of encoding an event and offering it to all SSE clients",
+)
+SSE_CLIENTS = Gauge("kube_ops_view_sse_clients", "Number of connected SSE clients")
+# per client in /events/stats, not as label (one time series per connection)
+SSE_QUEUED_EVENTS = Gauge(
+    "kube_ops_view_sse_queued_events",
+    "Number of events queued for all SSE clients",
+)
+SSE_MAX_QUEUED_EVENTS = Gauge(
+    "kube_ops_view_sse_max_queued_events",
+    "Largest number of events queued for a single SSE client",
+)
+SSE_DROPPED_EVENTS = Counter(
+    "kube_ops_view_sse_dropped_events_total",
+    "Number of events dropped because SSE clients did not keep up",
+)
+SSE_RESYNCS = Counter(
+    "kube_ops_view_sse_resyncs_total",
+    "Number of snapshots sent to SSE clients instead of dropped events",
+)
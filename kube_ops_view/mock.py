@@ -2,6 +2,11 @@ import random
 import string
 import time
 
+from .model import Container
+from .model import intern_dict
+from .model import Node
+from .model import Pod
+
 
 def hash_int(x: int):
     x = ((x >> 16) ^ x) * 0x45D9F3B
@@ -10,7 +15,21 @@ def hash_int(x: int):
     return x
 
 
-def generate_mock_pod(index: int, i: int, j: int):
+def generate_mock_pod(
+    index: int,
+    i: int,
+    j: int,
+    containers: int = None,
+    generation: int = 0,
+    rng: random.Random = None,
+):
+    """Generate pod j on node i of cluster index.
+
+    The pod has one or two containers unless containers is given, a new generation
+    (i.e. the pod was replaced) gets a new name. Resource values are taken from rng
+    (if given).
+    """
+    randint = rng.randint if rng else random.randint
     names = [
         "agent-cooper",
         "black-lodge",
@@ -34,66 +53,79 @@ def generate_mock_pod(index: int, i: int, j: int):
             pod_labels[k] = v[label_choice - 1]
 
     phase = pod_phases[hash_int((index + 1) * (i + 1) * (j + 1)) % len(pod_phases)]
-    containers = []
-    for _ in range(1 + j % 2):
+    pod_containers = []
+    for _ in range(1 + j % 2 if containers is None else containers):
         # generate "more real data"
-        requests_cpu = random.randint(10, 50)
-        requests_memory = random.randint(64, 256)
+        requests_cpu = randint(10, 50)
+        requests_memory = randint(64, 256)
         # with max, we defend ourselves against negative cpu/memory ;)
-        usage_cpu = max(requests_cpu + random.randint(-30, 30), 1)
-        usage_memory = max(requests_memory + random.randint(-64, 128), 1)
-        container = {
-            "name": "myapp",
-            "image": "foo/bar/{}".format(j),
-            "resources": {
+        usage_cpu = max(requests_cpu + randint(-30, 30), 1)
+        usage_memory = max(requests_memory + randint(-64, 128), 1)
+        resources = intern_dict(
+            {
                 "requests": {
                     "cpu": f"{requests_cpu}m",
                     "memory": f"{requests_memory}Mi",
                 },
                 "limits": {},
-                "usage": {"cpu": f"{usage_cpu}m", "memory": f"{usage_memory}Mi"},
-            },
-            "ready": True,
-            "state": {"running": {}},
-        }
+            }
+        )
+        usage = intern_dict({"cpu": f"{usage_cpu}m", "memory": f"{usage_memory}Mi"})
+        status = {"ready": True, "state": {"running": {}}}
         if phase == "Running":
             if j % 13 == 0:
-                container.update(
+                status.update(
                     **{
                         "ready": False,
                         "state": {"waiting": {"reason": "CrashLoopBackOff"}},
                     }
                 )
             elif j % 7 == 0:
-                container.update(
+                status.update(
                     **{"ready": False, "state": {"running": {}}, "restartCount": 3}
                 )
         elif phase == "Failed":
-            del container["state"]
-            del container["ready"]
-        containers.append(container)
-    pod = {
-        "name": "{}-{}-{}".format(
-            names[hash_int((i + 1) * (j + 1)) % len(names)], i, j
-        ),
-        "namespace": "kube-system" if j < 3 else "default",
-        "labels": pod_labels,
-        "phase": phase,
-        "containers": containers,
-    }
+            status = {}
+        pod_containers.append(
+            Container("myapp", "foo/bar/{}".format(j), resources, status, usage)
+        )
+    name = "{}-{}-{}".format(names[hash_int((i + 1) * (j + 1)) % len(names)], i, j)
+    if generation:
+        name += "-{:x}".format(generation)
+    pod = Pod(
+        name=name,
+        namespace="kube-system" if j < 3 else "default",
+        labels=intern_dict(pod_labels),
+        phase=phase,
+        containers=pod_containers,
+    )
     if phase == "Running" and j % 17 == 0:
-        pod["deleted"] = 123
+        pod.deleted = 123
 
     return pod
 
 
-def query_mock_cluster(cluster):
-    """Generate deterministic (no randomness!) mock data."""
+def query_mock_cluster(
+    cluster,
+    nodes: int = 10,
+    pods_per_node: int = None,
+    containers_per_pod: int = None,
+    churn: float = None,
+):
+    """Generate deterministic (no randomness!) mock data.
+
+    Nodes have up to 31 pods with one or two containers each unless pods_per_node
+    and containers_per_pod are given. Without churn, a node and some pods come and go
+    every few seconds and the resource usage changes on every query. Otherwise churn is
+    the ratio of pods replaced per second and the other pods do not change, e.g. to
+    benchmark large clusters.
+    """
     index = int(cluster.id.split("-")[-1])
-    nodes = {}
-    for i in range(10):
+    now = time.time()
+    cluster_nodes = {}
+    for i in range(nodes):
         # add/remove the second to last node every 13 seconds
-        if i == 8 and int(time.time() / 13) % 2 == 0:
+        if churn is None and i == nodes - 2 and int(now / 13) % 2 == 0:
             continue
         labels = {}
         # only the first two clusters have master nodes
@@ -105,44 +137,67 @@ def query_mock_cluster(cluster):
             else:
                 labels["master"] = "true"
         pods = {}
-        for j in range(hash_int((index + 1) * (i + 1)) % 32):
-            # add/remove some pods every 7 seconds
-            if j % 17 == 0 and int(time.time() / 7) % 2 == 0:
-                pass
+        if pods_per_node is None:
+            pod_count = hash_int((index + 1) * (i + 1)) % 32
+        else:
+            pod_count = pods_per_node
+        for j in range(pod_count):
+            if churn is None:
+                # add/remove some pods every 7 seconds
+                if j % 17 == 0 and int(now / 7) % 2 == 0:
+                    continue
+                pod = generate_mock_pod(index, i, j, containers_per_pod)
             else:
-                pod = generate_mock_pod(index, i, j)
-                pods["{}/{}".format(pod["namespace"], pod["name"])] = pod
+                key = hash_int(hash_int(hash_int(index) ^ i) ^ j)
+                # pods are replaced one after another (not all at once)
+                generation = int(now * churn + (key % 1000) / 1000)
+                pod = generate_mock_pod(
+                    index,
+                    i,
+                    j,
+                    containers_per_pod,
+                    generation,
+                    random.Random(key * 1000003 + generation),
+                )
+            pods["{}/{}".format(pod.namespace, pod.name)] = pod
 
         # use data from containers (usage)
         usage_cpu = 0
         usage_memory = 0
         for p in pods.values():
-            for c in p["containers"]:
-                usage_cpu += int(c["resources"]["usage"]["cpu"].split("m")[0])
-                usage_memory += int(c["resources"]["usage"]["memory"].split("Mi")[0])
+            for c in p.containers:
+                usage_cpu += int(c.usage["cpu"].split("m")[0])
+                usage_memory += int(c.usage["memory"].split("Mi")[0])
 
-        # generate longer name for a node
+        # generate longer name for a node (same name on every query)
+        rng = random.Random(hash_int((index + 1) * (i + 1)))
         suffix = "".join(
-            [random.choice(string.ascii_letters) for n in range(random.randint(1, 20))]
+            [rng.choice(string.ascii_letters) for n in range(rng.randint(1, 20))]
         )
 
-        node = {
-            "name": f"node-{i}-{suffix}",
-            "labels": labels,
-            "status": {
+        node = Node(
+            name=f"node-{i}-{suffix}",
+            labels=labels,
+            status={
                 "capacity": {"cpu": "8", "memory": "64Gi", "pods": "110"},
                 "allocatable": {"cpu": "7800m", "memory": "62Gi"},
             },
-            "pods": pods,
+            pods=pods,
             # get data from containers (usage)
-            "usage": {"cpu": f"{usage_cpu}m", "memory": f"{usage_memory}Mi"},
-        }
-        nodes[node["name"]] = node
-    pod = generate_mock_pod(index, 11, index)
-    unassigned_pods = {"{}/{}".format(pod["namespace"], pod["name"]): pod}
+            usage={"cpu": f"{usage_cpu}m", "memory": f"{usage_memory}Mi"},
+        )
+        cluster_nodes[node.name] = node
+    pod = generate_mock_pod(
+        index,
+        11,
+        index,
+        containers_per_pod,
+        rng=None if churn is None else random.Random(index),
+    )
+    unassigned_pods = {"{}/{}".format(pod.namespace, pod.name): pod}
     return {
         "id": "mock-cluster-{}".format(index),
         "api_server_url": "https://kube-{}.example.org".format(index),
-        "nodes": nodes,
+        "nodes": cluster_nodes,
         "unassigned_pods": unassigned_pods,
     }
@@ -0,0 +1,195 @@
+"""Compact internal representation of nodes, pods and containers.
+
+Cluster snapshots hold one object per pod and container. Slotted classes avoid a
+per-object __dict__, repeated strings (namespaces, label keys/values, images,
+phases) are interned and equal container resources are shared, i.e. stored only
+once per process. Objects are converted to the JSON wire format only when
+serialised (see to_json) or diffed.
+"""
+import operator
+import sys
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+# number of distinct container resources shared by value (cache is reset when full)
+MAX_SHARED_RESOURCES = 10000
+
+
+def intern_str(s):
+    """Intern the given string, other values (e.g. None) are returned unchanged."""
+    if type(s) is str:
+        return sys.intern(s)
+    return s
+
+
+def intern_dict(d: Optional[dict]):
+    """Intern keys and string values of a dict (and nested dicts), e.g. labels or resources."""
+    if not d:
+        return {}
+    return {
+        sys.intern(k): intern_dict(v) if type(v) is dict else intern_str(v)
+        for k, v in d.items()
+    }
+
+
+_shared_resources: dict = {}
+
+
+def share_resources(resources: dict):
+    """Return an equal resources dict shared with other containers (must not be modified)."""
+    try:
+        key = tuple([(k, tuple(v.items())) for k, v in resources.items()])
+        shared = _shared_resources.get(key)
+    except (AttributeError, TypeError):
+        # unexpected structure or unhashable values
+        return resources
+    if shared is None:
+        if len(_shared_resources) >= MAX_SHARED_RESOURCES:
+            _shared_resources.clear()
+        shared = _shared_resources[key] = resources
+    return shared
+
+
+class Model:
+
+    """Base class for slotted model objects, compared by value like the dicts they replace."""
+
+    __slots__: Tuple[str, ...] = ()
+
+    # slots which are left out of the wire format if they are None
+    _optional: tuple = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # returns all slot values as a tuple, compared at C level in __eq__
+        cls._values = operator.attrgetter(*cls.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._values(self) == other._values(other)
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self):
+        return "{}({})".format(
+            self.__class__.__name__,
+            ", ".join(
+                "{}={!r}".format(slot, getattr(self, slot)) for slot in self.__slots__
+            ),
+        )
+
+    def replace(self, **changes):
+        """Return a shallow copy with the given attributes replaced."""
+        obj = object.__new__(self.__class__)
+        for slot in self.__slots__:
+            setattr(obj, slot, changes.get(slot, getattr(self, slot)))
+        return obj
+
+    def to_dict(self) -> dict:
+        """Return the wire format (nested model objects are not converted)."""
+        obj: Dict[str, object] = {}
+        for slot in self.__slots__:
+            value = getattr(self, slot)
+            if value is not None or slot not in self._optional:
+                obj[slot] = value
+        return obj
+
+
+class Container(Model):
+
+    __slots__ = ("name", "image", "resources", "status", "usage")
+
+    def __init__(
+        self,
+        name: str,
+        image: str,
+        resources: dict,
+        status: Optional[dict] = None,
+        usage: Optional[dict] = None,
+    ):
+        self.name = sys.intern(name)
+        self.image = sys.intern(image)
+        # resources are shared between containers, i.e. usage is kept separately
+        self.resources = resources
+        # container status fields (ready, restartCount, state, ..)
+        self.status = status or {}
+        self.usage = usage
+
+    def to_dict(self):
+        resources = self.resources
+        if self.usage is not None:
+            resources = dict(resources, usage=self.usage)
+        # status fields are on the container itself in the wire format, they must not
+        # override the spec (e.g. resources of in-place resizable pods)
+        return {
+            **self.status,
+            "name": self.name,
+            "image": self.image,
+            "resources": resources,
+        }
+
+
+class Pod(Model):
+
+    __slots__ = (
+        "name",
+        "namespace",
+        "labels",
+        "phase",
+        "reason",
+        "startTime",
+        "containers",
+        "deleted",
+    )
+    _optional = ("reason", "deleted")
+
+    def __init__(
+        self,
+        name: str,
+        namespace: str,
+        labels: dict,
+        phase: Optional[str],
+        startTime: str = "",
+        containers: list = None,
+        deleted: Optional[float] = None,
+        reason: Optional[str] = None,
+    ):
+        self.name = name
+        self.namespace = sys.intern(namespace)
+        self.labels = labels
+        self.phase = intern_str(phase)
+        self.reason = intern_str(reason)
+        self.startTime = intern_str(startTime)
+        self.containers = containers if containers is not None else []
+        self.deleted = deleted
+
+
+class Node(Model):
+
+    __slots__ = ("name", "labels", "status", "pods", "usage")
+    _optional = ("usage",)
+
+    def __init__(
+        self,
+        name: str,
+        labels: dict,
+        status: dict,
+        pods: dict = None,
+        usage: Optional[dict] = None,
+    ):
+        self.name = name
+        self.labels = labels
+        self.status = status
+        self.pods = pods if pods is not None else {}
+        self.usage = usage
+
+
+def to_json(obj):
+    """Convert model objects for json.dumps(..., default=to_json)."""
+    if isinstance(obj, Model):
+        return obj.to_dict()
+    raise TypeError(
+        "Object of type {} is not JSON serializable".format(obj.__class__.__name__)
+    )
@@ -0,0 +1,186 @@
+"""Opt-in sampling profiler for the gevent runtime (served on /debug/profile).
+
+A real OS thread (not a greenlet, i.e. it also runs while a greenlet blocks the hub)
+samples the stacks of all threads at a fixed interval, the stack of the main thread is
+the one of the greenlet running at that moment. Samples are counted per stack in the
+"collapsed" format of flamegraph.pl and speedscope (one line per stack, frames
+separated by ";" and the number of samples), rooted at the greenlet's name.
+
+Greenlet switches are traced to account the time every greenlet ran between two
+switches: a long maximum run means the greenlet blocked the hub (and every other
+greenlet) for that long, wall time beyond CPU time means it waited in a blocking call.
+Nothing is installed while not profiling.
+"""
+import collections
+import os
+import sys
+import time
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import greenlet
+from gevent import monkey
+
+# 200 Hz, at most one sample per GIL switch interval anyway
+SAMPLE_INTERVAL_SECONDS = 0.005
+MAX_PROFILE_SECONDS = 300
+
+# the originals, not the gevent versions if monkey patched
+_allocate_lock = monkey.get_original("_thread", "allocate_lock")
+_start_new_thread = monkey.get_original("_thread", "start_new_thread")
+_get_ident = monkey.get_original("_thread", "get_ident")
+_sleep = monkey.get_original("time", "sleep")
+
+_path_prefixes = sorted(
+    (os.path.join(path, "") for path in sys.path if path), key=len, reverse=True
+)
+
+
+def short_filename(filename: str) -> str:
+    """Return the file name relative to sys.path, e.g. kube_ops_view/delta.py."""
+    for prefix in _path_prefixes:
+        if filename.startswith(prefix):
+            return filename[len(prefix) :]
+    return filename
+
+
+def greenlet_name(glet) -> str:
+    """Return the name of the function the greenlet runs (e.g. update_clusters)."""
+    if glet.parent is None:
+        return "main"
+    run = getattr(glet, "_run", None) or getattr(glet, "run", None)
+    # functools.partial
+    func = getattr(run, "func", run)
+    return getattr(func, "__qualname__", None) or type(glet).__name__
+
+
+class Profiler:
+
+    """Stack samples and per-greenlet run times between start() and stop()."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.samples: collections.Counter = collections.Counter()
+        # name -> [runs, seconds, CPU seconds, max. seconds of a single run]
+        self.greenlets: Dict[str, list] = collections.defaultdict(
+            lambda: [0, 0.0, 0.0, 0.0]
+        )
+        self.started: Optional[float] = None
+        self.stopped: Optional[float] = None
+        self._running = False
+        # held by the sampling thread while running
+        self._sampling = _allocate_lock()
+        self._labels: Dict[object, str] = {}
+        self._thread_id: Optional[int] = None
+        # name of the greenlet running in the profiled thread
+        self._current: Optional[str] = None
+        self._switched = (0.0, 0.0)
+        self._previous_trace = None
+
+    def start(self):
+        """Start sampling and tracing greenlet switches of the calling thread."""
+        self._thread_id = _get_ident()
+        self._current = greenlet_name(greenlet.getcurrent())
+        self._switched = (time.perf_counter(), time.thread_time())
+        self._previous_trace = greenlet.settrace(self._trace)
+        self._running = True
+        self.started = time.time()
+        self._sampling.acquire()
+        _start_new_thread(self._sample_periodically, ())
+
+    def stop(self):
+        """Stop sampling, has to be called in the same thread as start()."""
+        self._running = False
+        greenlet.settrace(self._previous_trace)
+        # wait for the last sample (blocks the hub for at most one interval)
+        self._sampling.acquire()
+        self._sampling.release()
+        self._account()
+        self.stopped = time.time()
+
+    def _account(self):
+        """Account the time since the last switch to the current greenlet."""
+        now, cpu = time.perf_counter(), time.thread_time()
+        seconds = now - self._switched[0]
+        stats = self.greenlets[self._current]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += cpu - self._switched[1]
+        stats[3] = max(stats[3], seconds)
+        self._switched = (now, cpu)
+
+    def _trace(self, event: str, args):
+        if event in ("switch", "throw"):
+            # the name while running, gevent clears the function when done
+            origin, target = args
+            self._account()
+            self._current = greenlet_name(target)
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = "{} ({}:{})".format(
+                code.co_name, short_filename(code.co_filename), code.co_firstlineno
+            )
+            self._labels[code] = label
+        return label
+
+    def sample(self):
+        own_thread_id = _get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if thread_id == self._thread_id:
+                stack.append(self._current)
+            else:
+                stack.append("thread-{}".format(thread_id))
+            self.samples[tuple(reversed(stack))] += 1
+
+    def _sample_periodically(self):
+        try:
+            while self._running:
+                self.sample()
+                _sleep(self.interval)
+        finally:
+            self._sampling.release()
+
+    def collapsed(self) -> str:
+        """Return the stack samples in the collapsed format (most frequent first)."""
+        return "".join(
+            "{} {}\n".format(";".join(stack), count)
+            for stack, count in self.samples.most_common()
+        )
+
+    def greenlet_stats(self) -> List[dict]:
+        """Return the run times per greenlet name, longest total time first."""
+        stats: List[Tuple[str, list]] = sorted(
+            self.greenlets.items(), key=lambda item: item[1][1], reverse=True
+        )
+        return [
+            {
+                "name": name,
+                "runs": runs,
+                "seconds": round(seconds, 6),
+                "cpu_seconds": round(cpu_seconds, 6),
+                "max_run_seconds": round(max_seconds, 6),
+            }
+            for name, (runs, seconds, cpu_seconds, max_seconds) in stats
+        ]
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            # 0 if not started
+            "seconds": round((self.stopped or now) - (self.started or now), 3),
+            "interval": self.interval,
+            "samples": sum(self.samples.values()),
+            "greenlets": self.greenlet_stats(),
+        }
@@ -0,0 +1,39 @@
+"""Partitioning of the cluster queries across replicas.
+
+Every replica registers itself with a heartbeat and assigns each cluster to one of
+the live replicas by rendezvous hashing, i.e. all replicas agree on the assignment
+and only the clusters of joining/leaving replicas move. A replica only queries
+clusters for which it holds the lease, the lease guards against two replicas
+writing the same cluster while the assignment changes.
+"""
+import socket
+from typing import Dict
+from typing import Iterable
+from typing import List
+
+from .stores import generate_token
+from .utils import stable_hash
+
+# replicas without heartbeat for this long are considered gone
+REPLICA_TTL_SECONDS = 10
+# leases of clusters are renewed on every iteration of the update loop
+LEASE_SECONDS = 10
+
+
+def generate_replica_id() -> str:
+    # the host name is the pod name on Kubernetes
+    return "{}-{}".format(socket.gethostname(), generate_token(6))
+
+
+def assign_clusters(
+    cluster_ids: Iterable[str], replica_ids: List[str]
+) -> Dict[str, str]:
+    """Return the replica ID for each cluster ID (replica with the highest weight)."""
+    if not replica_ids:
+        return {}
+    return {
+        cluster_id: max(
+            replica_ids, key=lambda replica_id: stable_hash(replica_id, cluster_id)
+        )
+        for cluster_id in cluster_ids
+    }
@@ -1,19 +1,252 @@
+import collections
+import contextlib
 import json
 import logging
+import os
 import random
 import string
+import threading
 import time
+import zlib
 from abc import ABC
 from abc import abstractmethod
 from queue import Queue
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
 from typing import Set
+from typing import Tuple
 
+import gevent
 import redis
-from redlock import Redlock
+
+from .metrics import STORE_DURATION
+from .metrics import timed
+from .model import to_json
+from .utils import paused_gc
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
 
 logger = logging.getLogger(__name__)
 
 ONE_YEAR = 3600 * 24 * 365
+# connections shared by all greenlets (updater, SSE listener and web requests)
+REDIS_MAX_CONNECTIONS = 20
+
+# number of events kept to replay them to reconnecting clients
+EVENT_LOG_SIZE = 1000
+# maximum time a Redis stream read blocks (the connection is checked in between)
+EVENT_READ_BLOCK_MILLISECONDS = 5000
+
+# cluster data older than this is not loaded from the snapshot file
+SNAPSHOT_MAX_AGE_SECONDS = 24 * 3600
+
+# KEYS[1]: lease key, ARGV[1]: replica ID, ARGV[2]: lease time in milliseconds
+ACQUIRE_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return redis.call("set", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) and 1 or 0
+"""
+RELEASE_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def dumps(value) -> str:
+    """Encode the value as compact JSON (including model objects)."""
+    return json.dumps(value, separators=(",", ":"), default=to_json)
+
+
+class Codec:
+
+    """Encoding of cluster data in Redis: JSON or msgpack, optionally zlib compressed.
+
+    The name is part of the Redis key (except for plain JSON) and recorded with each
+    write, i.e. replicas using different formats can coexist.
+    """
+
+    FORMATS = ("json", "msgpack")
+
+    def __init__(self, format: str = "json", compress: bool = False):
+        if format not in self.FORMATS:
+            raise ValueError("Unsupported format {}".format(format))
+        if format == "msgpack" and msgpack is None:
+            raise ValueError("The msgpack format requires the msgpack package")
+        self.format = format
+        self.compress = compress
+        self.name = format + ("+zlib" if compress else "")
+
+    @classmethod
+    def from_name(cls, name: str):
+        """Return the codec of the given name, e.g. "msgpack+zlib"."""
+        format, _, compression = name.partition("+")
+        return cls(format, compression == "zlib")
+
+    def dumps(self, value) -> bytes:
+        if self.format == "msgpack":
+            data = msgpack.packb(value, default=to_json)
+        else:
+            data = dumps(value).encode("utf-8")
+        if self.compress:
+            # fastest level, still shrinks snapshots about 8x
+            data = zlib.compress(data, 1)
+        return data
+
+    def loads(self, data: bytes):
+        if self.compress:
+            data = zlib.decompress(data)
+        with paused_gc():
+            if self.format == "msgpack":
+                return msgpack.unpackb(data, raw=False)
+            return json.loads(data)
+
+
+# hash fields of sharded cluster data: one per node plus the unassigned pods and the rest
+NODE_FIELD_PREFIX = "node:"
+UNASSIGNED_PODS_FIELD = "unassigned_pods"
+META_FIELD = "meta"
+
+
+def event_id_key(event_id: str) -> Tuple[int, ...]:
+    """Return the sort key of an event ID ("<milliseconds>-<sequence>" as in Redis streams).
+
+    Raises ValueError for invalid IDs.
+    """
+    return tuple(int(part) for part in event_id.split("-"))
+
+
+def _replay_window(
+    events: List[tuple], after_id: str, oldest_id: Optional[str], newest_id: str
+) -> Optional[List[tuple]]:
+    after = event_id_key(after_id)
+    if oldest_id is None or after < event_id_key(oldest_id):
+        # events were dropped from the log already (or the log was reset)
+        return None
+    if after > event_id_key(newest_id):
+        # ID of another log, e.g. before a restart
+        return None
+    return events
+
+
+def split_cluster_data(data: dict) -> Dict[str, Any]:
+    """Split cluster data into hash fields, i.e. a changed pod only changes its node's field."""
+    fields: Dict[str, Any] = {
+        META_FIELD: {
+            key: value
+            for key, value in data.items()
+            if key not in ("nodes", UNASSIGNED_PODS_FIELD)
+        },
+        UNASSIGNED_PODS_FIELD: data.get(UNASSIGNED_PODS_FIELD, {}),
+    }
+    for name, node in data.get("nodes", {}).items():
+        fields[NODE_FIELD_PREFIX + name] = node
+    return fields
+
+
+def join_cluster_data(fields: Dict[str, Any]) -> dict:
+    """Reassemble cluster data from its (decoded) hash fields."""
+    data = dict(fields.get(META_FIELD, {}))
+    data["nodes"] = {
+        field[len(NODE_FIELD_PREFIX) :]: value
+        for field, value in fields.items()
+        if field.startswith(NODE_FIELD_PREFIX)
+    }
+    data[UNASSIGNED_PODS_FIELD] = fields.get(UNASSIGNED_PODS_FIELD, {})
+    return data
+
+
+def join_encoded_cluster_data(fields: Dict[str, bytes]) -> bytes:
+    """Reassemble cluster data as JSON from JSON encoded hash fields without decoding them."""
+    meta = fields.get(META_FIELD, b"{}")
+    parts = [meta[:-1]]
+    if len(meta) > 2:
+        parts.append(b",")
+    parts.append(b'"nodes":{')
+    parts.append(
+        b",".join(
+            dumps(field[len(NODE_FIELD_PREFIX) :]).encode("utf-8") + b":" + value
+            for field, value in fields.items()
+            if field.startswith(NODE_FIELD_PREFIX)
+        )
+    )
+    parts.append(b'},"unassigned_pods":')
+    parts.append(fields.get(UNASSIGNED_PODS_FIELD, b"{}"))
+    parts.append(b"}")
+    return b"".join(parts)
+
+
+class CachedClusterData:
+
+    """Cluster data read from (or written to) Redis with its version, decoded/encoded lazily.
+
+    The data is either one value (data) or hash fields as written by split_cluster_data().
+    """
+
+    def __init__(
+        self,
+        version: Optional[int],
+        codec: Codec,
+        data: bytes = None,
+        value=None,
+        fields: Dict[str, bytes] = None,
+    ):
+        self.version = version
+        self.codec = codec
+        self._data = data
+        self._fields = fields
+        self._value = value
+        self._encoded: Optional[bytes] = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            if self._fields is not None:
+                with paused_gc():
+                    self._value = join_cluster_data(
+                        {
+                            field: self.codec.loads(data)
+                            for field, data in self._fields.items()
+                        }
+                    )
+            else:
+                self._value = self.codec.loads(self._data)
+        return self._value
+
+    @property
+    def encoded(self) -> bytes:
+        """Cluster data as encoded JSON (for SSE clients)."""
+        if self._encoded is None:
+            if self.codec.name != "json":
+                self._encoded = dumps(self.value).encode("utf-8")
+            elif self._fields is not None:
+                self._encoded = join_encoded_cluster_data(self._fields)
+            elif self._data is not None:
+                self._encoded = self._data
+            else:
+                self._encoded = dumps(self.value).encode("utf-8")
+        return self._encoded
+
+
+def _counting_connection_class(connection_class, store):
+    """Return a subclass of the Redis connection class which counts the store's round trips."""
+
+    class CountingConnection(connection_class):
+        def send_packed_command(self, command, check_health=True):
+            store.round_trips += 1
+            return super().send_packed_command(command, check_health)
+
+    return CountingConnection
 
 
 def generate_token(n: int):
@@ -53,110 +286,607 @@ class AbstractStore(ABC):
     def get(self, key):
         return None
 
+    @abstractmethod
+    def get_encoded(self, key) -> Optional[bytes]:
+        """Return the value as UTF-8 encoded JSON (None if not set)."""
+        return None
+
     def get_cluster_ids(self):
         return self.get("cluster-ids") or []
 
     def set_cluster_ids(self, cluster_ids: Set[str]):
         self.set("cluster-ids", list(sorted(cluster_ids)))
 
+    @timed(STORE_DURATION, "get_cluster_status")
     def get_cluster_status(self, cluster_id: str) -> dict:
         return self.get("clusters:{}:status".format(cluster_id)) or {}
 
+    @timed(STORE_DURATION, "set_cluster_status")
     def set_cluster_status(self, cluster_id: str, status: dict):
         self.set("clusters:{}:status".format(cluster_id), status)
 
+    @timed(STORE_DURATION, "get_cluster_statuses")
+    def get_cluster_statuses(self, cluster_ids: Iterable[str]) -> Dict[str, dict]:
+        # not via get_cluster_status, i.e. observed once
+        return {
+            cluster_id: self.get("clusters:{}:status".format(cluster_id)) or {}
+            for cluster_id in cluster_ids
+        }
+
+    @timed(STORE_DURATION, "get_cluster_data")
     def get_cluster_data(self, cluster_id: str) -> dict:
         return self.get("clusters:{}:data".format(cluster_id)) or {}
 
+    @timed(STORE_DURATION, "set_cluster_data")
     def set_cluster_data(self, cluster_id: str, data: dict):
         self.set("clusters:{}:data".format(cluster_id), data)
 
+    @timed(STORE_DURATION, "get_cluster_data_encoded")
+    def get_cluster_data_encoded(self, cluster_id: str) -> Optional[bytes]:
+        """Return the cluster data as encoded JSON, e.g. to send it to new clients as-is."""
+        return self.get_encoded("clusters:{}:data".format(cluster_id))
 
-class MemoryStore(AbstractStore):
+    @abstractmethod
+    def publish(self, event_type: str, event_data: dict):
+        """Append the event to the event log (with a new ID) and send it to all listeners."""
 
-    """Memory-only backend, mostly useful for local debugging."""
+    @abstractmethod
+    def listen(self, after_id: str = None) -> Iterator[Tuple[str, str, dict]]:
+        """Yield (event ID, event type, event data) of new events (after the given ID)."""
 
-    def __init__(self):
-        self._data = {}
-        self._queues = []
-        self._screen_tokens = {}
+    @abstractmethod
+    def read_events(self, after_id: str) -> Optional[List[Tuple[str, str, dict]]]:
+        """Return the logged events after the given ID, None if some are not logged anymore."""
 
-    def set(self, key, value):
-        self._data[key] = value
+    @contextlib.contextmanager
+    def batch(self):
+        """Send writes and events of the calling greenlet at the end of the block (if supported)."""
+        yield
 
-    def get(self, key):
-        return self._data.get(key)
+    def stats(self) -> dict:
+        return {}
+
+    def save_snapshot(self):
+        """Persist the cluster data for a warm start (if supported)."""
+        return None
+
+
+class MemoryStore(AbstractStore):
 
-    def acquire_lock(self):
-        # no-op for memory store
-        return "fake-lock"
+    """Memory-only backend, mostly useful for local debugging.
+
+    Safe to use from several threads (asyncio runtime) and greenlets.
+    """
+
+    def __init__(self, snapshot_path: str = None):
+        # guards all state (a gevent lock if monkey patched)
+        self._lock = threading.RLock()
+        self._data: Dict[str, Any] = {}
+        # encoded JSON by key, built on first request and dropped when the value changes
+        self._encoded: Dict[str, bytes] = {}
+        # one queue per listener
+        self._queues: List[Queue] = []
+        self._screen_tokens: Dict[str, dict] = {}
+        # cluster ID => last time SSE clients were subscribed to it
+        self._viewed: Dict[str, float] = {}
+        # IDs start with the creation time, i.e. IDs from before a restart are not replayed
+        self._event_id_prefix = int(time.time() * 1000)
+        self._event_sequence = 0
+        self._events: collections.deque = collections.deque(maxlen=EVENT_LOG_SIZE)
+        # file to keep the clusters across restarts, viewers get them before the first query
+        self.snapshot_path = snapshot_path
+        if snapshot_path:
+            self.load_snapshot()
 
-    def release_lock(self, lock):
-        # no op for memory store
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._encoded.pop(key, None)
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key)
+
+    @timed(STORE_DURATION, "get_cluster_statuses")
+    def get_cluster_statuses(self, cluster_ids: Iterable[str]) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                cluster_id: self._data.get("clusters:{}:status".format(cluster_id))
+                or {}
+                for cluster_id in cluster_ids
+            }
+
+    def get_encoded(self, key):
+        with self._lock:
+            encoded = self._encoded.get(key)
+            if encoded is None:
+                value = self._data.get(key)
+                if value is None:
+                    return None
+                # while locked, i.e. the value cannot change before it is cached
+                encoded = self._encoded[key] = dumps(value).encode("utf-8")
+            return encoded
+
+    def register_replica(self, replica_id: str, ttl: float) -> List[str]:
+        # there are no other replicas
+        return [replica_id]
+
+    def acquire_leases(
+        self, replica_id: str, cluster_ids: Iterable[str], ttl: float
+    ) -> Set[str]:
+        return set(cluster_ids)
+
+    def release_leases(self, replica_id: str, cluster_ids: Iterable[str]):
         pass
 
+    def touch_viewed_clusters(self, cluster_ids: Iterable[str]):
+        now = time.time()
+        with self._lock:
+            for cluster_id in cluster_ids:
+                self._viewed[cluster_id] = now
+
+    def get_viewed_clusters(self, ttl: float) -> Set[str]:
+        min_time = time.time() - ttl
+        with self._lock:
+            return {
+                cluster_id
+                for cluster_id, viewed in self._viewed.items()
+                if viewed >= min_time
+            }
+
+    @timed(STORE_DURATION, "publish")
     def publish(self, event_type, event_data):
-        for queue in self._queues:
-            queue.put((event_type, event_data))
-
-    def listen(self):
-        queue = Queue()
-        self._queues.append(queue)
+        with self._lock:
+            self._event_sequence += 1
+            event = (
+                "{}-{}".format(self._event_id_prefix, self._event_sequence),
+                event_type,
+                event_data,
+            )
+            self._events.append(event)
+            for queue in self._queues:
+                queue.put(event)
+
+    def listen(self, after_id: str = None):
+        queue: Queue = Queue()
+        with self._lock:
+            # no event is published in between
+            if after_id:
+                for event in self.read_events(after_id) or []:
+                    queue.put(event)
+            self._queues.append(queue)
         try:
             while True:
                 item = queue.get()
                 yield item
         finally:
-            self._queues.remove(queue)
+            with self._lock:
+                self._queues.remove(queue)
+
+    def save_snapshot(self):
+        """Write the IDs, statuses and data of all clusters to the snapshot file."""
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            clusters = {
+                cluster_id: {
+                    "status": self.get_cluster_status(cluster_id),
+                    "data": self.get_cluster_data(cluster_id),
+                }
+                for cluster_id in self.get_cluster_ids()
+            }
+        codec = Codec("msgpack" if msgpack else "json", compress=True)
+        data = codec.dumps({"saved": time.time(), "clusters": clusters})
+        # the codec name is the first line to decode snapshots written with other codecs
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "wb") as fd:
+            fd.write(codec.name.encode("utf-8") + b"\n" + data)
+        os.replace(temporary_path, self.snapshot_path)
+
+    def load_snapshot(self):
+        """Load clusters from the snapshot file, their status is flagged as stale."""
+        try:
+            with open(self.snapshot_path, "rb") as fd:
+                codec_name, data = fd.read().split(b"\n", 1)
+            snapshot = Codec.from_name(codec_name.decode("utf-8")).loads(data)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(
+                "Could not load snapshot {}: {}".format(self.snapshot_path, e)
+            )
+            return
+        clusters = {}
+        for cluster_id, cluster in snapshot["clusters"].items():
+            last_query_time = cluster["status"].get("last_query_time", 0)
+            if last_query_time < time.time() - SNAPSHOT_MAX_AGE_SECONDS:
+                continue
+            # shown (marked) by the frontend until the cluster is queried again
+            self.set_cluster_status(cluster_id, dict(cluster["status"], stale=True))
+            if cluster["data"]:
+                self.set_cluster_data(cluster_id, cluster["data"])
+            clusters[cluster_id] = cluster
+        self.set_cluster_ids(set(clusters))
+        logger.info(
+            "Loaded {} clusters from snapshot {} (saved {} seconds ago)".format(
+                len(clusters),
+                self.snapshot_path,
+                round(time.time() - snapshot["saved"]),
+            )
+        )
+
+    def save_snapshots(self, interval: float):
+        """Save the snapshot every interval seconds (run in a greenlet)."""
+        while True:
+            gevent.sleep(interval)
+            try:
+                self.save_snapshot()
+            except Exception as e:
+                logger.exception(
+                    "Failed to save snapshot {}: {}".format(self.snapshot_path, e)
+                )
+
+    def read_events(self, after_id: str):
+        with self._lock:
+            if not self._events:
+                return None
+            after = event_id_key(after_id)
+            events = [
+                event for event in self._events if event_id_key(event[0]) > after
+            ]
+            oldest_id = self._events[0][0]
+            if len(self._events) < EVENT_LOG_SIZE:
+                # nothing dropped yet, the first event follows the (never logged) start ID
+                oldest_id = "{}-0".format(self._event_id_prefix)
+            newest_id = self._events[-1][0]
+        return _replay_window(events, after_id, oldest_id, newest_id)
 
     def create_screen_token(self):
         data = generate_token_data()
         token = data["token"]
-        self._screen_tokens[token] = data
+        with self._lock:
+            self._screen_tokens[token] = data
         return token
 
     def redeem_screen_token(self, token: str, remote_addr: str):
-        data = self._screen_tokens.get(token)
-        data = check_token(token, remote_addr, data)
-        self._screen_tokens[token] = data
+        with self._lock:
+            data = self._screen_tokens.get(token)
+            data = check_token(token, remote_addr, data)
+            self._screen_tokens[token] = data
 
 
 class RedisStore(AbstractStore):
 
     """Redis-based backend for deployments with replicas > 1."""
 
-    def __init__(self, url: str):
+    def __init__(
+        self,
+        url: str,
+        codec: Codec = None,
+        max_connections: int = REDIS_MAX_CONNECTIONS,
+    ):
         logger.info("Connecting to Redis on {}..".format(url))
-        self._redis = redis.StrictRedis.from_url(url)
-        self._redlock = Redlock([url])
+        # greenlets wait for a free connection instead of failing
+        pool = redis.BlockingConnectionPool.from_url(
+            url, max_connections=max_connections
+        )
+        pool.connection_class = _counting_connection_class(pool.connection_class, self)
+        self._redis = redis.StrictRedis(connection_pool=pool)
+        self._acquire_lease = self._redis.register_script(ACQUIRE_LEASE_SCRIPT)
+        self._release_lease = self._redis.register_script(RELEASE_LEASE_SCRIPT)
+        # number of requests sent to Redis (a pipeline is one round trip)
+        self.round_trips = 0
+        # (greenlet, pipeline, callbacks) of the active batch
+        self._batch: Optional[tuple] = None
+        self._codec = codec or Codec()
+        # cluster ID => CachedClusterData (read-through cache, checked against the version)
+        self._cluster_data: dict = {}
+        # cluster ID => hash field => CRC32 of the encoded field as last written by this process
+        self._fingerprints: Dict[str, Dict[str, int]] = {}
+
+    @contextlib.contextmanager
+    def batch(self):
+        if self._batch is not None:
+            # nested or used by another greenlet, writes go to the active batch or directly
+            yield
+            return
+        pipeline = self._redis.pipeline()
+        # (index of the command, function called with its result) after executing
+        callbacks: List[Tuple[int, Callable]] = []
+        self._batch = (gevent.getcurrent(), pipeline, callbacks)
+        try:
+            yield
+        except Exception:
+            pipeline.reset()
+            raise
+        finally:
+            self._batch = None
+        # pipelines are always true
+        if len(pipeline):
+            with STORE_DURATION.labels("batch").time():
+                results = pipeline.execute()
+            for index, callback in callbacks:
+                callback(results[index])
+
+    def _batch_pipeline(self):
+        """Return the pipeline of the calling greenlet's batch, if any."""
+        if self._batch is not None and self._batch[0] is gevent.getcurrent():
+            return self._batch[1]
+        return None
+
+    def _execute(self, pipeline, callback: Callable):
+        """Execute the pipeline (unless part of the batch) and call back with the result of its last command."""
+        if self._batch is not None and pipeline is self._batch[1]:
+            # i.e. only once written
+            self._batch[2].append((len(pipeline) - 1, callback))
+        else:
+            callback(pipeline.execute()[-1])
+
+    def stats(self) -> dict:
+        return {"redis_round_trips": self.round_trips}
 
     def set(self, key, value):
-        self._redis.set(key, json.dumps(value, separators=(",", ":")))
+        (self._batch_pipeline() or self._redis).set(key, dumps(value))
 
     def get(self, key):
         value = self._redis.get(key)
         if value:
             return json.loads(value.decode("utf-8"))
 
-    def acquire_lock(self):
-        return self._redlock.lock("update", 10000)
+    @timed(STORE_DURATION, "get_cluster_statuses")
+    def get_cluster_statuses(self, cluster_ids: Iterable[str]) -> Dict[str, dict]:
+        cluster_ids = list(cluster_ids)
+        if not cluster_ids:
+            return {}
+        values = self._redis.mget(
+            ["clusters:{}:status".format(cluster_id) for cluster_id in cluster_ids]
+        )
+        return {
+            cluster_id: json.loads(value.decode("utf-8")) if value else {}
+            for cluster_id, value in zip(cluster_ids, values)
+        }
+
+    def get_encoded(self, key):
+        # values are stored as encoded JSON already
+        return self._redis.get(key) or None
+
+    def _cluster_data_key(self, cluster_id: str, codec_name: str):
+        # single value as written by older versions, only read as fallback
+        if codec_name == "json":
+            return "clusters:{}:data".format(cluster_id)
+        return "clusters:{}:data:{}".format(cluster_id, codec_name)
+
+    def _cluster_shards_key(self, cluster_id: str, codec_name: str):
+        if codec_name == "json":
+            return "clusters:{}:shards".format(cluster_id)
+        return "clusters:{}:shards:{}".format(cluster_id, codec_name)
+
+    def _get_data_version(self, cluster_id: str) -> Tuple[Optional[int], Optional[str]]:
+        """Return the version of the cluster data and the name of the codec which wrote it."""
+        version, codec_name = self._redis.mget(
+            [
+                "clusters:{}:data-version".format(cluster_id),
+                "clusters:{}:data-codec".format(cluster_id),
+            ]
+        )
+        return (
+            int(version) if version is not None else None,
+            codec_name.decode("utf-8") if codec_name is not None else None,
+        )
 
-    def release_lock(self, lock):
-        self._redlock.unlock(lock)
+    @timed(STORE_DURATION, "set_cluster_data")
+    def set_cluster_data(self, cluster_id: str, data: dict):
+        """Write the cluster data as hash with one field per node, only changed fields are written.
+
+        Fields equal to the last data written by this process are not even encoded,
+        others are compared by the CRC32 of their encoded value. If another replica
+        wrote in between, all fields are replaced.
+        """
+        key = self._cluster_shards_key(cluster_id, self._codec.name)
+        version_key = "clusters:{}:data-version".format(cluster_id)
+        version, codec_name = self._get_data_version(cluster_id)
+        cached = self._cluster_data.get(cluster_id)
+        fingerprints = self._fingerprints.get(cluster_id)
+        if not cached or cached.version != version or fingerprints is None:
+            previous_fields: Dict[str, Any] = {}
+            fingerprints = {}
+        else:
+            previous_fields = split_cluster_data(cached.value)
+        fields = split_cluster_data(data)
+        changed = {}
+        new_fingerprints = {}
+        for field, value in fields.items():
+            if field in fingerprints and previous_fields.get(field) == value:
+                new_fingerprints[field] = fingerprints[field]
+                continue
+            encoded = self._codec.dumps(value)
+            fingerprint = zlib.crc32(encoded)
+            if fingerprints.get(field) != fingerprint:
+                changed[field] = encoded
+            new_fingerprints[field] = fingerprint
+        removed = [field for field in fingerprints if field not in fields]
+
+        pipeline = self._batch_pipeline() or self._redis.pipeline()
+        if not fingerprints:
+            pipeline.delete(key)
+        if codec_name is not None and codec_name != self._codec.name:
+            # written by a replica using another format, readers use ours from now on
+            pipeline.delete(self._cluster_shards_key(cluster_id, codec_name))
+        if changed:
+            pipeline.hset(key, mapping=changed)
+        if removed:
+            pipeline.hdel(key, *removed)
+        # readers decode the data in the format of the last writer
+        pipeline.set("clusters:{}:data-codec".format(cluster_id), self._codec.name)
+        # every write increments the version, readers only fetch data of new versions
+        pipeline.incr(version_key)
+
+        def written(version: int):
+            self._fingerprints[cluster_id] = new_fingerprints
+            self._cluster_data[cluster_id] = CachedClusterData(
+                version, self._codec, value=data
+            )
+
+        self._execute(pipeline, written)
+        logger.debug(
+            "Wrote {} of {} fields of cluster {}".format(
+                len(changed), len(fields), cluster_id
+            )
+        )
 
+    def _get_cached_cluster_data(self, cluster_id: str) -> Optional[CachedClusterData]:
+        version, codec_name = self._get_data_version(cluster_id)
+        cached = self._cluster_data.get(cluster_id)
+        if cached and version is not None and cached.version == version:
+            return cached
+        # not written by this process, fingerprints are unknown
+        self._fingerprints.pop(cluster_id, None)
+        # decoded with the format of the replica which wrote the current version
+        codec = Codec.from_name(codec_name) if codec_name else self._codec
+        fields = self._redis.hgetall(self._cluster_shards_key(cluster_id, codec.name))
+        if fields:
+            cached = CachedClusterData(
+                version,
+                codec,
+                fields={field.decode("utf-8"): data for field, data in fields.items()},
+            )
+        elif codec_name is None:
+            # written by an older version (without recording the format)
+            cached = self._get_legacy_cluster_data(cluster_id, version)
+        else:
+            cached = None
+        if cached is None:
+            self._cluster_data.pop(cluster_id, None)
+            return None
+        if version is not None:
+            self._cluster_data[cluster_id] = cached
+        return cached
+
+    def _get_legacy_cluster_data(
+        self, cluster_id: str, version: Optional[int]
+    ) -> Optional[CachedClusterData]:
+        """Read cluster data written as single value by a replica of an older version."""
+        codec = self._codec
+        data = self._redis.get(self._cluster_data_key(cluster_id, codec.name))
+        if data is None and codec.name != "json":
+            codec = Codec()
+            data = self._redis.get(self._cluster_data_key(cluster_id, codec.name))
+        if data is None:
+            return None
+        return CachedClusterData(version, codec, data=data)
+
+    @timed(STORE_DURATION, "get_cluster_data")
+    def get_cluster_data(self, cluster_id: str) -> dict:
+        cached = self._get_cached_cluster_data(cluster_id)
+        return cached.value if cached else {}
+
+    @timed(STORE_DURATION, "get_cluster_data_encoded")
+    def get_cluster_data_encoded(self, cluster_id: str) -> Optional[bytes]:
+        cached = self._get_cached_cluster_data(cluster_id)
+        return cached.encoded if cached else None
+
+    def register_replica(self, replica_id: str, ttl: float) -> List[str]:
+        """Send a heartbeat for the replica and return the IDs of all live replicas."""
+        now = time.time()
+        pipeline = self._redis.pipeline()
+        pipeline.zadd("replicas", {replica_id: now})
+        pipeline.zremrangebyscore("replicas", "-inf", now - ttl)
+        pipeline.zrange("replicas", 0, -1)
+        replica_ids = pipeline.execute()[-1]
+        return [replica_id.decode("utf-8") for replica_id in replica_ids]
+
+    def acquire_leases(
+        self, replica_id: str, cluster_ids: Iterable[str], ttl: float
+    ) -> Set[str]:
+        """Acquire or renew the leases of the given clusters, return the IDs of the leased clusters."""
+        cluster_ids = list(cluster_ids)
+        pipeline = self._redis.pipeline(transaction=False)
+        for cluster_id in cluster_ids:
+            self._acquire_lease(
+                keys=["clusters:{}:lease".format(cluster_id)],
+                args=[replica_id, int(ttl * 1000)],
+                client=pipeline,
+            )
+        return {
+            cluster_id
+            for cluster_id, acquired in zip(cluster_ids, pipeline.execute())
+            if acquired
+        }
+
+    def release_leases(self, replica_id: str, cluster_ids: Iterable[str]):
+        """Release the leases of the given clusters (if held by the replica)."""
+        pipeline = self._redis.pipeline(transaction=False)
+        for cluster_id in cluster_ids:
+            self._release_lease(
+                keys=["clusters:{}:lease".format(cluster_id)],
+                args=[replica_id],
+                client=pipeline,
+            )
+        if len(pipeline):
+            pipeline.execute()
+
+    def touch_viewed_clusters(self, cluster_ids: Iterable[str]):
+        """Record that SSE clients (of this replica) are subscribed to the clusters now."""
+        now = time.time()
+        self._redis.zadd(
+            "viewed-clusters", {cluster_id: now for cluster_id in cluster_ids}
+        )
+
+    def get_viewed_clusters(self, ttl: float) -> Set[str]:
+        """Return the IDs of clusters with SSE clients (on any replica) within ttl seconds."""
+        now = time.time()
+        pipeline = self._redis.pipeline()
+        pipeline.zremrangebyscore("viewed-clusters", "-inf", now - ttl)
+        pipeline.zrange("viewed-clusters", 0, -1)
+        cluster_ids = pipeline.execute()[-1]
+        return {cluster_id.decode("utf-8") for cluster_id in cluster_ids}
+
+    @timed(STORE_DURATION, "publish")
     def publish(self, event_type, event_data):
-        self._redis.publish(
-            "default",
-            "{}:{}".format(event_type, json.dumps(event_data, separators=(",", ":"))),
+        # capped stream, IDs are assigned by Redis
+        (self._batch_pipeline() or self._redis).xadd(
+            "events",
+            {"type": event_type, "data": dumps(event_data)},
+            maxlen=EVENT_LOG_SIZE,
+            approximate=True,
         )
 
-    def listen(self):
-        p = self._redis.pubsub()
-        p.subscribe("default")
-        for message in p.listen():
-            if message["type"] == "message":
-                event_type, data = message["data"].decode("utf-8").split(":", 1)
-                yield (event_type, json.loads(data))
+    def _decode_event(self, entry) -> Tuple[str, str, dict]:
+        event_id, fields = entry
+        return (
+            event_id.decode("utf-8"),
+            fields[b"type"].decode("utf-8"),
+            json.loads(fields[b"data"].decode("utf-8")),
+        )
+
+    def listen(self, after_id: str = None):
+        last_id = after_id or "$"
+        while True:
+            response = self._redis.xread(
+                {"events": last_id}, block=EVENT_READ_BLOCK_MILLISECONDS
+            )
+            for _stream, entries in response or []:
+                for entry in entries:
+                    event = self._decode_event(entry)
+                    last_id = event[0]
+                    yield event
+
+    def read_events(self, after_id: str):
+        milliseconds, sequence = (event_id_key(after_id) + (0,))[:2]
+        pipeline = self._redis.pipeline(transaction=False)
+        pipeline.xrange("events", count=1)
+        pipeline.xrevrange("events", count=1)
+        # the exclusive start "(" needs Redis 6.2
+        pipeline.xrange("events", min="{}-{}".format(milliseconds, sequence + 1))
+        oldest, newest, entries = pipeline.execute()
+        if not oldest:
+            return None
+        return _replay_window(
+            [self._decode_event(entry) for entry in entries],
+            after_id,
+            oldest[0][0].decode("utf-8"),
+            newest[0][0].decode("utf-8"),
+        )
 
     def create_screen_token(self):
         """Generate a new screen token and store it in Redis."""
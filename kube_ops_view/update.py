@@ -1,32 +1,79 @@
 import logging
 import time
 from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
 
-import gevent
-import json_delta
+import gevent.pool
+import gevent.queue
 import requests.exceptions
 
+from . import delta as cluster_delta
 from .backoff import expo
 from .backoff import random_jitter
+from .broadcast import ALL_CLUSTERS
+from .broadcast import VIEWERS_TTL_SECONDS
 from .cluster_discovery import Cluster
+from .metrics import BACKOFF_NEXT_TRY
+from .metrics import BACKOFF_TRIES
+from .metrics import DIFF_DURATION
+from .metrics import QUERY_DURATION
+from .metrics import QUERY_FAILURES
+from .metrics import QUERY_INTERVAL
+from .shards import assign_clusters
+from .shards import generate_replica_id
+from .shards import LEASE_SECONDS
+from .shards import REPLICA_TTL_SECONDS
 from .utils import get_short_error_message
 
 logger = logging.getLogger(__name__)
 
+# empty deltas are published at least this often (frontend reconnects after 20 seconds)
+DELTA_KEEPALIVE_SECONDS = 10
+# the frontend drops cluster data older than this (maxDataAgeSeconds in config.js)
+MAX_DATA_AGE_SECONDS = 60
+# adaptive query interval: factor after a query without/with changes
+QUERY_INTERVAL_GROWTH = 1.5
+QUERY_INTERVAL_SHRINK = 0.5
+# share of the time a cluster may be queried, e.g. a 30 second query runs at most every 5 minutes
+QUERY_COST_RATIO = 0.1
+
 
 def calculate_backoff(tries: int):
     return random_jitter(expo(tries, factor=2, max_value=60), jitter=4)
 
 
-def handle_query_failure(e: Exception, cluster: Cluster, backoff: dict):
+def adapt_query_interval(
+    interval: float,
+    changed: bool,
+    query_seconds: float,
+    min_interval: float,
+    max_interval: float,
+) -> float:
+    """Return the next query interval of a cluster: longer while it does not change, shorter while it does.
+
+    Expensive queries are run less often (see QUERY_COST_RATIO), within the bounds.
+    """
+    interval *= QUERY_INTERVAL_SHRINK if changed else QUERY_INTERVAL_GROWTH
+    interval = max(interval, min_interval, query_seconds / QUERY_COST_RATIO)
+    return min(interval, max_interval)
+
+
+def handle_query_failure(e: Exception, cluster: Cluster, backoff: Optional[dict]):
     if not backoff:
         backoff = {}
     tries = backoff.get("tries", 0) + 1
     backoff["tries"] = tries
     wait_seconds = calculate_backoff(tries)
     backoff["next_try"] = time.time() + wait_seconds
+    QUERY_FAILURES.labels(cluster.id).inc()
+    BACKOFF_TRIES.labels(cluster.id).set(tries)
+    BACKOFF_NEXT_TRY.labels(cluster.id).set(backoff["next_try"])
     message = get_short_error_message(e)
-    if isinstance(e, requests.exceptions.RequestException):
+    if isinstance(e, (requests.exceptions.RequestException, TimeoutError)):
         log = logger.error
     else:
         log = logger.exception
@@ -38,83 +85,414 @@ def handle_query_failure(e: Exception, cluster: Cluster, backoff: dict):
     return backoff
 
 
+def query_cluster_with_timeout(
+    query_cluster: Callable[[Cluster], dict],
+    cluster: Cluster,
+    query_timeout: float,
+    results: gevent.queue.Queue,
+):
+    """Query a single cluster (in a pool greenlet) and put the result into the queue."""
+    started = time.time()
+    try:
+        logger.debug(
+            "Querying cluster {} ({})..".format(cluster.id, cluster.api_server_url)
+        )
+        with gevent.Timeout(
+            query_timeout,
+            TimeoutError(
+                "Query did not finish within {} seconds".format(round(query_timeout))
+            ),
+        ):
+            data = query_cluster(cluster)
+    except Exception as e:
+        results.put((cluster, started, None, e))
+    else:
+        results.put((cluster, started, data, None))
+    finally:
+        QUERY_DURATION.labels(cluster.id).observe(time.time() - started)
+
+
+def apply_query_result(
+    store,
+    cluster: Cluster,
+    now: float,
+    data: Optional[dict],
+    error: Optional[Exception],
+    snapshots: Dict[str, Tuple[float, dict]],
+    debug: bool,
+    coalescer: cluster_delta.DeltaCoalescer,
+    statuses: Dict[str, dict] = None,
+    query_interval: float = 0,
+    max_query_interval: float = None,
+):
+    """Store and publish the result of a cluster query, must only be called while holding its lease.
+
+    statuses are the cluster statuses read while holding the same lease (if any), they
+    are updated with the stored status. With a max_query_interval (above query_interval)
+    the cluster's query interval is adapted to its changes and query duration.
+    """
+    if statuses is not None and cluster.id in statuses:
+        status = statuses[cluster.id]
+    else:
+        status = store.get_cluster_status(cluster.id)
+    if now < status.get("last_query_time", 0):
+        # another replica already stored a newer result
+        return
+    backoff = status.get("backoff")
+    if error is not None:
+        backoff = handle_query_failure(error, cluster, backoff)
+        status["backoff"] = backoff
+        store.publish(
+            "clusterstatus",
+            {"cluster_id": cluster.id, "status": status},
+        )
+    elif data is not None:
+        if backoff:
+            logger.info(
+                "Cluster {} ({}) recovered after {} tries.".format(
+                    cluster.id, cluster.api_server_url, backoff["tries"]
+                )
+            )
+            del status["backoff"]
+            BACKOFF_TRIES.remove(cluster.id)
+            BACKOFF_NEXT_TRY.remove(cluster.id)
+        # loaded from a snapshot before
+        status.pop("stale", None)
+        last_query_time, old_data = snapshots.get(cluster.id, (None, None))
+        if last_query_time != status.get("last_query_time"):
+            # another replica might have updated the cluster in the meantime
+            old_data = store.get_cluster_data(data["id"])
+        status["last_query_time"] = now
+        snapshots[cluster.id] = (now, data)
+        delta = None
+        if old_data:
+            with DIFF_DURATION.labels(cluster.id).time():
+                delta = cluster_delta.diff(old_data, data)
+            if debug:
+                logger.debug(
+                    "Cluster {} changed: {} stanzas".format(cluster.id, len(delta))
+                )
+            delta_to_publish = coalescer.add(cluster.id, delta, time.time())
+            if delta_to_publish is not None:
+                store.publish(
+                    "clusterdelta",
+                    {"cluster_id": cluster.id, "delta": delta_to_publish},
+                )
+            if delta:
+                store.set_cluster_data(cluster.id, data)
+        else:
+            logger.info(
+                "Discovered new cluster {} ({}).".format(
+                    cluster.id, cluster.api_server_url
+                )
+            )
+            # first send status with last_query_time!
+            store.publish(
+                "clusterstatus",
+                {"cluster_id": cluster.id, "status": status},
+            )
+            coalescer.discard(cluster.id, time.time())
+            store.publish("clusterupdate", data)
+            store.set_cluster_data(cluster.id, data)
+        if max_query_interval and max_query_interval > query_interval:
+            status["query_interval"] = adapt_query_interval(
+                status.get("query_interval", query_interval),
+                # new clusters count as changed
+                delta is None or bool(delta),
+                time.time() - now,
+                query_interval,
+                max_query_interval,
+            )
+            QUERY_INTERVAL.labels(cluster.id).set(status["query_interval"])
+        else:
+            status.pop("query_interval", None)
+    store.set_cluster_status(cluster.id, status)
+    if statuses is not None:
+        statuses[cluster.id] = status
+
+
+def hand_over_clusters(
+    store,
+    cluster_ids: Set[str],
+    snapshots: Dict[str, Tuple[float, dict]],
+    coalescer: cluster_delta.DeltaCoalescer,
+):
+    """Publish pending deltas of clusters now updated by another replica and forget them."""
+    with store.batch():
+        for cluster_id in cluster_ids:
+            delta = coalescer.pop(cluster_id)
+            if delta:
+                # already stored, i.e. not part of the other replica's next delta
+                store.publish(
+                    "clusterdelta", {"cluster_id": cluster_id, "delta": delta}
+                )
+            snapshots.pop(cluster_id, None)
+
+
+def update_leases(
+    store,
+    replica_id: str,
+    cluster_ids: Set[str],
+    leases: Set[str],
+    snapshots: Dict[str, Tuple[float, dict]],
+    coalescer: cluster_delta.DeltaCoalescer,
+) -> Set[str]:
+    """Send the replica's heartbeat and renew/acquire/release cluster leases.
+
+    Returns the IDs of the clusters now leased by the replica.
+    """
+    replica_ids = store.register_replica(replica_id, REPLICA_TTL_SECONDS)
+    assigned = {
+        cluster_id
+        for cluster_id, owner in assign_clusters(cluster_ids, replica_ids).items()
+        if owner == replica_id
+    }
+    released = leases - assigned
+    if released:
+        # let the new owner take over right away
+        hand_over_clusters(store, released, snapshots, coalescer)
+        store.release_leases(replica_id, released)
+    held = store.acquire_leases(replica_id, assigned, LEASE_SECONDS)
+    if held != leases:
+        lost = leases - released - held
+        if lost:
+            hand_over_clusters(store, lost, snapshots, coalescer)
+        logger.info(
+            "Replica {} updates {} of {} clusters ({} replicas).".format(
+                replica_id, len(held), len(cluster_ids), len(replica_ids)
+            )
+        )
+    return held
+
+
+def is_query_due(status: dict, now: float, query_interval: float):
+    """Return whether the cluster should be queried, query_interval is the minimum.
+
+    The cluster's adapted query interval applies if longer.
+    """
+    query_interval = max(query_interval, status.get("query_interval", 0))
+    if now < status.get("last_query_time", 0) + query_interval:
+        return False
+    backoff = status.get("backoff")
+    # cluster might still be in backoff
+    return not backoff or now >= backoff["next_try"]
+
+
+def get_min_query_interval(
+    cluster_id: str,
+    query_interval: float,
+    idle_query_interval: Optional[float],
+    viewed: Optional[Set[str]],
+) -> float:
+    """Return the query interval of the cluster, idle_query_interval if nobody views it."""
+    if viewed is None or ALL_CLUSTERS in viewed or cluster_id in viewed:
+        return query_interval
+    return max(query_interval, idle_query_interval or 0)
+
+
+def flush_deltas(
+    store,
+    coalescer: cluster_delta.DeltaCoalescer,
+    leases: Set[str],
+    snapshots: Dict[str, Tuple[float, dict]],
+    statuses: Dict[str, dict],
+    in_flight: Set[str],
+):
+    """Publish the deltas due and keepalives of leased clusters whose last query succeeded.
+
+    Clusters with a longer (adaptive or idle) query interval would look outdated to
+    the frontend otherwise, running and failing queries are not covered up.
+    """
+    now = time.time()
+    healthy = [
+        cluster_id
+        for cluster_id in leases
+        if cluster_id in snapshots
+        and cluster_id not in in_flight
+        and not statuses.get(cluster_id, {}).get("backoff")
+    ]
+    with store.batch():
+        for cluster_id, delta in coalescer.flush(now):
+            store.publish("clusterdelta", {"cluster_id": cluster_id, "delta": delta})
+        for cluster_id in coalescer.keepalives(healthy, now):
+            store.publish("clusterdelta", {"cluster_id": cluster_id, "delta": []})
+
+
+class ClusterUpdater:
+
+    """State of the cluster updates of a replica, shared by the gevent and asyncio runtimes.
+
+    The runtimes only run the queries (bounded to query_concurrency) and the loop,
+    all methods have to be called from the same greenlet/thread.
+    """
+
+    def __init__(
+        self,
+        store,
+        query_interval: float = 5,
+        debug: bool = False,
+        query_concurrency: int = 10,
+        publish_interval: float = 0,
+        replica_id: str = None,
+        max_query_interval: float = None,
+        idle_query_interval: float = None,
+    ):
+        self.store = store
+        self.query_interval = query_interval
+        self.debug = debug
+        self.query_concurrency = query_concurrency
+        self.replica_id = replica_id or generate_replica_id()
+        self.max_query_interval = max_query_interval
+        self.idle_query_interval = idle_query_interval
+        self.in_flight: Set[str] = set()
+        # last snapshot per cluster (with its query time) to avoid reading it back from the store
+        self.snapshots: Dict[str, Tuple[float, dict]] = {}
+        self.coalescer = cluster_delta.DeltaCoalescer(
+            publish_interval, keepalive=DELTA_KEEPALIVE_SECONDS
+        )
+        # IDs of clusters leased by this replica
+        self.leases: Set[str] = set()
+        # cluster ID => status, read once per iteration
+        self.statuses: Dict[str, dict] = {}
+
+    def start_queries(self, clusters: List[Cluster]) -> List[Cluster]:
+        """Update the leases and return the clusters to query now (marked as in flight)."""
+        store = self.store
+        cluster_ids = {cluster.id for cluster in clusters}
+        store.set_cluster_ids(cluster_ids)
+
+        self.leases = update_leases(
+            store,
+            self.replica_id,
+            cluster_ids,
+            self.leases,
+            self.snapshots,
+            self.coalescer,
+        )
+
+        self.statuses = store.get_cluster_statuses(self.leases)
+        viewed = (
+            store.get_viewed_clusters(VIEWERS_TTL_SECONDS)
+            if self.idle_query_interval
+            else None
+        )
+        due = []
+        now = time.time()
+        for cluster in clusters:
+            if cluster.id not in self.leases or cluster.id in self.in_flight:
+                continue
+            if len(self.in_flight) >= self.query_concurrency:
+                break
+            if not is_query_due(
+                self.statuses[cluster.id],
+                now,
+                get_min_query_interval(
+                    cluster.id, self.query_interval, self.idle_query_interval, viewed
+                ),
+            ):
+                continue
+            self.in_flight.add(cluster.id)
+            due.append(cluster)
+        return due
+
+    def apply_result(
+        self,
+        cluster: Cluster,
+        started: float,
+        data: Optional[dict],
+        error: Optional[Exception],
+    ):
+        """Store and publish the result of a query started by start_queries."""
+        self.in_flight.discard(cluster.id)
+        if cluster.id not in self.leases:
+            # updated by another replica now
+            return
+        with self.store.batch():
+            apply_query_result(
+                self.store,
+                cluster,
+                started,
+                data,
+                error,
+                self.snapshots,
+                self.debug,
+                self.coalescer,
+                self.statuses,
+                self.query_interval,
+                self.max_query_interval,
+            )
+
+    def flush(self):
+        flush_deltas(
+            self.store,
+            self.coalescer,
+            self.leases,
+            self.snapshots,
+            self.statuses,
+            self.in_flight,
+        )
+
+
 def update_clusters(
     cluster_discoverer,
     query_cluster: Callable[[Cluster], dict],
     store,
     query_interval: float = 5,
     debug: bool = False,
+    query_concurrency: int = 10,
+    query_timeout: float = 60,
+    publish_interval: float = 0,
+    replica_id: str = None,
+    max_query_interval: float = None,
+    idle_query_interval: float = None,
 ):
+    """Query clusters concurrently, each at its own interval, and store/publish the results.
+
+    The clusters are partitioned across replicas (see shards), this replica only
+    queries clusters assigned to it and leased by it. Queries run in a bounded pool,
+    store writes and publishing only happen in this greenlet (see ClusterUpdater).
+    Deltas of a cluster are published at most once per publish_interval (merged in
+    between), empty deltas only as keepalive (see flush_deltas). Cluster statuses are
+    read once per iteration and the writes of each query result are sent as one batch.
+
+    The query interval of each cluster grows up to max_query_interval while it does not
+    change (see adapt_query_interval). Clusters without SSE clients on any replica are
+    queried at most every idle_query_interval.
+    """
+    updater = ClusterUpdater(
+        store,
+        query_interval,
+        debug,
+        query_concurrency,
+        publish_interval,
+        replica_id,
+        max_query_interval,
+        idle_query_interval,
+    )
+    pool = gevent.pool.Pool(query_concurrency)
+    results: gevent.queue.Queue = gevent.queue.Queue()
     while True:
-        lock = store.acquire_lock()
-        if lock:
-            try:
-                clusters = cluster_discoverer.get_clusters()
-                cluster_ids = set()
-                for cluster in clusters:
-                    cluster_ids.add(cluster.id)
-                    status = store.get_cluster_status(cluster.id)
-                    now = time.time()
-                    if now < status.get("last_query_time", 0) + query_interval:
-                        continue
-                    backoff = status.get("backoff")
-                    if backoff and now < backoff["next_try"]:
-                        # cluster is still in backoff, skip
-                        continue
-                    try:
-                        logger.debug(
-                            "Querying cluster {} ({})..".format(
-                                cluster.id, cluster.api_server_url
-                            )
-                        )
-                        data = query_cluster(cluster)
-                    except Exception as e:
-                        backoff = handle_query_failure(e, cluster, backoff)
-                        status["backoff"] = backoff
-                        store.publish(
-                            "clusterstatus",
-                            {"cluster_id": cluster.id, "status": status},
-                        )
-                    else:
-                        status["last_query_time"] = now
-                        if backoff:
-                            logger.info(
-                                "Cluster {} ({}) recovered after {} tries.".format(
-                                    cluster.id, cluster.api_server_url, backoff["tries"]
-                                )
-                            )
-                            del status["backoff"]
-                        old_data = store.get_cluster_data(data["id"])
-                        if old_data:
-                            # https://pikacode.com/phijaro/json_delta/ticket/11/
-                            # diff is extremely slow without array_align=False
-                            delta = json_delta.diff(
-                                old_data, data, verbose=debug, array_align=False
-                            )
-                            store.publish(
-                                "clusterdelta",
-                                {"cluster_id": cluster.id, "delta": delta},
-                            )
-                            if delta:
-                                store.set_cluster_data(cluster.id, data)
-                        else:
-                            logger.info(
-                                "Discovered new cluster {} ({}).".format(
-                                    cluster.id, cluster.api_server_url
-                                )
-                            )
-                            # first send status with last_query_time!
-                            store.publish(
-                                "clusterstatus",
-                                {"cluster_id": cluster.id, "status": status},
-                            )
-                            store.publish("clusterupdate", data)
-                            store.set_cluster_data(cluster.id, data)
-                    store.set_cluster_status(cluster.id, status)
-                store.set_cluster_ids(cluster_ids)
-            except Exception as e:
-                logger.exception(f"Failed to update: {e}")
-            finally:
-                store.release_lock(lock)
-        # sleep 1-2 seconds
-        gevent.sleep(min(random_jitter(1), query_interval))
+        # sleep 1-2 seconds (while waiting for query results)
+        wait_seconds = min(random_jitter(1), query_interval)
+        try:
+            clusters = list(cluster_discoverer.get_clusters())
+            for cluster in updater.start_queries(clusters):
+                pool.spawn(
+                    query_cluster_with_timeout,
+                    query_cluster,
+                    cluster,
+                    query_timeout,
+                    results,
+                )
+
+            deadline = time.time() + wait_seconds
+            while True:
+                try:
+                    result = results.get(timeout=max(deadline - time.time(), 0))
+                except gevent.queue.Empty:
+                    break
+                updater.apply_result(*result)
+            updater.flush()
+        except Exception as e:
+            logger.exception(f"Failed to update: {e}")
+            gevent.sleep(wait_seconds)
@@ -1,4 +1,11 @@
+import concurrent.futures
+import contextlib
+import gc
+import hashlib
+
+import gevent
 import requests.exceptions
+from gevent import monkey
 
 
 def get_short_error_message(e: Exception):
@@ -12,3 +19,58 @@ def get_short_error_message(e: Exception):
         return e.__class__.__name__
     else:
         return str(e)
+
+
+def stable_hash(*values) -> int:
+    """Return a hash of the values which is the same in every process (unlike hash())."""
+    data = "/".join(map(str, values)).encode("utf-8")
+    return int.from_bytes(hashlib.md5(data).digest(), "big")
+
+
+def run_concurrently(*calls: tuple):
+    """Run the given (function, *args) calls in greenlets and return their results in order.
+
+    Raises the first exception of any call, all remaining calls are killed then.
+    Without monkey patching (asyncio runtime) greenlets would run one call after
+    another, the calls run in threads then (remaining ones are not interrupted).
+    """
+    if not monkey.is_module_patched("socket"):
+        return _run_in_threads(calls)
+    greenlets = [gevent.spawn(*call) for call in calls]
+    try:
+        gevent.joinall(greenlets, raise_error=True)
+        return [greenlet.value for greenlet in greenlets]
+    finally:
+        gevent.killall(greenlets)
+
+
+def _run_in_threads(calls):
+    executor = concurrent.futures.ThreadPoolExecutor(len(calls))
+    try:
+        futures = [executor.submit(*call) for call in calls]
+        done, _ = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_EXCEPTION
+        )
+        for future in futures:
+            error = future.exception() if future in done else None
+            if error is not None:
+                raise error
+        return [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=False)
+
+
+@contextlib.contextmanager
+def paused_gc():
+    """Disable the cyclic garbage collector, e.g. while decoding large snapshots.
+
+    Decoding allocates millions of objects (without any cycles) which otherwise
+    trigger many expensive full collections.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
@@ -0,0 +1,421 @@
+import functools
+import json
+import logging
+import time
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import gevent.event
+
+from .backoff import expo
+from .backoff import random_jitter
+from .kubernetes import get_pod_expiry_time
+from .kubernetes import map_node
+from .kubernetes import map_pod_and_containers
+from .kubernetes import PaginatedList
+from .kubernetes import query_node_usage
+from .kubernetes import query_pod_metrics
+from .kubernetes import QueryProfile
+from .kubernetes import QueryProfiles
+from .model import Node
+from .model import Pod
+from .utils import get_short_error_message
+from .utils import run_concurrently
+
+logger = logging.getLogger(__name__)
+
+# server-side timeout of a single WATCH request, the watch is resumed afterwards
+WATCH_TIMEOUT_SECONDS = 300
+# how long the first query of a cluster waits for the initial LIST
+INITIAL_SYNC_TIMEOUT = 60
+# stop watching clusters which were not queried for some time (e.g. removed from registry)
+IDLE_TIMEOUT = 600
+
+
+class ResourceVersionExpired(Exception):
+
+    """The watched resourceVersion is too old (410 Gone), a new LIST is needed."""
+
+
+class ClusterState:
+
+    """Incrementally maintained nodes and pods of a single cluster.
+
+    Snapshots share all unchanged node and pod objects with the previous snapshot,
+    i.e. objects must be treated as immutable once returned by snapshot().
+    With nodes_filtered (node label selector) pods scheduled on unknown nodes are left
+    out instead of being "unassigned".
+    """
+
+    def __init__(self, nodes_filtered: bool = False):
+        self.nodes_filtered = nodes_filtered
+        self._nodes: Dict[str, Node] = {}
+        # pod key => (node name, pod)
+        self._pods: Dict[str, Tuple[Optional[str], Pod]] = {}
+        # node name => {pod key: pod}
+        self._pods_by_node: Dict[Optional[str], Dict[str, Pod]] = {}
+        # pod key => expiry time (finished pods only)
+        self._expiry: Dict[str, float] = {}
+        self._expired: Set[str] = set()
+        self._node_usage: Dict[str, dict] = {}
+        self._pod_metrics: Dict[str, dict] = {}
+        self._assembled_nodes: Dict[str, Node] = {}
+        self._assembled_unassigned: Dict[str, Pod] = {}
+        self._dirty_nodes: Set[str] = set()
+        self._unassigned_dirty = True
+
+    def _mark_dirty(self, node_name):
+        if node_name in self._nodes:
+            self._dirty_nodes.add(node_name)
+        else:
+            self._unassigned_dirty = True
+
+    def apply_node_event(self, event_type: str, node: dict):
+        name = node["metadata"]["name"]
+        if event_type == "DELETED":
+            self._remove_node(name)
+            return
+        obj = map_node(node)
+        if self._nodes.get(name) == obj:
+            # e.g. only node conditions changed
+            return
+        if name not in self._nodes:
+            # pods might move from "unassigned" to this node
+            self._unassigned_dirty = True
+        self._nodes[name] = obj
+        self._dirty_nodes.add(name)
+
+    def _remove_node(self, name: str):
+        if self._nodes.pop(name, None) is not None:
+            self._dirty_nodes.add(name)
+            self._unassigned_dirty = True
+
+    def reset_nodes(self, nodes: Iterable[dict]):
+        names = set()
+        for node in nodes:
+            names.add(node["metadata"]["name"])
+            self.apply_node_event("ADDED", node)
+        for name in self._nodes.keys() - names:
+            self._remove_node(name)
+
+    def apply_pod_event(self, event_type: str, pod: dict):
+        key = "{}/{}".format(pod["metadata"]["namespace"], pod["metadata"]["name"])
+        if event_type == "DELETED":
+            self._remove_pod(key)
+            return
+        node_name = pod["spec"].get("nodeName")
+        obj = map_pod_and_containers(pod)
+        if self._pods.get(key) == (node_name, obj):
+            return
+        self._remove_pod(key)
+        self._pods[key] = (node_name, obj)
+        self._pods_by_node.setdefault(node_name, {})[key] = obj
+        expiry_time = get_pod_expiry_time(obj)
+        if expiry_time is not None:
+            self._expiry[key] = expiry_time
+        self._mark_dirty(node_name)
+
+    def _remove_pod(self, key: str):
+        entry = self._pods.pop(key, None)
+        if entry is None:
+            return
+        node_name = entry[0]
+        pods = self._pods_by_node[node_name]
+        del pods[key]
+        if not pods:
+            del self._pods_by_node[node_name]
+        self._expiry.pop(key, None)
+        self._expired.discard(key)
+        self._mark_dirty(node_name)
+
+    def reset_pods(self, pods: Iterable[dict], namespace: str = None):
+        """Replace all pods (of the given namespace) with the listed ones."""
+        keys = set()
+        for pod in pods:
+            keys.add(
+                "{}/{}".format(pod["metadata"]["namespace"], pod["metadata"]["name"])
+            )
+            self.apply_pod_event("ADDED", pod)
+        for key in self._pods.keys() - keys:
+            if namespace is None or key.startswith(namespace + "/"):
+                self._remove_pod(key)
+
+    def set_node_usage(self, node_usage: dict):
+        for name in self._node_usage.keys() | node_usage.keys():
+            if self._node_usage.get(name) != node_usage.get(name):
+                self._dirty_nodes.add(name)
+        self._node_usage = node_usage
+
+    def set_pod_metrics(self, pod_metrics: dict):
+        """Set usage by container name by pod key ("namespace/name")."""
+        for key in self._pod_metrics.keys() | pod_metrics.keys():
+            if self._pod_metrics.get(key) != pod_metrics.get(key):
+                entry = self._pods.get(key)
+                if entry:
+                    self._mark_dirty(entry[0])
+        self._pod_metrics = pod_metrics
+
+    def _with_usage(self, key: str, pod: Pod):
+        usage_by_container = self._pod_metrics.get(key)
+        if not usage_by_container:
+            return pod
+        containers = []
+        for container in pod.containers:
+            usage = usage_by_container.get(container.name)
+            if usage is not None:
+                container = container.replace(usage=usage)
+            containers.append(container)
+        return pod.replace(containers=containers)
+
+    def _assemble_pods(self, pods: dict, into: dict):
+        for key, pod in pods.items():
+            if key not in self._expired:
+                into[key] = self._with_usage(key, pod)
+        return into
+
+    def snapshot(self, now: float):
+        """Return nodes (including pods) and unassigned pods, only changed nodes are rebuilt."""
+        for key, expiry_time in self._expiry.items():
+            if expiry_time < now and key not in self._expired:
+                self._expired.add(key)
+                self._mark_dirty(self._pods[key][0])
+
+        for name in self._dirty_nodes:
+            node = self._nodes.get(name)
+            if node is None:
+                self._assembled_nodes.pop(name, None)
+                continue
+            self._assembled_nodes[name] = node.replace(
+                pods=self._assemble_pods(self._pods_by_node.get(name, {}), {}),
+                usage=self._node_usage.get(name),
+            )
+        self._dirty_nodes = set()
+
+        if self._unassigned_dirty:
+            unassigned_pods: dict = {}
+            for node_name, pods in self._pods_by_node.items():
+                if node_name not in self._nodes and (
+                    not node_name or not self.nodes_filtered
+                ):
+                    self._assemble_pods(pods, unassigned_pods)
+            self._assembled_unassigned = unassigned_pods
+            self._unassigned_dirty = False
+
+        return dict(self._assembled_nodes), self._assembled_unassigned
+
+
+class ResourceWatcher:
+
+    """Keep a resource (e.g. all pods) up-to-date with one LIST and a resumed WATCH."""
+
+    def __init__(
+        self,
+        client,
+        endpoint: str,
+        handle_list,
+        handle_event,
+        params: dict = None,
+        namespace: str = None,
+    ):
+        self.client = client
+        self.endpoint = endpoint
+        self.handle_list = handle_list
+        self.handle_event = handle_event
+        self.params = params or {}
+        self.namespace = namespace
+        self.resource_version = None
+        self.error = None
+        self.synced = gevent.event.Event()
+
+    def list(self):
+        objects = PaginatedList(
+            self.client, self.endpoint, params=self.params, namespace=self.namespace
+        )
+        self.handle_list(objects)
+        self.resource_version = objects.resource_version
+        self.error = None
+        self.synced.set()
+
+    def watch(self):
+        params = {
+            **self.params,
+            "watch": "true",
+            "resourceVersion": self.resource_version,
+            "allowWatchBookmarks": "true",
+            "timeoutSeconds": WATCH_TIMEOUT_SECONDS,
+        }
+        response = self.client.get(
+            url=self.endpoint,
+            namespace=self.namespace,
+            params=params,
+            stream=True,
+            timeout=(10, WATCH_TIMEOUT_SECONDS + 30),
+        )
+        try:
+            if response.status_code == 410:
+                raise ResourceVersionExpired()
+            response.raise_for_status()
+            self.error = None
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                event_type = event["type"]
+                obj = event["object"]
+                if event_type == "ERROR":
+                    if obj.get("code") == 410:
+                        raise ResourceVersionExpired()
+                    raise Exception(
+                        "Watch failed: {} {}".format(
+                            obj.get("code"), obj.get("message")
+                        )
+                    )
+                if event_type != "BOOKMARK":
+                    self.handle_event(event_type, obj)
+                self.resource_version = obj["metadata"]["resourceVersion"]
+        finally:
+            response.close()
+
+    def run(self):
+        tries = 0
+        while True:
+            try:
+                if self.resource_version is None:
+                    self.list()
+                self.watch()
+                tries = 0
+            except ResourceVersionExpired:
+                logger.info(
+                    "Resource version of {} expired, listing again..".format(
+                        self.endpoint
+                    )
+                )
+                self.resource_version = None
+            except Exception as e:
+                tries += 1
+                self.error = e
+                wait_seconds = random_jitter(expo(tries, max_value=30))
+                logger.warning(
+                    "Failed to list/watch {}: {} (try {}, wait {} seconds)".format(
+                        self.endpoint,
+                        get_short_error_message(e),
+                        tries,
+                        round(wait_seconds),
+                    )
+                )
+                gevent.sleep(wait_seconds)
+
+
+class ClusterWatcher:
+
+    """Watches nodes and pods of a single cluster in background greenlets."""
+
+    def __init__(self, cluster, profile: QueryProfile):
+        self.cluster = cluster
+        self.profile = profile
+        self.state = ClusterState(nodes_filtered=profile.nodes_filtered)
+        self.last_query_time = time.time()
+        self._watchers = [
+            ResourceWatcher(
+                cluster.client,
+                "nodes",
+                self.state.reset_nodes,
+                self.state.apply_node_event,
+                params=profile.node_params(),
+            )
+        ]
+        for namespace in profile.pod_namespaces:
+            self._watchers.append(
+                ResourceWatcher(
+                    cluster.client,
+                    "pods",
+                    functools.partial(self.state.reset_pods, namespace=namespace),
+                    self.state.apply_pod_event,
+                    params=profile.pod_params(),
+                    namespace=namespace,
+                )
+            )
+        self._greenlets = [gevent.spawn(watcher.run) for watcher in self._watchers]
+
+    def query(self, sync_timeout: float):
+        self.last_query_time = time.time()
+        deadline = self.last_query_time + sync_timeout
+        for watcher in self._watchers:
+            if not watcher.synced.wait(max(deadline - time.time(), 0)):
+                raise watcher.error or TimeoutError(
+                    "Initial list of {} did not finish".format(watcher.endpoint)
+                )
+            if watcher.error:
+                # the local state might be outdated
+                raise watcher.error
+
+        node_usage, pod_metrics = run_concurrently(
+            (query_node_usage, self.cluster),
+            (query_pod_metrics, self.cluster, self.profile),
+        )
+        self.state.set_node_usage(node_usage)
+        self.state.set_pod_metrics(
+            {
+                f"{namespace}/{name}": usage_by_container
+                for (namespace, name), usage_by_container in pod_metrics.items()
+            }
+        )
+        nodes, unassigned_pods = self.state.snapshot(time.time())
+        return {
+            "id": self.cluster.id,
+            "api_server_url": self.cluster.api_server_url,
+            "nodes": nodes,
+            "unassigned_pods": unassigned_pods,
+        }
+
+    def stop(self):
+        gevent.killall(self._greenlets)
+
+
+class WatchingClusterQuery:
+
+    """Drop-in replacement for query_kubernetes_cluster using LIST+WATCH instead of polling."""
+
+    def __init__(
+        self,
+        query_profiles: QueryProfiles = None,
+        sync_timeout: float = INITIAL_SYNC_TIMEOUT,
+        idle_timeout=IDLE_TIMEOUT,
+    ):
+        self._query_profiles = query_profiles or QueryProfiles()
+        self._sync_timeout = sync_timeout
+        self._idle_timeout = idle_timeout
+        self._watchers: dict = {}
+
+    def _stop_idle_watchers(self, now: float):
+        for cluster_id, watcher in list(self._watchers.items()):
+            if watcher.last_query_time < now - self._idle_timeout:
+                logger.info("Stopping idle watches for cluster {}..".format(cluster_id))
+                watcher.stop()
+                del self._watchers[cluster_id]
+
+    def __call__(self, cluster):
+        self._stop_idle_watchers(time.time())
+        watcher = self._watchers.get(cluster.id)
+        if watcher and watcher.cluster.api_server_url != cluster.api_server_url:
+            watcher.stop()
+            watcher = None
+        if not watcher:
+            logger.info(
+                "Starting to watch cluster {} ({})..".format(
+                    cluster.id, cluster.api_server_url
+                )
+            )
+            watcher = self._watchers[cluster.id] = ClusterWatcher(
+                cluster, self._query_profiles.get(cluster.id)
+            )
+        return watcher.query(self._sync_timeout)
+
+    def stop(self):
+        """Stop watching all clusters."""
+        for watcher in self._watchers.values():
+            watcher.stop()
+        self._watchers.clear()
@@ -0,0 +1,252 @@
+import time
+from typing import Optional
+
+import pytest
+
+from kube_ops_view import stores
+
+
+def encode(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode("utf-8")
+
+
+class FakePipeline:
+
+    """Queues the commands until execute(), i.e. one round trip."""
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands: list = []
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __bool__(self):
+        # as redis-py's
+        return True
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        if self._redis.error is not None:
+            raise self._redis.error
+        if commands:
+            self._redis.round_trips += 1
+        return [self._redis.execute(*command) for command in commands]
+
+    def reset(self):
+        self._commands = []
+
+
+class FakeRedis:
+
+    """In-process replacement of the Redis client with the commands used by RedisStore.
+
+    Every command called on the client is one round trip, the commands of a pipeline
+    are one round trip when executed. Executed commands are logged (name, args, kwargs).
+    """
+
+    def __init__(self):
+        self.data: dict = {}
+        self.round_trips = 0
+        self.commands: list = []
+        # raised when executing a pipeline
+        self.error: Optional[Exception] = None
+        # key => time of expiry
+        self.expiry: dict = {}
+        # added to the time, e.g. to expire keys
+        self.offset = 0.0
+        self._scripts = {
+            stores.ACQUIRE_LEASE_SCRIPT: self._acquire_lease,
+            stores.RELEASE_LEASE_SCRIPT: self._release_lease,
+        }
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            self.round_trips += 1
+            return self.execute(name, args, kwargs)
+
+        return call
+
+    def execute(self, name: str, args: tuple, kwargs: dict):
+        self.commands.append((name, args, kwargs))
+        return getattr(self, "_" + name)(*args, **kwargs)
+
+    def written_fields(self, key: str) -> list:
+        """Return the hash fields written to the key by HSET commands (in order)."""
+        return [
+            field
+            for name, args, kwargs in self.commands
+            if name == "hset" and args[0] == key
+            for field in kwargs["mapping"]
+        ]
+
+    def pipeline(self, transaction: bool = True):
+        return FakePipeline(self)
+
+    def register_script(self, script: str):
+        """The scripts of RedisStore are run as their Python equivalent."""
+
+        def run(keys, args, client=None):
+            return (client or self).evalsha(script, keys, args)
+
+        return run
+
+    def _evalsha(self, script: str, keys: list, args: list):
+        return self._scripts[script](*keys, *args)
+
+    def _acquire_lease(self, key, replica_id, milliseconds):
+        if self._get(key) == encode(replica_id):
+            return self._pexpire(key, milliseconds)
+        return 1 if self._set(key, replica_id, nx=True, px=milliseconds) else 0
+
+    def _release_lease(self, key, replica_id):
+        if self._get(key) == encode(replica_id):
+            return self._delete(key)
+        return 0
+
+    def _get(self, key):
+        if key in self.expiry and self.expiry[key] <= time.time() + self.offset:
+            self._delete(key)
+        return self.data.get(key)
+
+    def _mget(self, keys):
+        return [self._get(key) for key in keys]
+
+    def _set(self, key, value, nx: bool = False, px: int = None):
+        if nx and self._get(key) is not None:
+            return None
+        self.data[key] = encode(value)
+        self.expiry.pop(key, None)
+        if px is not None:
+            self._pexpire(key, px)
+        return True
+
+    def _pexpire(self, key, milliseconds):
+        if self._get(key) is None:
+            return 0
+        self.expiry[key] = time.time() + self.offset + int(milliseconds) / 1000
+        return 1
+
+    def _delete(self, *keys):
+        for key in keys:
+            self.expiry.pop(key, None)
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def _zadd(self, key, mapping):
+        scores = self.data.setdefault(key, {})
+        added = sum(encode(member) not in scores for member in mapping)
+        scores.update({encode(member): score for member, score in mapping.items()})
+        return added
+
+    def _zremrangebyscore(self, key, min, max):
+        scores = self.data.get(key, {})
+        removed = [
+            member
+            for member, score in scores.items()
+            if float(min) <= score <= float(max)
+        ]
+        for member in removed:
+            del scores[member]
+        return len(removed)
+
+    def _zrange(self, key, start, end):
+        members = sorted(
+            self.data.get(key, {}).items(), key=lambda item: (item[1], item[0])
+        )
+        return [member for member, _score in members][start : (end + 1) or None]
+
+    def _incr(self, key):
+        value = int(self.data.get(key, 0)) + 1
+        self.data[key] = encode(value)
+        return value
+
+    def _hset(self, key, mapping):
+        fields = self.data.setdefault(key, {})
+        added = sum(encode(field) not in fields for field in mapping)
+        fields.update(
+            {encode(field): encode(value) for field, value in mapping.items()}
+        )
+        return added
+
+    def _hdel(self, key, *fields):
+        values = self.data.get(key, {})
+        removed = sum(values.pop(encode(field), None) is not None for field in fields)
+        if not values:
+            self.data.pop(key, None)
+        return removed
+
+    def _hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def _xadd(self, key, fields, maxlen=None, approximate=True):
+        entries = self.data.setdefault(key, [])
+        milliseconds = int((time.time() + self.offset) * 1000)
+        sequence = 0
+        if entries:
+            last = stores.event_id_key(entries[-1][0].decode("utf-8"))
+            if last[0] >= milliseconds:
+                milliseconds, sequence = last[0], last[1] + 1
+        event_id = encode("{}-{}".format(milliseconds, sequence))
+        entries.append(
+            (event_id, {encode(name): encode(value) for name, value in fields.items()})
+        )
+        if maxlen is not None:
+            # exact, Redis trims whole nodes with approximate=True
+            del entries[:-maxlen]
+        return event_id
+
+    def _xrange(self, key, min="-", max="+", count=None):
+        entries = [
+            entry
+            for entry in self.data.get(key, [])
+            if (min == "-" or _id_key(entry[0]) >= _id_key(min))
+            and (max == "+" or _id_key(entry[0]) <= _id_key(max))
+        ]
+        return entries[:count]
+
+    def _xrevrange(self, key, max="+", min="-", count=None):
+        return list(reversed(self._xrange(key, min, max)))[:count]
+
+    def _xread(self, streams, block=None):
+        """Return the entries after the IDs (without blocking)."""
+        response = []
+        for key, last_id in streams.items():
+            entries = self.data.get(key, [])
+            if last_id == "$":
+                continue
+            entries = [
+                entry for entry in entries if _id_key(entry[0]) > _id_key(last_id)
+            ]
+            if entries:
+                response.append([encode(key), entries])
+        return response
+
+
+def _id_key(event_id) -> tuple:
+    if isinstance(event_id, bytes):
+        event_id = event_id.decode("utf-8")
+    # (milliseconds, sequence), the sequence is optional
+    return (stores.event_id_key(event_id) + (0,))[:2]
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Every RedisStore created in the test uses the same FakeRedis (i.e. "server")."""
+    redis = FakeRedis()
+    monkeypatch.setattr(stores.redis, "StrictRedis", lambda connection_pool: redis)
+    return redis
@@ -0,0 +1,86 @@
+import asyncio
+import concurrent.futures
+import time
+
+import pytest
+
+from benchmarks.fake_apiserver import FakeCluster
+from benchmarks.fake_apiserver import serve
+from kube_ops_view.broadcast import encode_event
+from kube_ops_view.cluster_discovery import MockDiscoverer
+from kube_ops_view.cluster_discovery import StaticClusterDiscoverer
+from kube_ops_view.kubernetes import query_kubernetes_cluster
+from kube_ops_view.mock import query_mock_cluster
+from kube_ops_view.stores import MemoryStore
+
+aio = pytest.importorskip("kube_ops_view.aio")
+
+
+async def receive(subscription, n: int):
+    frames = []
+    async for frame in subscription:
+        frames.append(frame)
+        if len(frames) == n:
+            break
+    return frames
+
+
+def test_async_broadcaster():
+    async def test():
+        broadcaster = aio.AsyncBroadcaster(MemoryStore(), max_queued_events=2)
+        subscription = broadcaster.subscribe(["a"])
+        broadcaster.publish("clusterdelta", {"cluster_id": "a", "delta": []}, "1-1")
+        broadcaster.publish("clusterdelta", {"cluster_id": "b", "delta": []}, "1-2")
+        assert await receive(subscription, 1) == [
+            encode_event("clusterdelta", {"cluster_id": "a", "delta": []}, "1-1")
+        ]
+        # the slow client gets a fresh snapshot instead
+        for i in range(3):
+            broadcaster.publish("clusterdelta", {"cluster_id": "a", "delta": [i]})
+        assert subscription.resyncs == 0
+        assert broadcaster.stats()["clients"][0]["dropped_events"] == 3
+
+    asyncio.run(test())
+
+
+def test_async_update_clusters():
+    async def test():
+        store = MemoryStore()
+        task = asyncio.ensure_future(
+            aio.update_clusters(MockDiscoverer(), query_mock_cluster, store)
+        )
+        await asyncio.sleep(1)
+        task.cancel()
+        return store
+
+    store = asyncio.run(test())
+    cluster = next(iter(MockDiscoverer().get_clusters()))
+    assert store.get_cluster_ids() == [
+        "mock-cluster-0",
+        "mock-cluster-1",
+        "mock-cluster-2",
+    ]
+    assert store.get_cluster_data(cluster.id)["id"] == cluster.id
+    assert query_mock_cluster(cluster)["id"] == cluster.id
+
+
+def test_async_query_runs_requests_concurrently():
+    (server,) = serve([FakeCluster(nodes=2, pods_per_node=2)], 0, latency=0.3)
+    (cluster,) = StaticClusterDiscoverer(
+        ["http://localhost:{}".format(server.server_port)]
+    ).get_clusters()
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    async def test():
+        loop = asyncio.get_running_loop()
+        started = time.time()
+        data = await loop.run_in_executor(executor, query_kubernetes_cluster, cluster)
+        return data, time.time() - started
+
+    try:
+        data, seconds = asyncio.run(test())
+    finally:
+        server.shutdown()
+    assert len(data["nodes"]) == 2
+    # nodes, pods, node and pod metrics are fetched at the same time
+    assert seconds < 0.6
@@ -0,0 +1,150 @@
+import time
+
+import gevent
+
+from kube_ops_view.broadcast import ALL_CLUSTERS
+from kube_ops_view.broadcast import Broadcaster
+from kube_ops_view.broadcast import encode_event
+from kube_ops_view.broadcast import snapshot_frames
+from kube_ops_view.stores import MemoryStore
+
+
+class FakeStore:
+    def __init__(self, events: list):
+        self.events = events
+
+    def listen(self, after_id=None):
+        yield from self.events
+
+
+def receive(subscription, n: int):
+    frames = []
+    for frame in subscription:
+        frames.append(frame)
+        if len(frames) == n:
+            break
+    return frames
+
+
+def test_broadcast_filters_by_cluster():
+    store = FakeStore(
+        [
+            ("1-1", "clusterdelta", {"cluster_id": "a", "delta": []}),
+            ("1-2", "clusterupdate", {"id": "b", "nodes": {}}),
+        ]
+    )
+    broadcaster = Broadcaster(store)
+    everything = broadcaster.subscribe()
+    only_b = broadcaster.subscribe(["b"])
+    greenlet = gevent.spawn(broadcaster.run)
+    assert receive(everything, 2) == [
+        encode_event("clusterdelta", {"cluster_id": "a", "delta": []}, "1-1"),
+        encode_event("clusterupdate", {"id": "b", "nodes": {}}, "1-2"),
+    ]
+    assert receive(only_b, 1) == [
+        b'id: 1-2\nevent: clusterupdate\ndata: {"id":"b","nodes":{}}\n\n'
+    ]
+    broadcaster.unsubscribe(only_b)
+    assert broadcaster._channels[0].by_cluster == {}
+    greenlet.kill()
+
+
+def test_broadcast_disconnects_slow_client():
+    broadcaster = Broadcaster(FakeStore([]), max_queued_events=2)
+    subscription = broadcaster.subscribe()
+    for i in range(3):
+        broadcaster.publish("clusterdelta", {"cluster_id": "a", "delta": [i]})
+    assert subscription.closed
+    assert len(list(subscription)) <= 2
+    broadcaster.unsubscribe(subscription)
+    assert broadcaster.stats()["disconnects"] == 1
+
+
+def test_broadcast_resyncs_slow_client():
+    broadcaster = Broadcaster(FakeStore([]), max_queued_events=3)
+    subscription = broadcaster.subscribe(["a"], resync=lambda: [b"snapshot"])
+    for i in range(5):
+        broadcaster.publish("clusterdelta", {"cluster_id": "a", "delta": [i]})
+    assert not subscription.closed
+    assert receive(subscription, 1) == [b"snapshot"]
+    # events queued before the snapshot was read are not sent again
+    broadcaster.publish("clusterdelta", {"cluster_id": "a", "delta": [5]})
+    assert receive(subscription, 1) == [
+        encode_event("clusterdelta", {"cluster_id": "a", "delta": [5]})
+    ]
+    assert subscription.queue.qsize() == 0
+    assert subscription.dropped_events == 4
+    assert subscription.resyncs == 1
+    broadcaster.unsubscribe(subscription)
+    stats = broadcaster.stats()
+    assert stats["dropped_events"] == 4
+    assert stats["resyncs"] == 1
+    assert stats["clients"] == []
+
+
+def test_broadcast_update_interval():
+    broadcaster = Broadcaster(FakeStore([]))
+    immediate = broadcaster.subscribe()
+    limited = broadcaster.subscribe(update_interval=0.5)
+    for i in range(3):
+        broadcaster.publish("clusterdelta", {"cluster_id": "a", "delta": [[[i], i]]})
+    assert immediate.queue.qsize() == 3
+    assert receive(limited, 1) == [
+        encode_event("clusterdelta", {"cluster_id": "a", "delta": [[[0], 0]]})
+    ]
+    broadcaster.flush(time.time() + 1)
+    assert receive(limited, 1) == [
+        encode_event("clusterdelta", {"cluster_id": "a", "delta": [[[1], 1], [[2], 2]]})
+    ]
+    broadcaster.unsubscribe(limited)
+    assert list(broadcaster._channels) == [0]
+
+
+def test_replay_missed_events():
+    store = MemoryStore()
+    for cluster_id in ("a", "b", "a"):
+        store.publish("clusterdelta", {"cluster_id": cluster_id, "delta": []})
+    ids = [event[0] for event in store._events]
+    broadcaster = Broadcaster(store)
+    subscription = broadcaster.subscribe(["a"])
+    assert broadcaster.replay(subscription, ids[0]) == [
+        encode_event("clusterdelta", {"cluster_id": "a", "delta": []}, ids[2])
+    ]
+    # queued events are only sent once
+    broadcaster.publish("clusterdelta", {"cluster_id": "a", "delta": []}, ids[2])
+    store.publish("clusterdelta", {"cluster_id": "a", "delta": [1]})
+    broadcaster.publish(*store._events[-1][1:], store._events[-1][0])
+    assert receive(subscription, 1) == [
+        encode_event(
+            "clusterdelta", {"cluster_id": "a", "delta": [1]}, store._events[-1][0]
+        )
+    ]
+    # unknown or invalid IDs need a full snapshot
+    assert broadcaster.replay(subscription, "1-0") is None
+    assert broadcaster.replay(subscription, "foo") is None
+
+
+def test_broadcast_viewed_cluster_ids():
+    broadcaster = Broadcaster(FakeStore([]))
+    only_a = broadcaster.subscribe(["a"])
+    broadcaster.subscribe(["b"], update_interval=5)
+    assert broadcaster.viewed_cluster_ids() == {"a", "b"}
+    broadcaster.unsubscribe(only_a)
+    broadcaster.subscribe()
+    assert broadcaster.viewed_cluster_ids() == {ALL_CLUSTERS, "b"}
+
+
+def test_snapshot_frames_carry_last_event_id():
+    store = MemoryStore()
+    store.set_cluster_ids({"a"})
+    store.set_cluster_status("a", {"last_query_time": 1})
+    store.set_cluster_data("a", {"id": "a"})
+    assert b"".join(snapshot_frames(store, set(), "1-2")) == (
+        encode_event(
+            "clusterstatus",
+            {"cluster_id": "a", "status": {"last_query_time": 1}},
+            "1-2",
+        )
+        + encode_event("clusterupdate", {"id": "a"}, "1-2")
+    )
+    assert b"id:" not in b"".join(snapshot_frames(store, set()))
@@ -0,0 +1,20 @@
+import pytest
+
+from kube_ops_view.cli import common_options
+from kube_ops_view.cli import OPTIONS
+
+aio = pytest.importorskip("kube_ops_view.aio")
+
+
+def test_common_options():
+    @common_options
+    def command():
+        pass
+
+    params = command.__click_params__
+    assert len(params) == len(OPTIONS)
+    # both runtimes read the same environment variables
+    aio_envvars = {param.name: param.envvar for param in aio.main.params}
+    for param in params:
+        assert aio_envvars[param.name] == param.envvar
+    assert aio_envvars["redis_url"] == "REDIS_URL"
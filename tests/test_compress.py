@@ -0,0 +1,56 @@
+import zlib
+
+from kube_ops_view.compress import compress_events
+from kube_ops_view.compress import negotiate_encoding
+from kube_ops_view.compress import select_encoding
+
+
+def test_compress_events_flushes_every_event():
+    frames = ["event: bootstrapend\ndata: \n\n", "event: clusterupdate\ndata: ", b"{}"]
+    frames += [b"\n\n", b'event: clusterdelta\ndata: {"delta":[]}\n\n']
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    received = b""
+    for chunk in compress_events(iter(frames), "gzip"):
+        received += decompressor.decompress(chunk)
+        # every chunk ends with a complete event
+        assert received.endswith(b"\n\n")
+    assert received == b"".join(
+        frame.encode() if isinstance(frame, str) else frame for frame in frames
+    )
+
+
+def test_compress_events_closes_stream():
+    closed = []
+
+    def events():
+        try:
+            while True:
+                yield b"event: clusterdelta\ndata: {}\n\n"
+        finally:
+            closed.append(True)
+
+    stream = compress_events(events(), "deflate")
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+    assert decompressor.decompress(next(stream)) == b"event: clusterdelta\ndata: {}\n\n"
+    stream.close()
+    assert closed == [True]
+
+
+def test_select_encoding():
+    assert select_encoding("") is None
+    assert select_encoding("br") is None
+    assert select_encoding("gzip, deflate, br") == "gzip"
+    assert select_encoding("deflate") == "deflate"
+    assert select_encoding("gzip;q=0.5, deflate") == "deflate"
+    assert select_encoding("gzip;q=0, *") == "deflate"
+    assert select_encoding("*;q=0") is None
+
+
+def test_negotiate_encoding():
+    # opt-in
+    assert negotiate_encoding(None, "gzip") == (None, {})
+    assert negotiate_encoding("true", "gzip") == (
+        "gzip",
+        {"Vary": "Accept-Encoding", "Content-Encoding": "gzip"},
+    )
+    assert negotiate_encoding("1", None) == (None, {"Vary": "Accept-Encoding"})
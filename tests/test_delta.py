@@ -0,0 +1,95 @@
+import copy
+import json
+
+import json_delta
+
+from kube_ops_view.cluster_discovery import MockDiscoverer
+from kube_ops_view.delta import DeltaCoalescer
+from kube_ops_view.delta import diff
+from kube_ops_view.delta import merge
+from kube_ops_view.mock import query_mock_cluster
+from kube_ops_view.model import to_json
+
+
+def wire(obj):
+    return json.loads(json.dumps(obj, default=to_json))
+
+
+def assert_patch_applies(old: dict, new: dict):
+    delta = diff(old, new)
+    assert json_delta.patch(wire(old), wire(delta)) == wire(new)
+    return delta
+
+
+def test_diff_unchanged():
+    old = {"id": "c", "nodes": {"n1": {"pods": {"a": {"phase": "Running"}}}}}
+    assert diff(old, copy.deepcopy(old)) == []
+
+
+def test_diff_changed_pods_and_nodes():
+    old = {
+        "id": "c",
+        "nodes": {
+            "n1": {"labels": {}, "pods": {"a": {"phase": "Pending", "containers": []}}},
+            "n2": {"labels": {}, "pods": {}},
+        },
+        "unassigned_pods": {"b": {"phase": "Pending"}},
+    }
+    new = copy.deepcopy(old)
+    new["nodes"]["n1"]["pods"]["a"]["phase"] = "Running"
+    new["nodes"]["n1"]["pods"]["a"]["containers"].append({"name": "main"})
+    del new["nodes"]["n2"]
+    new["nodes"]["n3"] = {"labels": {"role": "worker"}, "pods": {}}
+    del new["unassigned_pods"]["b"]
+    delta = assert_patch_applies(old, new)
+    assert [["nodes", "n1", "pods", "a", "phase"], "Running"] in delta
+    assert [["nodes", "n2"]] in delta
+
+
+def test_diff_mock_clusters():
+    for cluster in MockDiscoverer().get_clusters():
+        old = query_mock_cluster(cluster)
+        new = query_mock_cluster(cluster)
+        assert_patch_applies(old, new)
+
+
+def test_merge():
+    first = [[["nodes", "n1", "pods", "a", "phase"], "Running"], [["nodes", "n2"]]]
+    second = [[["nodes", "n1", "pods", "a"]], [["nodes", "n3"], {"pods": {}}]]
+    assert merge(first, second) == [[["nodes", "n2"]]] + second
+    assert merge([], second) == second
+    assert merge(first, []) == first
+
+
+def test_merge_mock_clusters():
+    for cluster in MockDiscoverer().get_clusters():
+        first = query_mock_cluster(cluster)
+        second = copy.deepcopy(first)
+        second["unassigned_pods"] = {}
+        third = copy.deepcopy(second)
+        del third["nodes"][next(iter(third["nodes"]))]
+        merged = merge(diff(first, second), diff(second, third))
+        assert json_delta.patch(wire(first), wire(merged)) == wire(third)
+
+
+def test_delta_coalescer():
+    coalescer = DeltaCoalescer(10, keepalive=5)
+    stanza = [["id"], "x"]
+    # first delta is released immediately
+    assert coalescer.add("c", [stanza], 100) == [stanza]
+    # empty delta is suppressed within the keepalive period
+    assert coalescer.add("c", [], 101) is None
+    assert coalescer.add("c", [stanza], 102) is None
+    assert coalescer.add("c", [], 103) is None
+    assert coalescer.flush(105) == []
+    assert coalescer.flush(110) == [("c", [stanza])]
+    assert coalescer.flush(120) == []
+    # empty delta as keepalive after the interval
+    assert coalescer.add("c", [], 121) == []
+    # keepalives for clusters without (queried) deltas
+    assert coalescer.keepalives(["c", "d"], 122) == ["d"]
+    assert coalescer.keepalives(["c", "d"], 125) == []
+    assert coalescer.add("c", [stanza], 131) == [stanza]
+    # not while a delta is pending
+    assert coalescer.add("c", [stanza], 132) is None
+    assert coalescer.keepalives(["c", "d"], 140) == ["d"]
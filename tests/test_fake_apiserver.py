@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from benchmarks.fake_apiserver import create_app
+from benchmarks.fake_apiserver import FakeCluster
+from benchmarks.fake_apiserver import serve
+from kube_ops_view.cluster_discovery import StaticClusterDiscoverer
+from kube_ops_view.kubernetes import query_kubernetes_cluster
+from kube_ops_view.kubernetes import QueryProfiles
+
+
+@pytest.fixture
+def server():
+    (server,) = serve([FakeCluster(nodes=10, pods_per_node=60)], 0)
+    yield server
+    server.shutdown()
+
+
+def test_query_fake_cluster(server):
+    (cluster,) = StaticClusterDiscoverer(
+        ["http://localhost:{}".format(server.server_port)]
+    ).get_clusters()
+    # more pods than one page
+    data = query_kubernetes_cluster(cluster)
+    assert len(data["nodes"]) == 10
+    pods = [pod for node in data["nodes"].values() for pod in node.pods.values()]
+    assert len(pods) == 600
+    assert all(container.usage for pod in pods for container in pod.containers)
+    assert all(node.usage for node in data["nodes"].values())
+
+    profiles = QueryProfiles(
+        {"default": {"namespaces": ["namespace-1"], "pod_label_selector": "x=y"}}
+    )
+    data = query_kubernetes_cluster(cluster, profiles)
+    assert not any(node.pods for node in data["nodes"].values())
+
+
+def test_list_and_watch():
+    cluster = FakeCluster(nodes=2, pods_per_node=3)
+    client = create_app(cluster).test_client()
+    page = client.get("/api/v1/pods?limit=4").get_json()
+    assert len(page["items"]) == 4
+    # continued from the same list
+    cluster.replace_pods(2)
+    rest = client.get(
+        "/api/v1/pods?limit=4&continue=" + page["metadata"]["continue"]
+    ).get_json()
+    assert [pod["metadata"]["name"] for pod in rest["items"]] == [
+        "app-4-00000004",
+        "app-5-00000005",
+    ]
+    assert "continue" not in rest["metadata"]
+
+    response = client.get(
+        "/api/v1/pods?watch=true&timeoutSeconds=0&resourceVersion="
+        + page["metadata"]["resourceVersion"]
+    )
+    events = [json.loads(line) for line in response.data.splitlines()]
+    assert [
+        (event["type"], event["object"]["metadata"]["name"]) for event in events
+    ] == [
+        ("DELETED", "app-0-00000000"),
+        ("ADDED", "app-6-00000006"),
+        ("DELETED", "app-1-00000001"),
+        ("ADDED", "app-7-00000007"),
+    ]
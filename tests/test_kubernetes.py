@@ -0,0 +1,157 @@
+import datetime
+
+import pytest
+
+from kube_ops_view.cluster_discovery import Cluster
+from kube_ops_view.kubernetes import PaginatedList
+from kube_ops_view.kubernetes import parse_time
+from kube_ops_view.kubernetes import query_kubernetes_cluster
+from kube_ops_view.kubernetes import QueryProfiles
+
+
+class FakeResponse:
+    def __init__(self, data: dict):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeClient:
+
+    """Serves LIST requests for the given objects by endpoint, two objects per page."""
+
+    def __init__(self, objects: dict):
+        self.objects = objects
+        self.requests = []
+
+    def get(
+        self, url: str, version: str = "v1", namespace: str = None, params: dict = None
+    ):
+        params = params or {}
+        self.requests.append((version, url, dict(params)))
+        items = [
+            obj
+            for obj in self.objects.get((version, url), [])
+            if namespace in (None, obj["metadata"].get("namespace"))
+        ]
+        offset = int(params.get("continue", 0))
+        limit = min(params.get("limit", len(items)), 2)
+        metadata = {"resourceVersion": "123"}
+        if offset + limit < len(items):
+            metadata["continue"] = str(offset + limit)
+        return FakeResponse(
+            {"metadata": metadata, "items": items[offset : offset + limit]}
+        )
+
+
+def pod(name: str, node_name: str, namespace="default"):
+    return {
+        "metadata": {"name": name, "namespace": namespace},
+        "spec": {
+            "nodeName": node_name,
+            "containers": [{"name": "main", "image": "foo", "resources": {}}],
+        },
+        "status": {"phase": "Running"},
+    }
+
+
+def test_paginated_list():
+    client = FakeClient({("v1", "pods"): [pod(str(i), "n1") for i in range(5)]})
+    objects = PaginatedList(client, "pods", page_size=2)
+    names = [obj["metadata"]["name"] for obj in objects]
+    assert names == ["0", "1", "2", "3", "4"]
+    assert objects.resource_version == "123"
+    assert [params.get("continue") for _, _, params in client.requests] == [
+        None,
+        "2",
+        "4",
+    ]
+
+
+def test_query_kubernetes_cluster():
+    client = FakeClient(
+        {
+            ("v1", "nodes"): [{"metadata": {"name": "n1", "labels": {}}, "status": {}}],
+            ("v1", "pods"): [pod("a", "n1"), pod("b", "n1"), pod("c", None)],
+            ("metrics.k8s.io/v1beta1", "pods"): [
+                {
+                    "metadata": {"name": "a", "namespace": "default"},
+                    "containers": [{"name": "main", "usage": {"cpu": "1m"}}],
+                }
+            ],
+        }
+    )
+    cluster = Cluster("c", "c", "https://c.example.org", client)
+    data = query_kubernetes_cluster(cluster)
+    pods = data["nodes"]["n1"].pods
+    assert set(pods) == {"default/a", "default/b"}
+    assert set(data["unassigned_pods"]) == {"default/c"}
+    usage = pods["default/a"].containers[0].usage
+    assert usage == {"cpu": "1m"}
+
+
+def test_query_profiles():
+    profiles = QueryProfiles(
+        {
+            "default": {
+                "pod_field_selector": "status.phase!=Succeeded",
+                "exclude_namespaces": ["kube-system"],
+            },
+            "clusters": {"c": {"namespaces": ["a", "b"], "exclude_namespaces": []}},
+        }
+    )
+    assert profiles.get("other").pod_params() == {
+        "fieldSelector": "status.phase!=Succeeded,metadata.namespace!=kube-system"
+    }
+    assert profiles.get("other").pod_namespaces == [None]
+    assert profiles.get("c").pod_namespaces == ["a", "b"]
+
+    client = FakeClient(
+        {("v1", "pods"): [pod("x", "n1", "a"), pod("y", "n1", "b"), pod("z", "n1")]}
+    )
+    cluster = Cluster("c", "c", "https://c.example.org", client)
+    data = query_kubernetes_cluster(cluster, query_profiles=profiles)
+    assert set(data["unassigned_pods"]) == {"a/x", "b/y"}
+
+
+def test_query_profiles_node_label_selector():
+    client = FakeClient(
+        {
+            ("v1", "nodes"): [{"metadata": {"name": "n1", "labels": {}}, "status": {}}],
+            ("v1", "pods"): [pod("a", "n1"), pod("b", "n2"), pod("c", None)],
+        }
+    )
+    cluster = Cluster("c", "c", "https://c.example.org", client)
+    profiles = QueryProfiles({"default": {"node_label_selector": "pool=a"}})
+    data = query_kubernetes_cluster(cluster, query_profiles=profiles)
+    assert ("v1", "nodes", {"labelSelector": "pool=a"}) in [
+        (version, url, {k: v for k, v in params.items() if k != "limit"})
+        for version, url, params in client.requests
+    ]
+    assert set(data["nodes"]["n1"].pods) == {"default/a"}
+    # pods on filtered out nodes are not "unassigned"
+    assert set(data["unassigned_pods"]) == {"default/c"}
+
+
+def test_query_profiles_unknown_keys(tmp_path):
+    path = tmp_path / "profiles.yaml"
+    path.write_text("default:\n  pod_label_selektor: a=b\n")
+    with pytest.raises(ValueError, match="pod_label_selektor"):
+        QueryProfiles.from_file(path)
+    with pytest.raises(ValueError, match="cluster"):
+        QueryProfiles({"cluster": {}})
+
+
+def test_parse_time():
+    for s in ("2020-02-29T23:59:58Z", "1970-01-01T00:00:00Z"):
+        expected = (
+            datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ")
+            .replace(tzinfo=datetime.timezone.utc)
+            .timestamp()
+        )
+        assert parse_time(s) == expected
+        assert isinstance(parse_time(s), float)
@@ -0,0 +1,63 @@
+from kube_ops_view import metrics
+from kube_ops_view.broadcast import Broadcaster
+from kube_ops_view.metrics import Counter
+from kube_ops_view.metrics import Histogram
+from kube_ops_view.metrics import SSE_DROPPED_EVENTS
+from kube_ops_view.metrics import SSE_RESYNCS
+
+
+def test_render_counter():
+    counter = Counter("test_requests_total", "Number of requests", ["path"])
+    counter.labels("/").inc()
+    counter.labels('/"x"').inc(2)
+    assert counter.render() == [
+        "# HELP test_requests_total Number of requests",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{path="/"} 1',
+        'test_requests_total{path="/\\"x\\""} 2',
+    ]
+    counter.remove("/")
+    assert len(counter.render()) == 3
+    metrics.REGISTRY.remove(counter)
+
+
+def test_render_histogram():
+    histogram = Histogram("test_duration_seconds", "Duration", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert histogram.render()[2:] == [
+        'test_duration_seconds_bucket{le="0.1"} 1',
+        'test_duration_seconds_bucket{le="1"} 2',
+        'test_duration_seconds_bucket{le="+Inf"} 3',
+        "test_duration_seconds_count 3",
+        "test_duration_seconds_sum 5.55",
+    ]
+    metrics.REGISTRY.remove(histogram)
+
+
+def test_broadcaster_metrics():
+    broadcaster = Broadcaster(None, max_queued_events=3)
+    subscription = broadcaster.subscribe(["a"], remote_addr="10.0.0.1")
+    broadcaster.subscribe(["a"], remote_addr="10.0.0.2")
+    broadcaster.publish("clusterdelta", {"cluster_id": "a", "delta": []})
+    broadcaster.update_metrics()
+    text = metrics.render()
+    assert "kube_ops_view_sse_clients 2\n" in text
+    assert "kube_ops_view_sse_queued_events 2\n" in text
+    assert "kube_ops_view_sse_max_queued_events 1\n" in text
+    assert 'kube_ops_view_event_size_bytes_count{type="clusterdelta"}' in text
+
+    # counted when the events are dropped
+    dropped = SSE_DROPPED_EVENTS.labels().value
+    resyncs = SSE_RESYNCS.labels().value
+    slow = broadcaster.subscribe(["b"], resync=lambda: [])
+    for i in range(4):
+        broadcaster.publish("clusterdelta", {"cluster_id": "b", "delta": [i]})
+    assert SSE_DROPPED_EVENTS.labels().value == dropped + 4
+    assert SSE_RESYNCS.labels().value == resyncs + 1
+    broadcaster.unsubscribe(slow)
+
+    broadcaster.unsubscribe(subscription)
+    broadcaster.update_metrics()
+    assert "kube_ops_view_sse_clients 1\n" in metrics.render()
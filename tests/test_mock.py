@@ -7,3 +7,30 @@ def test_query_mock_clusters():
     for cluster in discoverer.get_clusters():
         data = query_mock_cluster(cluster)
         assert data["id"].startswith("mock-cluster-")
+
+
+def test_query_large_mock_cluster(monkeypatch):
+    discoverer = MockDiscoverer(clusters=5)
+    clusters = list(discoverer.get_clusters())
+    assert [cluster.id for cluster in clusters][-1] == "mock-cluster-4"
+
+    def query(now: float):
+        monkeypatch.setattr("time.time", lambda: now)
+        return query_mock_cluster(
+            clusters[4], nodes=20, pods_per_node=50, containers_per_pod=3, churn=0.1
+        )
+
+    data = query(1000)
+    assert len(data["nodes"]) == 20
+    pods = {
+        key: pod for node in data["nodes"].values() for key, pod in node.pods.items()
+    }
+    assert len(pods) == 1000
+    assert all(len(pod.containers) == 3 for pod in pods.values())
+    # same data without churn (deterministic)
+    assert query(1000) == data
+    # about 10% of the pods are replaced per second
+    replaced = pods.keys() - {
+        key for node in query(1001)["nodes"].values() for key in node.pods
+    }
+    assert 50 < len(replaced) < 150
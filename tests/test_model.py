@@ -0,0 +1,101 @@
+import json
+
+from kube_ops_view.kubernetes import map_pod_and_containers
+from kube_ops_view.model import Container
+from kube_ops_view.model import Node
+from kube_ops_view.model import to_json
+
+
+def pod(name: str):
+    # decode from JSON to get distinct string objects as from the API
+    return json.loads(
+        json.dumps(
+            {
+                "metadata": {
+                    "name": name,
+                    "namespace": "default",
+                    "labels": {"a": "b"},
+                },
+                "spec": {
+                    "containers": [
+                        {
+                            "name": "main",
+                            "image": "foo",
+                            "resources": {"requests": {"cpu": "1"}},
+                        }
+                    ]
+                },
+                "status": {
+                    "phase": "Running",
+                    "containerStatuses": [
+                        {"name": "main", "ready": True, "restartCount": 2}
+                    ],
+                },
+            }
+        )
+    )
+
+
+def test_wire_format():
+    node = Node("n1", {}, {"capacity": {"cpu": "1"}})
+    node.pods["default/a"] = map_pod_and_containers(pod("a"))
+    assert json.loads(json.dumps(node, default=to_json)) == {
+        "name": "n1",
+        "labels": {},
+        "status": {"capacity": {"cpu": "1"}},
+        "pods": {
+            "default/a": {
+                "name": "a",
+                "namespace": "default",
+                "labels": {"a": "b"},
+                "phase": "Running",
+                "startTime": "",
+                "containers": [
+                    {
+                        "name": "main",
+                        "image": "foo",
+                        "resources": {"requests": {"cpu": "1"}},
+                        "ready": True,
+                        "restartCount": 2,
+                    }
+                ],
+            }
+        },
+    }
+
+
+def test_strings_are_interned():
+    a = map_pod_and_containers(pod("a"))
+    b = map_pod_and_containers(pod("b"))
+    assert a.namespace is b.namespace
+    assert a.phase is b.phase
+    assert list(a.labels)[0] is list(b.labels)[0]
+    assert a.labels["a"] is b.labels["a"]
+    assert a.containers[0].image is b.containers[0].image
+    assert a.containers[0].resources is b.containers[0].resources
+
+
+def test_equality_and_replace():
+    container = Container("main", "foo", {})
+    assert container == Container("main", "foo", {})
+    changed = container.replace(usage={"cpu": "1m"})
+    assert changed != container
+    assert changed.name == "main"
+    assert container.usage is None
+    assert to_json(changed)["resources"] == {"usage": {"cpu": "1m"}}
+
+
+def test_container_status_does_not_override_spec():
+    container = Container(
+        "main",
+        "foo",
+        {"requests": {"cpu": "1"}},
+        status={"ready": True, "resources": {"requests": {"cpu": "2"}}},
+        usage={"cpu": "1m"},
+    )
+    assert to_json(container) == {
+        "name": "main",
+        "image": "foo",
+        "resources": {"requests": {"cpu": "1"}, "usage": {"cpu": "1m"}},
+        "ready": True,
+    }
@@ -0,0 +1,28 @@
+import time
+
+import gevent
+
+from kube_ops_view.profiler import Profiler
+
+
+def busy(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+
+
+def test_profile_greenlets():
+    profiler = Profiler(interval=0.001)
+    profiler.start()
+    gevent.spawn(busy, 0.2).join()
+    profiler.stop()
+    collapsed = profiler.collapsed()
+    assert collapsed.startswith("busy;busy (")
+    for line in collapsed.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+    stats = {greenlet["name"]: greenlet for greenlet in profiler.greenlet_stats()}
+    assert stats["busy"]["runs"] == 1
+    assert stats["busy"]["max_run_seconds"] >= 0.2
+    assert stats["busy"]["cpu_seconds"] > 0.1
+    assert "main" in stats
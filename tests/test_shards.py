@@ -0,0 +1,20 @@
+from kube_ops_view.shards import assign_clusters
+from kube_ops_view.shards import generate_replica_id
+
+
+def test_assign_clusters():
+    cluster_ids = ["cluster-{}".format(i) for i in range(100)]
+    assert assign_clusters(cluster_ids, []) == {}
+    assignment = assign_clusters(cluster_ids, ["a", "b"])
+    # independent of the order of replicas
+    assert assign_clusters(cluster_ids, ["b", "a"]) == assignment
+    assert 20 < list(assignment.values()).count("a") < 80
+    # a new replica only takes over clusters, the others keep their assignment
+    new_assignment = assign_clusters(cluster_ids, ["a", "b", "c"])
+    for cluster_id, replica_id in new_assignment.items():
+        assert replica_id in ("c", assignment[cluster_id])
+    assert "c" in new_assignment.values()
+
+
+def test_generate_replica_id():
+    assert generate_replica_id() != generate_replica_id()
@@ -0,0 +1,289 @@
+import copy
+import json
+import threading
+import time
+
+import pytest
+
+from kube_ops_view import stores
+from kube_ops_view.cluster_discovery import MockDiscoverer
+from kube_ops_view.metrics import STORE_DURATION
+from kube_ops_view.mock import query_mock_cluster
+from kube_ops_view.stores import ACQUIRE_LEASE_SCRIPT
+from kube_ops_view.stores import CachedClusterData
+from kube_ops_view.stores import Codec
+from kube_ops_view.stores import dumps
+from kube_ops_view.stores import join_cluster_data
+from kube_ops_view.stores import join_encoded_cluster_data
+from kube_ops_view.stores import MemoryStore
+from kube_ops_view.stores import msgpack
+from kube_ops_view.stores import NODE_FIELD_PREFIX
+from kube_ops_view.stores import RedisStore
+from kube_ops_view.stores import RELEASE_LEASE_SCRIPT
+from kube_ops_view.stores import split_cluster_data
+
+
+def test_memory_store_cluster_data_encoded():
+    store = MemoryStore()
+    assert store.get_cluster_data_encoded("mock-cluster-0") is None
+    cluster = next(iter(MockDiscoverer().get_clusters()))
+    data = query_mock_cluster(cluster)
+    store.set_cluster_data(cluster.id, data)
+    encoded = store.get_cluster_data_encoded(cluster.id)
+    assert json.loads(encoded) == json.loads(dumps(data))
+    # cached until the data changes
+    assert store.get_cluster_data_encoded(cluster.id) is encoded
+    store.set_cluster_data(cluster.id, {"id": cluster.id})
+    assert json.loads(store.get_cluster_data_encoded(cluster.id)) == {"id": cluster.id}
+
+
+def test_memory_store_cluster_statuses():
+    store = MemoryStore()
+    store.set_cluster_status("a", {"last_query_time": 1})
+    single = STORE_DURATION.labels("get_cluster_status")
+    multiple = STORE_DURATION.labels("get_cluster_statuses")
+    count, multiple_count = single.count, multiple.count
+    assert store.get_cluster_statuses(["a", "b"]) == {
+        "a": {"last_query_time": 1},
+        "b": {},
+    }
+    # observed once for all clusters
+    assert (single.count, multiple.count) == (count, multiple_count + 1)
+
+
+def test_codecs():
+    data = query_mock_cluster(next(iter(MockDiscoverer().get_clusters())))
+    expected = json.loads(dumps(data))
+    formats = ["json"] + (["msgpack"] if msgpack else [])
+    for format in formats:
+        for compress in (False, True):
+            codec = Codec(format, compress)
+            assert codec.loads(codec.dumps(data)) == expected
+            assert vars(Codec.from_name(codec.name)) == vars(codec)
+
+
+def test_cached_cluster_data():
+    codec = Codec()
+    data = codec.dumps({"id": "c", "nodes": {}})
+    cached = CachedClusterData(1, codec, data=data)
+    # plain JSON is passed through without decoding
+    assert cached.encoded is data
+    assert cached.value == {"id": "c", "nodes": {}}
+    written = CachedClusterData(2, Codec(compress=True), value={"id": "c"})
+    assert json.loads(written.encoded) == {"id": "c"}
+
+
+def test_split_and_join_cluster_data():
+    data = json.loads(
+        dumps(query_mock_cluster(next(iter(MockDiscoverer().get_clusters()))))
+    )
+    fields = split_cluster_data(data)
+    assert len(fields) == len(data["nodes"]) + 2
+    assert join_cluster_data(fields) == data
+    encoded = {field: dumps(value).encode("utf-8") for field, value in fields.items()}
+    assert json.loads(join_encoded_cluster_data(encoded)) == data
+    cached = CachedClusterData(1, Codec(), fields=encoded)
+    assert cached.value == data
+    assert json.loads(cached.encoded) == data
+
+
+def test_memory_store_snapshot(tmp_path):
+    path = str(tmp_path / "snapshot")
+    store = MemoryStore(path)
+    cluster = next(iter(MockDiscoverer().get_clusters()))
+    data = query_mock_cluster(cluster)
+    store.set_cluster_ids({cluster.id})
+    store.set_cluster_status(cluster.id, {"last_query_time": time.time()})
+    store.set_cluster_data(cluster.id, data)
+    store.save_snapshot()
+
+    restarted = MemoryStore(path)
+    assert restarted.get_cluster_ids() == [cluster.id]
+    assert restarted.get_cluster_status(cluster.id)["stale"]
+    assert restarted.get_cluster_data(cluster.id) == json.loads(dumps(data))
+    # no file yet
+    assert MemoryStore(str(tmp_path / "missing")).get_cluster_ids() == []
+
+
+def test_memory_store_concurrent_access():
+    # e.g. updater, requests and listener threads of the asyncio runtime
+    store = MemoryStore()
+    store.publish("clusterdelta", {"cluster_id": "a", "delta": []})
+    first_id = store._events[0][0]
+    errors = []
+
+    def write():
+        for i in range(2000):
+            store.publish("clusterdelta", {"cluster_id": "a", "delta": [i]})
+            store.set("key", i)
+
+    def read():
+        try:
+            for _ in range(200):
+                store.read_events(first_id)
+                store.get_encoded("key")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write)] + [
+        threading.Thread(target=read) for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    # not the encoding of an older value
+    assert store.get_encoded("key") == b"1999"
+
+
+def test_redis_store_cluster_data(fake_redis):
+    store = RedisStore("redis://localhost")
+    cluster = next(iter(MockDiscoverer().get_clusters()))
+    data = json.loads(dumps(query_mock_cluster(cluster)))
+    store.set_cluster_data(cluster.id, data)
+    # read by another replica
+    assert RedisStore("redis://localhost").get_cluster_data(cluster.id) == data
+    key = "clusters:{}:shards".format(cluster.id)
+    assert len(fake_redis.written_fields(key)) == len(data["nodes"]) + 2
+
+    # only the changed node is written, the removed one is deleted
+    data = copy.deepcopy(data)
+    changed, removed = list(data["nodes"])[:2]
+    data["nodes"][changed]["labels"]["changed"] = "true"
+    del data["nodes"][removed]
+    fake_redis.commands.clear()
+    store.set_cluster_data(cluster.id, data)
+    assert fake_redis.written_fields(key) == [NODE_FIELD_PREFIX + changed]
+    assert ("hdel", (key, NODE_FIELD_PREFIX + removed), {}) in fake_redis.commands
+    assert RedisStore("redis://localhost").get_cluster_data(cluster.id) == data
+
+    # nothing written for unchanged data
+    fake_redis.commands.clear()
+    store.set_cluster_data(cluster.id, copy.deepcopy(data))
+    assert fake_redis.written_fields(key) == []
+
+
+def test_redis_store_cluster_data_version(fake_redis):
+    store = RedisStore("redis://localhost")
+    other = RedisStore("redis://localhost")
+    store.set_cluster_data("c", {"id": "c", "nodes": {}})
+    assert other.get_cluster_data("c")["id"] == "c"
+    # cached while the version does not change
+    fake_redis.commands.clear()
+    assert other.get_cluster_data("c")["id"] == "c"
+    assert [command[0] for command in fake_redis.commands] == ["mget"]
+
+    other.set_cluster_data("c", {"id": "c", "nodes": {}, "api_server_url": "x"})
+    assert store.get_cluster_data("c")["api_server_url"] == "x"
+    assert fake_redis.data["clusters:c:data-version"] == b"2"
+
+
+def test_redis_store_cluster_data_codecs(fake_redis):
+    json_store = RedisStore("redis://localhost")
+    other_codec = Codec("msgpack" if msgpack else "json", compress=True)
+    other_store = RedisStore("redis://localhost", other_codec)
+    data = {"id": "c", "nodes": {"n": {"name": "n"}}, "unassigned_pods": {}}
+    json_store.set_cluster_data("c", data)
+    assert other_store.get_cluster_data("c") == data
+
+    # readers use the format of the last writer, the other format's data is deleted
+    data["nodes"]["m"] = {"name": "m"}
+    other_store.set_cluster_data("c", data)
+    assert fake_redis.data["clusters:c:data-codec"] == other_codec.name.encode("utf-8")
+    assert "clusters:c:shards" not in fake_redis.data
+    assert json_store.get_cluster_data("c") == data
+    assert json.loads(json_store.get_cluster_data_encoded("c")) == data
+
+
+def test_redis_store_legacy_cluster_data(fake_redis):
+    # written as single value by older versions
+    fake_redis.data["clusters:c:data"] = dumps({"id": "c"}).encode("utf-8")
+    assert RedisStore("redis://localhost").get_cluster_data("c") == {"id": "c"}
+    assert RedisStore("redis://localhost").get_cluster_data("d") == {}
+
+
+def test_redis_store_batch(fake_redis):
+    store = RedisStore("redis://localhost")
+    round_trips = fake_redis.round_trips
+    with store.batch():
+        store.set_cluster_data("a", {"id": "a", "nodes": {}})
+        store.set_cluster_data("b", {"id": "b", "nodes": {}})
+        store.set_cluster_status("a", {"last_query_time": 1})
+        # not written yet, i.e. the cached version must not change either
+        assert "clusters:a:data-version" not in fake_redis.data
+        assert "a" not in store._cluster_data
+    # the version reads and one round trip for all writes
+    assert fake_redis.round_trips == round_trips + 3
+    assert store._cluster_data["a"].version == 1
+    assert store.get_cluster_status("a") == {"last_query_time": 1}
+
+    # nothing cached if the writes fail
+    fake_redis.error = ConnectionError()
+    with pytest.raises(ConnectionError):
+        with store.batch():
+            store.set_cluster_data("a", {"id": "a", "nodes": {}, "x": 1})
+    assert store._cluster_data["a"].version == 1
+    assert "x" not in store._cluster_data["a"].value
+
+
+def test_redis_store_leases(fake_redis):
+    store = RedisStore("redis://localhost")
+    other = RedisStore("redis://localhost")
+    assert store.acquire_leases("a", ["c1", "c2"], 30) == {"c1", "c2"}
+    assert (
+        "evalsha",
+        (ACQUIRE_LEASE_SCRIPT, ["clusters:c1:lease"], ["a", 30000]),
+        {},
+    ) in fake_redis.commands
+    assert other.acquire_leases("b", ["c1"], 30) == set()
+    # renewed by the holder
+    assert store.acquire_leases("a", ["c1"], 30) == {"c1"}
+
+    # handed over, only the holder can release a lease
+    store.release_leases("a", ["c1"])
+    other.release_leases("b", ["c2"])
+    assert (
+        "evalsha",
+        (RELEASE_LEASE_SCRIPT, ["clusters:c1:lease"], ["a"]),
+        {},
+    ) in fake_redis.commands
+    assert other.acquire_leases("b", ["c1", "c2"], 30) == {"c1"}
+
+    # expired
+    fake_redis.offset = 31
+    assert other.acquire_leases("b", ["c2"], 30) == {"c2"}
+    assert store.acquire_leases("a", ["c1", "c2"], 30) == {"c1"}
+
+
+def test_redis_store_register_replica(fake_redis):
+    store = RedisStore("redis://localhost")
+    assert store.register_replica("a", 10) == ["a"]
+    assert store.register_replica("b", 10) == ["a", "b"]
+    # no heartbeat of replica a within the TTL
+    fake_redis.data["replicas"][b"a"] -= 11
+    assert store.register_replica("b", 10) == ["b"]
+
+
+def test_redis_store_events(fake_redis, monkeypatch):
+    monkeypatch.setattr(stores, "EVENT_LOG_SIZE", 3)
+    store = RedisStore("redis://localhost")
+    assert store.read_events("0-0") is None
+    for i in range(5):
+        store.publish("clusterdelta", {"cluster_id": "a", "delta": [i]})
+    ids = [entry[0].decode("utf-8") for entry in fake_redis.data["events"]]
+    assert len(ids) == 3
+
+    # replayed after the given ID
+    assert store.read_events(ids[0]) == [
+        (ids[1], "clusterdelta", {"cluster_id": "a", "delta": [3]}),
+        (ids[2], "clusterdelta", {"cluster_id": "a", "delta": [4]}),
+    ]
+    assert store.read_events(ids[2]) == []
+    # trimmed out of the stream already
+    assert store.read_events("1-0") is None
+    # ID of another stream (e.g. before Redis was reset)
+    assert store.read_events("{}-0".format(int(ids[2].split("-")[0]) + 1)) is None
+
+    events = store.listen(ids[1])
+    assert next(events)[0] == ids[2]
@@ -0,0 +1,171 @@
+import collections
+import time
+
+import gevent
+
+from kube_ops_view.cluster_discovery import MockDiscoverer
+from kube_ops_view.delta import DeltaCoalescer
+from kube_ops_view.mock import query_mock_cluster
+from kube_ops_view.shards import assign_clusters
+from kube_ops_view.shards import LEASE_SECONDS
+from kube_ops_view.shards import REPLICA_TTL_SECONDS
+from kube_ops_view.stores import MemoryStore
+from kube_ops_view.stores import RedisStore
+from kube_ops_view.update import adapt_query_interval
+from kube_ops_view.update import apply_query_result
+from kube_ops_view.update import flush_deltas
+from kube_ops_view.update import update_clusters
+from kube_ops_view.update import update_leases
+
+
+def slow_query(cluster):
+    if cluster.id == "mock-cluster-2":
+        # never finishes within the query timeout
+        gevent.sleep(10)
+    gevent.sleep(0.2)
+    return query_mock_cluster(cluster)
+
+
+def test_update_clusters_concurrently():
+    store = MemoryStore()
+    greenlet = gevent.spawn(
+        update_clusters,
+        cluster_discoverer=MockDiscoverer(),
+        query_cluster=slow_query,
+        store=store,
+        query_interval=60,
+        query_concurrency=3,
+        query_timeout=0.5,
+    )
+    gevent.sleep(1.5)
+    greenlet.kill()
+    assert store.get_cluster_ids() == [
+        "mock-cluster-0",
+        "mock-cluster-1",
+        "mock-cluster-2",
+    ]
+    for cluster_id in ("mock-cluster-0", "mock-cluster-1"):
+        assert store.get_cluster_data(cluster_id)["id"] == cluster_id
+    assert not store.get_cluster_data("mock-cluster-2")
+    assert store.get_cluster_status("mock-cluster-2")["backoff"]["tries"] == 1
+
+
+def test_apply_query_result_uses_statuses():
+    store = MemoryStore()
+    cluster = next(iter(MockDiscoverer().get_clusters()))
+    data = query_mock_cluster(cluster)
+    statuses = store.get_cluster_statuses([cluster.id])
+    assert statuses == {cluster.id: {}}
+    coalescer = DeltaCoalescer(0)
+    apply_query_result(store, cluster, 10, data, None, {}, False, coalescer, statuses)
+    assert statuses[cluster.id]["last_query_time"] == 10
+    assert store.get_cluster_status(cluster.id) == statuses[cluster.id]
+    # an older result is ignored without reading the status again
+    store.set_cluster_status(cluster.id, {})
+    apply_query_result(store, cluster, 5, {}, None, {}, False, coalescer, statuses)
+    assert store.get_cluster_status(cluster.id) == {}
+
+
+def test_adapt_query_interval():
+    # no changes
+    assert adapt_query_interval(10, False, 0.1, 5, 60) == 15
+    assert adapt_query_interval(50, False, 0.1, 5, 60) == 60
+    # changes
+    assert adapt_query_interval(20, True, 0.1, 5, 60) == 10
+    assert adapt_query_interval(6, True, 0.1, 5, 60) == 5
+    # expensive query
+    assert adapt_query_interval(6, True, 3, 5, 60) == 30
+    assert adapt_query_interval(6, True, 30, 5, 60) == 60
+
+
+def test_apply_query_result_adapts_query_interval():
+    store = MemoryStore()
+    cluster = next(iter(MockDiscoverer().get_clusters()))
+    data = query_mock_cluster(cluster)
+    snapshots: dict = {}
+    coalescer = DeltaCoalescer(0)
+    for expected in (5, 7.5, 11.25):
+        apply_query_result(
+            store,
+            cluster,
+            time.time(),
+            data,
+            None,
+            snapshots,
+            False,
+            coalescer,
+            query_interval=5,
+            max_query_interval=60,
+        )
+        assert store.get_cluster_status(cluster.id)["query_interval"] == expected
+
+
+def test_flush_deltas_keepalives():
+    store = MemoryStore()
+    published = []
+    store.publish = lambda event_type, data: published.append(data)
+    coalescer = DeltaCoalescer(0, keepalive=10)
+    snapshots = {cluster_id: (0, {}) for cluster_id in ("a", "b", "c")}
+    statuses = {"a": {}, "b": {"backoff": {"tries": 1}}, "c": {}, "d": {}}
+    flush_deltas(store, coalescer, {"a", "b", "c", "d"}, snapshots, statuses, {"c"})
+    # no keepalives for failing, running or never queried clusters
+    assert published == [{"cluster_id": "a", "delta": []}]
+    flush_deltas(store, coalescer, {"a"}, snapshots, statuses, set())
+    assert len(published) == 1
+
+
+def test_update_clusters_slows_down_without_viewers():
+    store = MemoryStore()
+    store.touch_viewed_clusters(["mock-cluster-0"])
+    queries: collections.Counter = collections.Counter()
+
+    def query_cluster(cluster):
+        queries[cluster.id] += 1
+        return query_mock_cluster(cluster)
+
+    greenlet = gevent.spawn(
+        update_clusters,
+        cluster_discoverer=MockDiscoverer(),
+        query_cluster=query_cluster,
+        store=store,
+        query_interval=0.1,
+        idle_query_interval=60,
+    )
+    gevent.sleep(1)
+    greenlet.kill()
+    assert queries["mock-cluster-0"] > 2
+    assert queries["mock-cluster-1"] == queries["mock-cluster-2"] == 1
+
+
+def test_update_leases_across_replicas(fake_redis):
+    cluster_ids = {"cluster-{}".format(i) for i in range(20)}
+    assignment = assign_clusters(cluster_ids, ["a", "b"])
+    shares = {
+        replica_id: {key for key, owner in assignment.items() if owner == replica_id}
+        for replica_id in ("a", "b")
+    }
+    replicas = {
+        replica_id: (RedisStore("redis://localhost"), DeltaCoalescer(0))
+        for replica_id in ("a", "b")
+    }
+    leases: dict = {"a": set(), "b": set()}
+
+    def update(replica_id):
+        store, coalescer = replicas[replica_id]
+        leases[replica_id] = update_leases(
+            store, replica_id, cluster_ids, leases[replica_id], {}, coalescer
+        )
+        return leases[replica_id]
+
+    assert update("a") == cluster_ids
+    # still leased by replica a
+    assert update("b") == set()
+    # replica a hands over the clusters assigned to b
+    assert update("a") == shares["a"]
+    assert update("b") == shares["b"]
+
+    # replica b drops out of the heartbeat, its leases expire later
+    fake_redis.data["replicas"][b"b"] -= REPLICA_TTL_SECONDS + 1
+    assert update("a") == shares["a"]
+    fake_redis.offset = LEASE_SECONDS + 1
+    assert update("a") == cluster_ids
@@ -0,0 +1,46 @@
+import subprocess
+import sys
+import time
+
+import gevent
+import pytest
+
+from kube_ops_view.utils import run_concurrently
+from kube_ops_view.utils import stable_hash
+
+
+def sleep_and_return(seconds: float, value):
+    gevent.sleep(seconds)
+    return value
+
+
+def fail():
+    raise ValueError("failed")
+
+
+def test_run_concurrently():
+    start = time.time()
+    results = run_concurrently(
+        (sleep_and_return, 0.2, "a"), (sleep_and_return, 0.2, "b"), (dict,)
+    )
+    assert results == ["a", "b", {}]
+    assert time.time() - start < 0.35
+
+
+def test_run_concurrently_error():
+    with pytest.raises(ValueError):
+        run_concurrently((sleep_and_return, 5, "a"), (fail,))
+
+
+def test_stable_hash():
+    assert stable_hash("a", 1) == stable_hash("a", "1")
+    assert stable_hash("a", 1) != stable_hash("a", 2)
+    # hash() of strings differs between processes (PYTHONHASHSEED)
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            "from kube_ops_view.utils import stable_hash; print(stable_hash('a', 1))",
+        ]
+    )
+    assert int(output) == stable_hash("a", 1)
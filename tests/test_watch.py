@@ -0,0 +1,187 @@
+import time
+
+import gevent
+import gevent.threadpool
+import pytest
+
+from benchmarks import fake_apiserver
+from benchmarks.fake_apiserver import FakeCluster
+from benchmarks.fake_apiserver import serve
+from kube_ops_view import watch
+from kube_ops_view.cluster_discovery import StaticClusterDiscoverer
+from kube_ops_view.watch import ClusterState
+from kube_ops_view.watch import ResourceWatcher
+from kube_ops_view.watch import WatchingClusterQuery
+
+
+def node(name: str, cpu="4"):
+    return {
+        "metadata": {"name": name, "labels": {}},
+        "status": {"capacity": {"cpu": cpu}, "allocatable": {"cpu": cpu}},
+    }
+
+
+def pod(name: str, node_name=None, phase="Running"):
+    return {
+        "metadata": {"name": name, "namespace": "default"},
+        "spec": {
+            "nodeName": node_name,
+            "containers": [{"name": "main", "image": "foo", "resources": {}}],
+        },
+        "status": {"phase": phase},
+    }
+
+
+def test_cluster_state_incremental_snapshot():
+    state = ClusterState()
+    state.reset_nodes([node("n1"), node("n2")])
+    state.reset_pods([pod("a", "n1"), pod("b", "n2"), pod("c")])
+    nodes, unassigned = state.snapshot(0)
+    assert set(nodes["n1"].pods) == {"default/a"}
+    assert set(unassigned) == {"default/c"}
+
+    state.apply_pod_event("MODIFIED", pod("c", "n1"))
+    new_nodes, new_unassigned = state.snapshot(0)
+    assert set(new_nodes["n1"].pods) == {"default/a", "default/c"}
+    assert new_unassigned == {}
+    # unchanged nodes are shared with the previous snapshot
+    assert new_nodes["n2"] is nodes["n2"]
+
+    state.apply_node_event("DELETED", node("n2"))
+    nodes, unassigned = state.snapshot(0)
+    assert "n2" not in nodes
+    assert set(unassigned) == {"default/b"}
+
+
+def test_cluster_state_relist_removes_missing_objects():
+    state = ClusterState()
+    state.reset_nodes([node("n1")])
+    state.reset_pods([pod("a", "n1"), pod("b", "n1")])
+    state.snapshot(0)
+    state.reset_pods([pod("b", "n1")])
+    nodes, _ = state.snapshot(0)
+    assert set(nodes["n1"].pods) == {"default/b"}
+
+
+def test_cluster_state_metrics():
+    state = ClusterState()
+    state.reset_nodes([node("n1")])
+    state.reset_pods([pod("a", "n1")])
+    state.set_node_usage({"n1": {"cpu": "1"}})
+    state.set_pod_metrics({"default/a": {"main": {"cpu": "10m"}}})
+    nodes, _ = state.snapshot(0)
+    assert nodes["n1"].usage == {"cpu": "1"}
+    container = nodes["n1"].pods["default/a"].containers[0]
+    assert container.usage == {"cpu": "10m"}
+
+
+def test_cluster_state_relist_namespace():
+    state = ClusterState()
+    other = pod("b", "n1")
+    other["metadata"]["namespace"] = "other"
+    state.reset_pods([pod("a"), other])
+    state.reset_pods([], namespace="default")
+    _, unassigned = state.snapshot(0)
+    assert set(unassigned) == {"other/b"}
+
+
+def test_cluster_state_filtered_nodes():
+    state = ClusterState(nodes_filtered=True)
+    state.reset_nodes([node("n1")])
+    state.reset_pods([pod("a", "n1"), pod("b", "n2"), pod("c")])
+    nodes, unassigned = state.snapshot(0)
+    assert set(nodes["n1"].pods) == {"default/a"}
+    assert set(unassigned) == {"default/c"}
+
+
+class CooperativeClient:
+
+    """HTTP client running the blocking requests in a thread pool.
+
+    Sockets are not monkey patched in tests, i.e. requests in greenlets would block all
+    other greenlets (e.g. the other watches).
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pool = gevent.threadpool.ThreadPool(10)
+
+    def get(self, **kwargs):
+        response = self.pool.apply(self.client.get, kwds=kwargs)
+        if kwargs.get("stream"):
+            lines = response.iter_lines()
+            response.iter_lines = lambda: iter(
+                lambda: self.pool.apply(next, (lines, None)), None
+            )
+        return response
+
+
+@pytest.fixture
+def fake_cluster(monkeypatch):
+    # short watches and a short event log to run into expired resource versions
+    monkeypatch.setattr(watch, "WATCH_TIMEOUT_SECONDS", 1)
+    monkeypatch.setattr(fake_apiserver, "EVENT_LOG_SIZE", 10)
+    monkeypatch.setattr(fake_apiserver, "BOOKMARK_INTERVAL_SECONDS", 0.2)
+    cluster = FakeCluster(nodes=3, pods_per_node=4)
+    (server,) = serve([cluster], 0)
+    yield cluster, "http://localhost:{}".format(server.server_port)
+    server.shutdown()
+
+
+def pod_names(data: dict):
+    return {
+        pod.name
+        for node in data["nodes"].values()
+        for pod in node.pods.values()
+        if pod.name
+    }
+
+
+def wait_for_pods(query, cluster, names: set, timeout: float = 5):
+    deadline = time.time() + timeout
+    while True:
+        data = query(cluster)
+        if pod_names(data) == names or time.time() > deadline:
+            return pod_names(data)
+        gevent.sleep(0.1)
+
+
+def test_watching_cluster_query(fake_cluster, monkeypatch):
+    fake, url = fake_cluster
+    (cluster,) = StaticClusterDiscoverer([url]).get_clusters()
+    cluster.client = CooperativeClient(cluster.client)
+    lists = []
+    original_list = ResourceWatcher.list
+
+    def count_list(watcher):
+        lists.append(watcher.endpoint)
+        original_list(watcher)
+
+    monkeypatch.setattr(ResourceWatcher, "list", count_list)
+    query = WatchingClusterQuery(sync_timeout=5)
+    try:
+        data = query(cluster)
+        assert len(pod_names(data)) == 12
+        assert sorted(lists) == ["nodes", "pods"]
+
+        # resumed after the server-side timeout of the watch (without a new LIST)
+        gevent.sleep(1.5)
+        fake.replace_pods(2)
+        expected = {pod["metadata"]["name"] for pod in fake.pods.values()}
+        assert wait_for_pods(query, cluster, expected) == expected
+        assert sorted(lists) == ["nodes", "pods"]
+        # the nodes watch only receives bookmarks
+        nodes_watcher = query._watchers[cluster.id]._watchers[0]
+        deadline = time.time() + 2
+        while int(nodes_watcher.resource_version) < fake.resource_version:
+            assert time.time() < deadline
+            gevent.sleep(0.1)
+
+        # more changes at once than the event log keeps: ERROR event with 410 Gone
+        fake.replace_pods(8)
+        expected = {pod["metadata"]["name"] for pod in fake.pods.values()}
+        assert wait_for_pods(query, cluster, expected) == expected
+        # listed again
+        assert lists.count("pods") == 2
+    finally:
+        query.stop()